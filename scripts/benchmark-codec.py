@@ -0,0 +1,63 @@
+"""
+Compare the time taken to encode the payloads we send for each spec and each log line, and to decode a
+spec's report, with the schemas (and stdlib json) and with the codec:
+
+    python scripts/benchmark-codec.py [number of tests in the spec]
+"""
+import json
+import sys
+import timeit
+
+from cykubedrunner import codec
+from cykubedrunner.common.enums import AgentEventType, LogLevel, TestResultStatus
+from cykubedrunner.common.schemas import AgentSpecCompleted, AgentLogMessage, AppLogMessage, SpecTests, SpecTest, \
+    TestResult, TestResultError, CodeFrame
+from cykubedrunner.common.utils import utcnow
+
+
+def make_spec_completed(count: int) -> AgentSpecCompleted:
+    tests = []
+    for i in range(count):
+        result = TestResult(browser='electron', status=TestResultStatus.passed, retry=0, duration=120 + i % 50)
+        if i % 20 == 0:
+            result.status = TestResultStatus.failed
+            result.failure_screenshots = [f'https://api.cykubed.com/artifacts/image{i}.png']
+            result.errors = [TestResultError(title='AssertionError', test_line=i,
+                                             message=f'Expected to find element: #item-{i}, but never found it.',
+                                             stack=f'AssertionError: at Context.eval (generated.spec.ts:{i}:12)',
+                                             code_frame=CodeFrame(file='generated.spec.ts', line=i, column=12,
+                                                                  language='ts', frame=f'> {i} |  cy.get("#item")'))]
+        tests.append(SpecTest(title=f'generated test {i}', context=f'group {i // 100}', status=result.status,
+                              results=[result]))
+    return AgentSpecCompleted(file='cypress/e2e/generated.spec.ts', finished=utcnow(),
+                              result=SpecTests(tests=tests))
+
+
+def make_log_message() -> AgentLogMessage:
+    return AgentLogMessage(type=AgentEventType.log, testrun_id=20,
+                           msg=AppLogMessage(ts=utcnow(), level=LogLevel.info, host='runner-1', step=3,
+                                             source='runner', msg='Completed test: group 1 generated test 123'))
+
+
+def compare(name: str, number: int, before, after):
+    before_time = timeit.timeit(before, number=number) / number
+    after_time = timeit.timeit(after, number=number) / number
+    print(f'{name:>20}: {before_time * 1e6:10.1f}us -> {after_time * 1e6:10.1f}us '
+          f'({before_time / after_time:.1f}x)')
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    print(f'Using {"orjson" if codec.orjson else "the standard library"}: {count} tests per spec')
+
+    spec_completed = make_spec_completed(count)
+    report = spec_completed.result.json()
+    log_message = make_log_message()
+
+    compare('spec-completed', 50, spec_completed.json, lambda: codec.encode_model(spec_completed))
+    compare('decode results', 50, lambda: json.loads(report), lambda: codec.loads(report))
+    compare('log line', 10000, log_message.json, lambda: codec.encode_model(log_message))
+
+
+if __name__ == '__main__':
+    main()
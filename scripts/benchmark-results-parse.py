@@ -0,0 +1,74 @@
+"""
+Compare the peak memory and time taken to parse (and serialise) a huge Cypress report, using the schemas and the
+lean records:
+
+    python scripts/benchmark-results-parse.py [number of tests]
+"""
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from cykubedrunner.cypress import CypressSpecRunner
+from cykubedrunner.settings import settings
+
+SPEC = 'cypress/e2e/generated.spec.ts'
+
+
+def make_test(i: int) -> dict:
+    test = dict(title=f'generated test {i}', context=f'group {i // 100}', file=SPEC, duration=120 + i % 50,
+                currentRetry=0, offset=i * 150, err={})
+    if i % 20 == 0:
+        message = f'Timed out retrying after 4000ms: Expected to find element: #item-{i}, but never found it.'
+        test['err'] = dict(name='AssertionError', message=message,
+                           stack=f'AssertionError: {message}\n    at Context.eval (webpack:///./{SPEC}:{i}:12)',
+                           parsedStack=[dict(relativeFile=SPEC, line=i, column=12)],
+                           codeFrame=dict(line=i, column=12, relativeFile=SPEC, language='ts',
+                                          frame=f'> {i} |     cy.get("#item-{i}").should("be.visible");'))
+    return test
+
+
+def write_report(path: str, count: int):
+    tests = [make_test(i) for i in range(count)]
+    report = dict(stats=dict(tests=count), tests=tests, pending=[],
+                  failures=[t for t in tests if t['err']], passes=[t for t in tests if not t['err']])
+    with open(path, 'w') as f:
+        json.dump(report, f, indent=2)
+
+
+def measure(runner: CypressSpecRunner, lean: bool) -> tuple[float, float, int, int]:
+    settings.LEAN_RESULTS_MIN_SIZE = 0 if lean else sys.maxsize
+    tracemalloc.start()
+    started = time.perf_counter()
+    result = runner.parse_results()
+    parsed = time.perf_counter()
+    content = result.json()
+    finished = time.perf_counter()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return parsed - started, finished - parsed, peak, len(content)
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+    with tempfile.TemporaryDirectory() as tmpdir:
+        # we don't need a test run just to parse results
+        runner = CypressSpecRunner.__new__(CypressSpecRunner)
+        runner.file = SPEC
+        runner.browser = 'electron'
+        runner.results_file = os.path.join(tmpdir, 'out.json')
+        runner.screenshots_folder = os.path.join(tmpdir, 'screenshots')
+        runner.videos_folder = os.path.join(tmpdir, 'videos')
+        write_report(runner.results_file, count)
+        print(f'{count} tests: report is {os.path.getsize(runner.results_file) / 2**20:.1f} MiB')
+
+        for name, lean in [('schemas', False), ('lean', True)]:
+            parse, serialise, peak, size = measure(runner, lean)
+            print(f'{name:>8}: parse {parse:.2f}s, serialise {serialise:.2f}s, peak memory {peak / 2**20:.1f} MiB '
+                  f'({size} bytes of JSON)')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,7 +1,9 @@
 import os
+from functools import cached_property
 
 import httpx
 
+from cykubedrunner import codec
 from cykubedrunner.common.exceptions import RunFailedException
 from cykubedrunner.common.schemas import NewTestRun
 from cykubedrunner.settings import settings
@@ -9,33 +11,63 @@ from cykubedrunner.settings import settings
 
 class App(object):
     def __init__(self):
-        self.is_spot = False
-        self.is_yarn = os.path.exists(os.path.join(settings.src_dir, 'yarn.lock'))
-        self.is_yarn_modern = False
-        self.is_yarn_zero_install = False
-        self.is_terminating = False
-        self.specs_completed = set()
+        self.is_spot = settings.SPOT
         self.http_client: httpx.Client = None
-        self.trid = None
+        self.reset()
 
+    @cached_property
+    def hostname(self) -> str:
         with open('/etc/hostname') as f:
-            self.hostname = f.read().strip()
+            return f.read().strip()
 
-    def init_http_client(self, trid: int):
+    def init_http_client(self, trid: int = None):
         self.trid = trid
+        if self.http_client:
+            # keep the existing connection pool
+            return
         transport = httpx.HTTPTransport(retries=settings.MAX_HTTP_RETRIES)
         self.http_client = httpx.Client(transport=transport,
                                    base_url=settings.MAIN_API_URL + f'/agent',
                                    headers={'Authorization': f'Bearer {settings.API_TOKEN}'})
 
+    def reset(self):
+        """
+        Clear any state from the previous test run, so a pooled runner can start afresh
+        """
+        self.detect_package_manager()
+        self.is_yarn_zero_install = False
+        self.is_terminating = False
+        # if set, the time by which any running spec must finish (used on spot termination)
+        self.terminate_by: float = None
+        self.specs_completed = set()
+        self.trid = None
+        # the URL of the caching proxy in front of the app's upstreams, if it's running
+        self.proxy_url: str = None
+
+    def detect_package_manager(self):
+        """
+        Work out how the node environment is (or will be) installed from the files in the source directory
+        """
+        def exists(name):
+            return os.path.exists(os.path.join(settings.src_dir, name))
+
+        self.is_yarn = exists('yarn.lock')
+        self.is_yarn_modern = self.is_yarn and exists('.yarnrc.yml')
+        # Yarn Plug'n'Play: there's no node_modules, as packages are loaded from the zip cache
+        self.is_yarn_pnp = self.is_yarn and exists('.pnp.cjs')
+        self.is_pnpm = exists('pnpm-lock.yaml')
+
     def get_testrun(self) -> NewTestRun:
         r = self.http_client.get(f'testrun/{self.trid}')
         if r.status_code != 200:
             raise RunFailedException(f'Failed to get testrun: {r.status_code}')
-        return NewTestRun.parse_raw(r.text)
+        return NewTestRun.parse_obj(codec.loads(r.content))
 
-    def post(self, url, **kwargs):
-        r = self.http_client.post(f'testrun/{self.trid}/{url}', **kwargs)
+    def post(self, url, trid: int = None, **kwargs):
+        if 'json' in kwargs:
+            kwargs['content'] = codec.dumpb(kwargs.pop('json'))
+            kwargs['headers'] = {'Content-Type': 'application/json', **kwargs.get('headers', {})}
+        r = self.http_client.post(f'testrun/{trid or self.trid}/{url}', **kwargs)
         if r.status_code not in [200, 204]:
             raise RunFailedException(f'Failed to post {url}: {r.status_code}')
         return r
@@ -0,0 +1,112 @@
+import hashlib
+import os
+import re
+
+from cykubedrunner.common.schemas import SpecTests
+from cykubedrunner.settings import settings
+from cykubedrunner.utils import logger, all_results_with_screenshots_generator
+
+ATTEMPT_REGEX = re.compile(r'\(attempt (\d+)\)')
+MIN_SCREENSHOT_WIDTH = 320
+
+
+def get_attempt(path: str) -> int:
+    """
+    Cypress adds the attempt number to the screenshots for retries
+    """
+    m = ATTEMPT_REGEX.search(os.path.basename(path))
+    return int(m.group(1)) if m else 1
+
+
+def get_final_results(specresult: SpecTests) -> set[int]:
+    """
+    Return the ids of the results for the final attempt of each test in each browser (Playwright and
+    reruns give each attempt its own result)
+    """
+    final = set()
+    for test in specresult.tests:
+        latest = dict()
+        for result in test.results:
+            if result.browser not in latest or (result.retry or 0) >= (latest[result.browser].retry or 0):
+                latest[result.browser] = result
+        final.update(id(result) for result in latest.values())
+    return final
+
+
+def file_digest(path: str) -> str:
+    with open(path, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def encode_screenshot(path: str) -> str:
+    """
+    Re-encode a screenshot in SCREENSHOT_FORMAT, scaling it down if needed to fit in SCREENSHOT_MAX_BYTES.
+    Returns the path of the new file, or the original if it can't be made smaller
+    """
+    try:
+        from PIL import Image
+    except ImportError:
+        logger.warning('Pillow is not installed: uploading screenshots as they are')
+        return path
+
+    fmt = settings.SCREENSHOT_FORMAT.lower()
+    options = dict(lossless=True) if fmt == 'webp' and settings.SCREENSHOT_QUALITY >= 100 \
+        else dict(quality=settings.SCREENSHOT_QUALITY)
+    outpath = f'{os.path.splitext(path)[0]}.{fmt}'
+    original_size = os.path.getsize(path)
+
+    with Image.open(path) as image:
+        if fmt == 'jpeg':
+            image = image.convert('RGB')
+        while True:
+            image.save(outpath, format=fmt, optimize=True, **options)
+            size = os.path.getsize(outpath)
+            if not settings.SCREENSHOT_MAX_BYTES or size <= settings.SCREENSHOT_MAX_BYTES \
+                    or image.width * 3 // 4 < MIN_SCREENSHOT_WIDTH:
+                break
+            image = image.resize((image.width * 3 // 4, image.height * 3 // 4))
+
+    if size >= original_size:
+        os.remove(outpath)
+        return path
+    return outpath
+
+
+class ScreenshotUpload(object):
+    """
+    The screenshots to upload for a spec: each distinct image is uploaded once, however many test
+    results (retries or browsers) it belongs to
+    """
+    def __init__(self, specresult: SpecTests):
+        self.results = list(all_results_with_screenshots_generator(specresult))
+        self.files: list[str] = []
+        # for each result, the index into files of each of its screenshots
+        self.indexes: list[list[int]] = []
+
+        final = get_final_results(specresult) if settings.SCREENSHOT_POLICY == 'final' else None
+        by_digest = dict()
+        for result in self.results:
+            screenshots = result.failure_screenshots
+            if final is not None:
+                # Cypress puts every attempt's screenshots in the one result
+                screenshots = sorted(screenshots, key=get_attempt)[-1:] if id(result) in final else []
+            indexes = []
+            for path in screenshots:
+                digest = file_digest(path)
+                if digest not in by_digest:
+                    by_digest[digest] = len(self.files)
+                    self.files.append(encode_screenshot(path) if settings.SCREENSHOT_FORMAT else path)
+                if by_digest[digest] not in indexes:
+                    indexes.append(by_digest[digest])
+            self.indexes.append(indexes)
+
+        total = sum(len(r.failure_screenshots) for r in self.results)
+        if total > len(self.files):
+            logger.debug(f'Uploading {len(self.files)} of {total} screenshots')
+
+    def set_urls(self, urls: list[str]):
+        """
+        Replace the screenshots for each result with the URLs of the uploaded files
+        """
+        for result, indexes in zip(self.results, self.indexes):
+            result.failure_screenshots = [urls[i] for i in indexes]
@@ -1,24 +1,77 @@
 import os
 import subprocess
-import tempfile
+import threading
+import time
 from abc import ABC, abstractmethod
 
 from cykubedrunner.app import app
 from cykubedrunner.common import schemas
 from cykubedrunner.common.exceptions import RunFailedException
-from cykubedrunner.common.schemas import NewTestRun, AgentSpecCompleted, SpecTests
+from cykubedrunner.common.enums import TestResultStatus
+from cykubedrunner.common.schemas import NewTestRun, SpecTests, SpecTest, TestResult, \
+    TestResultError
 from cykubedrunner.common.utils import utcnow
+from cykubedrunner.caches import get_dir_size
+from cykubedrunner.durations import spec_durations
+from cykubedrunner.scratch import scratch
 from cykubedrunner.server import ServerThread
 from cykubedrunner.settings import settings
-from cykubedrunner.utils import logger
+from cykubedrunner.utils import logger, kill_process_tree, upload_results
+from cykubedrunner.watchdog import ProcessWatchdog, get_spec_memory_limit, running_specs, spec_usage, MB
+
+PROCESS_POLL_INTERVAL = 1
+OUT_OF_MEMORY_TITLE = 'Out of memory'
+
+
+class SpecInterrupted(Exception):
+    """
+    The runner is shutting down and the spec couldn't be completed in time
+    """
+    pass
+
+
+class SpecOutOfMemory(Exception):
+    """
+    The spec used more memory than we allow, and was killed
+    """
+    pass
+
+
+class OutputReader(threading.Thread):
+    """
+    Collect the output of a stream, noting when we last saw anything
+    """
+    def __init__(self, stream):
+        super().__init__(daemon=True)
+        self.stream = stream
+        self.lines = []
+        self.last_output = time.time()
+
+    def run(self):
+        for line in iter(self.stream.readline, ''):
+            self.lines.append(line)
+            self.last_output = time.time()
+
+    @property
+    def output(self) -> str:
+        return ''.join(self.lines)
 
 
 class BaseSpecRunner(ABC):
-    def __init__(self, server: ServerThread, testrun: NewTestRun, file: str):
+    browser: str = None
+
+    def __init__(self, server: ServerThread, testrun: NewTestRun, file: str | list[str],
+                 only: list[SpecTest] = None):
+        """
+        Run either a single spec, or a batch of specs in a single process. If `only` is set we just rerun
+        those tests from the spec
+        """
         self.server = server
         self.testrun = testrun
-        self.file = file
-        self.results_dir = tempfile.mkdtemp()
+        self.only = only
+        self.files = [file] if isinstance(file, str) else list(file)
+        self.file = ','.join(self.files)
+        self.results_dir = scratch.create(self.files)
         self.results_file = os.path.join(self.results_dir, 'out.json')
         self.screenshots_folder = os.path.join(self.results_dir, 'screenshots')
         self.videos_folder = os.path.join(self.results_dir, 'videos')
@@ -36,29 +89,135 @@ class BaseSpecRunner(ABC):
     def parse_results(self) -> schemas.SpecTests:
         pass
 
+    @abstractmethod
+    def parse_batch_results(self) -> dict[str, schemas.SpecTests]:
+        pass
+
     def get_env(self):
         return dict()
 
-    def create_process(self) -> subprocess.CompletedProcess:
+    def get_command(self) -> list[str]:
+        """
+        With Yarn Plug'n'Play there's no node_modules/.bin, so we run the test framework through yarn,
+        which sets up the PnP loader
+        """
         args = self.get_args()
+        if app.is_yarn_pnp:
+            if args[0] == 'npx':
+                args = args[1:]
+            return ['yarn'] + args
+        return args
+
+    @property
+    def is_batch(self) -> bool:
+        return len(self.files) > 1
+
+    @property
+    def use_lean_results(self) -> bool:
+        return os.path.getsize(self.results_file) >= settings.LEAN_RESULTS_MIN_SIZE
+
+    @property
+    def in_process_retries(self) -> int:
+        """
+        Retries are handled by the test framework, unless we're rerunning failed tests in a new process
+        (which we don't do for batches)
+        """
+        if settings.RETRY_FAILED_TESTS and not self.is_batch:
+            return 0
+        return self.testrun.project.runner_retries or 0
+
+    def match_spec(self, path: str) -> str | None:
+        """
+        Return the spec in this batch that corresponds to the file reported by the test framework
+        """
+        for spec in self.files:
+            if path == spec or path.endswith(f'/{spec}') or spec.endswith(f'/{path}'):
+                return spec
+        return None
+
+    def get_deadline(self) -> int | None:
+        """
+        A batch gets the sum of the deadlines of its specs
+        """
+        deadlines = [spec_durations.get_deadline(spec, self.testrun.project.spec_deadline) for spec in self.files]
+        if not all(deadlines):
+            return None
+        return sum(deadlines)
+
+    def create_process(self) -> subprocess.CompletedProcess:
+        args = self.get_command()
         fullcmd = ' '.join(args)
         logger.debug(f'Calling runner with args: "{fullcmd}"')
 
-        result = subprocess.run(args,
-                                timeout=self.testrun.project.spec_deadline or None,
-                                capture_output=True,
-                                text=True,
-                                env=self.get_env(),
-                                cwd=settings.src_dir)
-        logger.debug(f'runner stdout: \n{result.stdout}')
-        logger.debug(f'runner stderr: \n{result.stderr}')
-        return result
+        if app.terminate_by and time.time() > app.terminate_by:
+            raise SpecInterrupted(f'No time left to run {self.file}')
+
+        timeout = self.get_deadline()
+        deadline = time.time() + timeout if timeout else None
+        if timeout and timeout != self.testrun.project.spec_deadline:
+            logger.debug(f'Using deadline of {timeout}s for spec {self.file}')
+
+        with running_specs.track(), subprocess.Popen(args,
+                                                     stdout=subprocess.PIPE,
+                                                     stderr=subprocess.PIPE,
+                                                     text=True,
+                                                     env=self.get_env(),
+                                                     cwd=settings.app_dir) as proc:
+            stdout, stderr = OutputReader(proc.stdout), OutputReader(proc.stderr)
+            stdout.start()
+            stderr.start()
+            watchdog = ProcessWatchdog(proc.pid)
+            try:
+                while True:
+                    # poll rather than block so we can enforce the various deadlines
+                    try:
+                        proc.wait(timeout=PROCESS_POLL_INTERVAL)
+                        break
+                    except subprocess.TimeoutExpired:
+                        pass
+                    rss = watchdog.sample()
+                    # this changes as other specs start and finish
+                    memory_limit = get_spec_memory_limit()
+                    if memory_limit and rss > memory_limit:
+                        raise SpecOutOfMemory(f'Spec {self.file} used {rss // MB}MB of memory, more than the '
+                                              f'limit of {memory_limit // MB}MB')
+                    now = time.time()
+                    if app.terminate_by and now > app.terminate_by:
+                        raise SpecInterrupted(f'Spec {self.file} did not finish within the termination budget')
+                    if deadline and now > deadline:
+                        raise subprocess.TimeoutExpired(args, timeout)
+                    silent = now - max(stdout.last_output, stderr.last_output)
+                    if settings.SPEC_OUTPUT_TIMEOUT and silent > settings.SPEC_OUTPUT_TIMEOUT:
+                        logger.warning(f'No output from spec {self.file} for {silent:.0f}s: assuming it has hung')
+                        raise subprocess.TimeoutExpired(args, timeout)
+            except BaseException:
+                # including the SystemExit from a SIGTERM, or Popen would wait for the browser to exit
+                kill_process_tree(proc)
+                proc.wait()
+                raise
+            finally:
+                stdout.join()
+                stderr.join()
+                watchdog.usage.scratch_bytes = get_dir_size(self.results_dir)
+                spec_usage.record(self.files, watchdog.usage)
+                logger.debug(f'Spec {self.file} used at most {watchdog.usage.peak_rss // MB}MB of memory, '
+                             f'{watchdog.usage.cpu_time:.1f}s of CPU time and wrote '
+                             f'{watchdog.usage.scratch_bytes // MB}MB')
+
+        logger.debug(f'runner stdout: \n{stdout.output}')
+        logger.debug(f'runner stderr: \n{stderr.output}')
+        return subprocess.CompletedProcess(args, proc.returncode, stdout.output, stderr.output)
 
     def run(self) -> SpecTests:
         self.started = utcnow()
         logger.debug(f'Run tests for {self.file}')
         try:
+            started = time.time()
             proc = self.create_process()
+            if not self.only:
+                # the deadline applies to each process, so that's what we keep the history of
+                spec_durations.record(self.file, time.time() - started)
+                spec_durations.save()
             if not os.path.exists(self.results_file):
                 if proc.returncode == 1:
                     # there was a problem with the run - log output
@@ -67,13 +226,96 @@ class BaseSpecRunner(ABC):
 
             # parse the results
             return self.parse_results()
+        except SpecOutOfMemory as ex:
+            logger.error(str(ex))
+            if self.only:
+                return None
+            return self.get_out_of_memory_result(str(ex))
         except subprocess.TimeoutExpired:
             logger.info(f'Exceeded deadline for spec {self.file}')
+            if self.only:
+                # we still have the results of the original run
+                return None
+
+            # through the spool, if it's enabled, like any other result
+            upload_results(self.file, SpecTests(timeout=True, tests=[]), usage=spec_usage.pop(self.file))
+
+    def get_out_of_memory_result(self, msg: str) -> SpecTests:
+        """
+        We don't know which test was running, so report a single failed test for the spec
+        """
+        result = TestResult(browser=self.browser, status=TestResultStatus.failed, retry=0,
+                            errors=[TestResultError(title='OutOfMemory', message=msg)])
+        return SpecTests(tests=[SpecTest(title=OUT_OF_MEMORY_TITLE, status=TestResultStatus.failed,
+                                         results=[result])])
+
+    def run_batch(self) -> dict[str, SpecTests]:
+        """
+        Run a batch of specs. Only the results of the specs that completed are returned: it's up to the caller
+        to deal with the rest
+        """
+        self.started = utcnow()
+        logger.debug(f'Run tests for {self.file}')
+        try:
+            started = time.time()
+            proc = self.create_process()
+            duration = time.time() - started
+            if not os.path.exists(self.results_file):
+                logger.error(f"Batch run failed to produce any results:\n {proc.stdout}\n{proc.stderr}")
+                return dict()
+            results = self.parse_batch_results()
+            if len(results) == len(self.files):
+                self.record_batch_durations(results, duration)
+            return results
+        except SpecOutOfMemory as ex:
+            # the specs that completed before this can still be reported
+            logger.error(str(ex))
+            if not os.path.exists(self.results_file):
+                return dict()
+        except subprocess.TimeoutExpired:
+            logger.info(f'Exceeded deadline for specs {self.file}')
+            if not os.path.exists(self.results_file):
+                return dict()
+        return self.parse_batch_results()
+
+    def record_batch_durations(self, results: dict[str, SpecTests], duration: float):
+        """
+        Split the duration of the batch between its specs, in proportion to the time spent in their tests
+        """
+        weights = {spec: sum(result.duration or 0 for test in spectests.tests for result in test.results)
+                   for spec, spectests in results.items()}
+        total = sum(weights.values())
+        for spec, weight in weights.items():
+            spec_durations.record(spec, duration * weight / total if total else duration / len(weights))
+        spec_durations.save()
+
+
+def test_key(test: SpecTest) -> tuple:
+    return test.context, test.title, test.line
+
+
+def get_failed_tests(spectests: SpecTests) -> list[SpecTest]:
+    # there's nothing to rerun if the whole spec ran out of memory
+    return [test for test in spectests.tests
+            if test.status == TestResultStatus.failed and test.title != OUT_OF_MEMORY_TITLE]
+
 
-            r = app.http_client.post('/spec-completed',
-                                     content=AgentSpecCompleted(
-                                         result=SpecTests(timeout=True, tests=[]),
-                                         file=self.file,
-                                         finished=utcnow()).json())
-            if r.status_code != 200:
-                raise RunFailedException(f'Failed to set spec completed: {r.status_code}: {r.text}')
+def merge_rerun(spectests: SpecTests, rerun: SpecTests):
+    """
+    Merge the results of rerunning the failed tests into the original results. Each result is a further
+    attempt for its browser, and a test that now passes is flakey
+    """
+    tests = {test_key(test): test for test in spectests.tests}
+    for rerun_test in rerun.tests:
+        test = tests.get(test_key(rerun_test))
+        if not test:
+            continue
+        for result in rerun_test.results:
+            previous = [r for r in test.results if r.browser == result.browser]
+            if previous and previous[-1].status != TestResultStatus.failed:
+                # only failed in another browser
+                continue
+            result.retry = max((r.retry or 0 for r in previous), default=-1) + 1
+            test.results.append(result)
+        if test.status == TestResultStatus.failed and rerun_test.status != TestResultStatus.failed:
+            test.status = TestResultStatus.flakey
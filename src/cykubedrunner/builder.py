@@ -1,18 +1,27 @@
 import json
 import os
 import re
+import shlex
 import time
+from contextlib import nullcontext
+from functools import partial
 
-import yaml
-from wcmatch import glob
-
+from cykubedrunner import codec
 from cykubedrunner.app import app
+from cykubedrunner.bundler import bundle_specs
+from cykubedrunner.caches import get_package_version, get_cypress_cache, get_playwright_cache, \
+    get_playwright_version, get_playwright_browsers_path
 from cykubedrunner.common.enums import TestRunStatus, TestFramework
 from cykubedrunner.common.exceptions import BuildFailedException
 from cykubedrunner.common.schemas import NewTestRun, \
     AgentBuildCompleted
+from cykubedrunner.fsutils import move, remove_tree, sync_filesystem
+from cykubedrunner.pkgcache import use_package_cache, NpmCache, YarnCache, YarnBerryCache
+from cykubedrunner.snapshot import create_snapshot
 from cykubedrunner.settings import settings
+from cykubedrunner.steps import BuildStep, run_steps
 from cykubedrunner.utils import runcmd, logger, root_file_exists, get_node_version
+from cykubedrunner.workspaces import get_workspace_paths, get_workspace_name
 
 CYPRESS_INCLUDE_SPEC_REGEX = re.compile(r'specPattern:\s*[\"\'](.*)[\"\']')
 CYPRESS_EXCLUDE_SPEC_REGEX = re.compile(r'excludeSpecPattern:\s*[\"\'](.*)[\"\']')
@@ -24,18 +33,37 @@ PLAYWRIGHT_EXCLUDE_SPEC_REGEX = re.compile(r'testIgnore:\s*[\"\'](.*)[\"\']')
 
 def clone_repos(testrun: NewTestRun):
     logger.info("Cloning repository")
+    # in a monorepo we start with just the files at the root, and fetch the rest as we check it out
+    sparse = '--filter=blob:none --sparse ' if settings.APP_PATH else ''
     if not testrun.sha:
-        runcmd(f'git clone --single-branch --depth 1 --recursive --branch {testrun.branch} {testrun.url} .',
+        runcmd(f'git clone {sparse}--single-branch --depth 1 --recursive --branch {testrun.branch} {testrun.url} .',
                log=True, cwd=settings.src_dir)
     else:
-        runcmd(f'git clone --recursive {testrun.url} .', log=True, cwd=settings.src_dir)
+        runcmd(f'git clone {sparse}--recursive {testrun.url} .', log=True, cwd=settings.src_dir)
 
     logger.info(f"Cloned branch {testrun.branch}")
     if testrun.sha:
         runcmd(f'git reset --hard {testrun.sha}', cwd=settings.src_dir)
+    if settings.APP_PATH:
+        sparse_checkout(settings.APP_PATH)
+
+
+def sparse_checkout(app_path: str):
+    """
+    Check out the app's workspace and the workspaces it depends on (the files at the root are always checked
+    out in cone mode, so we have the lockfile)
+    """
+    files = runcmd('git ls-tree -r --name-only HEAD', cwd=settings.src_dir).stdout.splitlines()
+    paths = get_workspace_paths(app_path, files,
+                                lambda path: runcmd(f'git show HEAD:{shlex.quote(path)}', cwd=settings.src_dir).stdout)
+    logger.info(f'Checking out workspaces {", ".join(paths)}')
+    runcmd(f'git sparse-checkout set {" ".join(shlex.quote(path) for path in paths)}', log=True,
+           cwd=settings.src_dir)
 
 
 def enable_yarn2_global_cache(yarnrc):
+    import yaml
+
     with open(yarnrc) as f:
         data = yaml.safe_load(f)
         data['enableGlobalCache'] = True
@@ -44,17 +72,33 @@ def enable_yarn2_global_cache(yarnrc):
         yaml.dump(data, f)
 
 
-def create_node_environment(testrun: NewTestRun):
+def create_node_environment(testrun: NewTestRun) -> bool:
     """
-    Create node environment from either Yarn or npm
+    Create node environment from either pnpm, Yarn or npm. Returns True if the node_modules came from the cache
     """
 
     logger.info(f"Creating node distribution")
 
     t = time.time()
     using_cache = False
-
-    if root_file_exists('yarn.lock'):
+    # in a monorepo, only install the app's workspace (and the workspaces it depends on)
+    workspace = get_workspace_name(settings.app_dir) if settings.APP_PATH else None
+    if settings.APP_PATH and not workspace:
+        logger.warning(f'No package name found for {settings.APP_PATH}: installing all workspaces')
+
+    if root_file_exists('pnpm-lock.yaml'):
+        app.is_pnpm = True
+        # pnpm hard links packages from its content-addressable store, so there's no need to keep node_modules:
+        # just the store, which is on the same volume
+        if os.path.exists(settings.pnpm_store):
+            logger.info("Using cached pnpm store")
+            using_cache = True
+        else:
+            logger.info("Building new node cache using pnpm")
+        focus = f' --filter={shlex.quote(workspace)}...' if workspace else ''
+        runcmd(f'pnpm install --frozen-lockfile --store-dir={settings.pnpm_store}{focus}', cmd=True,
+               cwd=settings.src_dir)
+    elif root_file_exists('yarn.lock'):
         logger.info("Building new node cache using yarn")
         # check for yarn2
         app.is_yarn = True
@@ -73,37 +117,64 @@ def create_node_environment(testrun: NewTestRun):
                     using_cache = True
                 enable_yarn2_global_cache(yarnrc)
 
-            runcmd(f'yarn install', cmd=True, cwd=settings.src_dir)
+            with nullcontext() if app.is_yarn_zero_install else use_package_cache(YarnBerryCache()):
+                if workspace:
+                    runcmd(f'yarn workspaces focus {shlex.quote(workspace)}', cmd=True, cwd=settings.src_dir)
+                else:
+                    runcmd(f'yarn install', cmd=True, cwd=settings.src_dir)
+            app.is_yarn_pnp = root_file_exists('.pnp.cjs')
+            if app.is_yarn_pnp:
+                logger.info("Using Plug'n'Play")
         else:
             logger.info("Assume Yarn1.x")
             if os.path.exists(settings.cached_node_modules):
                 logger.info("Using cached node_modules")
                 using_cache = True
-                runcmd(f'mv {settings.cached_node_modules} {settings.src_dir}')
+                move(settings.cached_node_modules, os.path.join(settings.src_dir, 'node_modules'))
             else:
-                runcmd(f'yarn install --pure-lockfile --cache-folder={settings.BUILD_DIR}/.yarn-cache',
-                       cmd=True, cwd=settings.src_dir)
+                with use_package_cache(YarnCache()) as cache_dir:
+                    runcmd(f'yarn install --pure-lockfile --cache-folder={cache_dir}',
+                           cmd=True, cwd=settings.src_dir)
     else:
         if os.path.exists(settings.cached_node_modules):
             logger.info("Using cached node_modules")
             using_cache = True
-            runcmd(f'mv {settings.cached_node_modules} {settings.src_dir}')
+            move(settings.cached_node_modules, os.path.join(settings.src_dir, 'node_modules'))
         else:
             logger.info("Building new node cache using npm")
-            runcmd('npm ci', cmd=True, cwd=settings.src_dir)
+            with use_package_cache(NpmCache()) as cache_dir:
+                focus = f' --workspace={shlex.quote(settings.APP_PATH)} --include-workspace-root' if workspace else ''
+                runcmd(f'npm ci --cache={cache_dir} --prefer-offline{focus}', cmd=True, cwd=settings.src_dir)
 
     t = time.time() - t
     logger.info(f"Created node environment in {t:.1f}s")
+    return using_cache
+
 
-    # pre-verify it so it's properly read-only
+def verify_test_framework(testrun: NewTestRun, using_cache: bool):
+    """
+    Pre-verify the test framework so the runners don't need to (and the cache is properly read-only).
+    This only needs doing once per version
+    """
     if testrun.project.test_framework == TestFramework.cypress:
-        if not using_cache:
-            runcmd('cypress verify', cwd=settings.src_dir, cmd=True, node=True)
+        version = get_package_version('cypress')
+        verify = partial(runcmd, 'cypress verify', cwd=settings.src_dir, cmd=True, node=True)
+        if not version:
+            # we can't tell which binary this needs, so just verify it if it's new
+            if not using_cache:
+                verify()
+        elif get_cypress_cache().ensure(version, verify):
+            logger.info(f'Cypress {version} already verified')
     else:
         # check we have the browsers
-        runcmd('npx playwright install', cwd=settings.src_dir, cmd=True,
-               env=dict(PLAYWRIGHT_BROWSERS_PATH='0'))
-
+        version = get_playwright_version()
+        install = partial(runcmd, 'yarn playwright install' if app.is_yarn_pnp else 'npx playwright install',
+                          cwd=settings.src_dir, cmd=True,
+                          env=dict(PLAYWRIGHT_BROWSERS_PATH=get_playwright_browsers_path()))
+        if not version:
+            install()
+        elif get_playwright_cache().ensure(version, install):
+            logger.info(f'Using cached browsers for Playwright {version}')
 
 
 def make_array(x):
@@ -118,6 +189,8 @@ def get_playwright_specs(wdir, spec_filter=None):
     the config file natively. I acknowledge that this is an imperfect solution and could break if the config
     file has actual code in it: a better solution is probably a tiny Node library to do the same job.
     """
+    from wcmatch import glob
+
     config = os.path.join(wdir, 'playwright.config.js')
     if not os.path.exists(config):
         config = os.path.join(wdir, 'playwright.config.ts')
@@ -144,6 +217,8 @@ def get_playwright_specs(wdir, spec_filter=None):
 
 
 def get_cypress_specs(wdir, spec_filter=None):
+    from wcmatch import glob
+
     cyjson = os.path.join(wdir, 'cypress.json')
     folder = wdir
     prefix = None
@@ -182,6 +257,35 @@ def get_cypress_specs(wdir, spec_filter=None):
     return specs
 
 
+def get_specs(testrun: NewTestRun) -> list[str]:
+    if testrun.project.test_framework == TestFramework.cypress:
+        return get_cypress_specs(settings.app_dir, testrun.project.spec_filter)
+    return get_playwright_specs(settings.app_dir, testrun.project.spec_filter)
+
+
+def build_steps(testrun: NewTestRun) -> list[BuildStep]:
+    """
+    The build steps that follow the checkout, and what each depends on
+    """
+    node_env = BuildStep('node_environment', lambda: create_node_environment(testrun))
+    specs = BuildStep('specs', lambda: get_specs(testrun))
+    steps = [node_env,
+             specs,
+             BuildStep('verify', lambda: verify_test_framework(testrun, node_env.result), requires=[node_env])]
+
+    build_app_step = None
+    if testrun.project.build_cmd:
+        build_app_step = BuildStep('build_app', lambda: build_app(testrun), requires=[node_env])
+        steps.append(build_app_step)
+
+    if settings.PREBUNDLE_SPECS and testrun.project.test_framework == TestFramework.cypress:
+        # specs may import files generated by the build
+        requires = [node_env, specs] + ([build_app_step] if build_app_step else [])
+        steps.append(BuildStep('bundle', lambda: bundle_specs(specs.result), requires=requires))
+
+    return steps
+
+
 def build():
     """
     Build the distribution
@@ -196,42 +300,41 @@ def build():
 
     clone_repos(testrun)
 
-    if root_file_exists('yarn.lock'):
-        app.is_yarn = True
-        if root_file_exists('.yarnc.yml'):
-            app.is_yarn_modern = True
+    app.detect_package_manager()
 
     logger.info(f'Build distribution for test run {testrun.local_id}')
 
     logger.info(f'Using node {get_node_version()}')
 
-    # create node environment
-    create_node_environment(testrun)
+    # everything else only needs the checkout, so run what we can in parallel
+    steps = build_steps(testrun)
+    timings = run_steps(steps, settings.BUILD_CONCURRENCY)
+    logger.debug('Build step timings: ' + ', '.join(f'{name}={t:.1f}s' for name, t in timings.items()))
 
-    # build the app if required
-    if testrun.project.build_cmd:
-        build_app(testrun)
+    specs = next(step.result for step in steps if step.name == 'specs')
+    logger.debug(f'Parse specs: {specs}')
 
-    # inform the main server so it can tell the agent to
-    # start the runner job
-    if testrun.project.test_framework == TestFramework.cypress:
-        specs = get_cypress_specs(settings.src_dir, testrun.project.spec_filter)
-    else:
-        specs = get_playwright_specs(settings.src_dir, testrun.project.spec_filter)
+    if settings.WORKSPACE_SNAPSHOT:
+        create_snapshot()
 
-    logger.debug(f'Parse specs: {specs}')
-    app.post('build-completed', content=AgentBuildCompleted(specs=specs).json())
+    # make sure the build is on disk before the runners are started
+    sync_filesystem(settings.BUILD_DIR)
+    app.post('build-completed', content=codec.encode_model(AgentBuildCompleted(specs=specs)))
 
 
 def prepare_cache():
     """
-    Move the cachable stuff into root and delete the rest
+    Move the cachable stuff into root and delete the rest. Yarn berry and pnpm keep their own caches
+    (the zip cache and the store) so we only need to keep node_modules for npm and Yarn 1
     """
+    app.detect_package_manager()
 
-    if os.path.exists(f'{settings.src_dir}/node_modules') and not app.is_yarn_modern:
-        runcmd(f'mv {settings.src_dir}/node_modules {settings.BUILD_DIR}')
+    if os.path.exists(f'{settings.src_dir}/node_modules') and not app.is_yarn_modern and not app.is_pnpm:
+        move(f'{settings.src_dir}/node_modules', settings.cached_node_modules)
 
-    runcmd(f'rm -fr {settings.src_dir}')
+    remove_tree(settings.src_dir)
+    remove_tree(settings.snapshot_dir)
+    sync_filesystem(settings.BUILD_DIR)
     logger.info("Send cache_prepared event")
 
     app.post('cache-prepared')
@@ -241,10 +344,10 @@ def build_app(testrun: NewTestRun):
     logger.info('Building app')
 
     # build the app
-    runcmd(testrun.project.build_cmd, cmd=True, cwd=settings.src_dir, node=True)
+    runcmd(testrun.project.build_cmd, cmd=True, cwd=settings.app_dir, node=True)
 
     # check for dist and index file
-    distdir = os.path.join(settings.src_dir, 'dist')
+    distdir = os.path.join(settings.app_dir, 'dist')
 
     if not os.path.exists(distdir):
         raise BuildFailedException("No dist directory: please check your build command")
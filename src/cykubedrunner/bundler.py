@@ -0,0 +1,178 @@
+import glob
+import hashlib
+import json
+import os
+import re
+import shlex
+from concurrent.futures import ThreadPoolExecutor
+
+from cykubedrunner.common.exceptions import BuildFailedException
+from cykubedrunner.settings import settings
+from cykubedrunner.utils import runcmd, logger
+
+SUPPORT_FILE_GLOBS = ['cypress/support/e2e.*', 'cypress/support/index.*']
+IMPORT_REGEX = re.compile(r'''(?:from|import|require\(|import\()\s*['"](\.{1,2}/[^'"]+)['"]''')
+RESOLVE_SUFFIXES = ['', '.ts', '.tsx', '.js', '.jsx', '.mjs', '.cjs', '.json',
+                    '/index.ts', '/index.tsx', '/index.js', '/index.jsx']
+
+
+def resolve_import(path: str) -> str | None:
+    for suffix in RESOLVE_SUFFIXES:
+        if os.path.isfile(path + suffix):
+            return path + suffix
+    return None
+
+
+def get_dependencies(path: str) -> list[str]:
+    """
+    Return the file and everything it imports (transitively) from inside the source directory, relative
+    to it. Only relative imports are followed: packages are covered by the lockfile
+    """
+    root = os.path.abspath(settings.app_dir)
+    # in a monorepo the app can import from other workspaces
+    src_dir = os.path.abspath(settings.src_dir)
+    found = set()
+    pending = [os.path.abspath(os.path.join(root, path))]
+    while pending:
+        current = pending.pop()
+        if current in found:
+            continue
+        found.add(current)
+        try:
+            with open(current, encoding='utf8', errors='replace') as f:
+                source = f.read()
+        except OSError:
+            continue
+        for imported in IMPORT_REGEX.findall(source):
+            resolved = resolve_import(os.path.normpath(os.path.join(os.path.dirname(current), imported)))
+            if resolved and resolved.startswith(src_dir + os.sep):
+                pending.append(resolved)
+    return sorted(os.path.relpath(x, root) for x in found)
+
+
+def hash_files(digest, paths: list[str]):
+    for path in paths:
+        digest.update(path.encode())
+        with open(os.path.join(settings.app_dir, path), 'rb') as f:
+            digest.update(hashlib.sha256(f.read()).digest())
+
+
+def get_source_hash(path: str, support: str | None) -> str:
+    """
+    Hash the file and everything that goes into its bundle: what it imports, and the support file
+    """
+    paths = get_dependencies(path)
+    if support and support != path:
+        paths += get_dependencies(support)
+    digest = hashlib.sha256()
+    hash_files(digest, paths)
+    return digest.hexdigest()
+
+
+def get_esbuild() -> str | None:
+    for wdir in dict.fromkeys([settings.app_dir, settings.src_dir]):
+        esbuild = os.path.join(wdir, 'node_modules', '.bin', 'esbuild')
+        if os.path.exists(esbuild):
+            return esbuild
+    return None
+
+
+def get_support_file() -> str | None:
+    for pattern in SUPPORT_FILE_GLOBS:
+        found = glob.glob(pattern, root_dir=settings.app_dir)
+        if found:
+            return found[0]
+    return None
+
+
+def bundle(esbuild: str, path: str, support: str | None) -> dict | None:
+    """
+    Bundle a single file. The bundle keeps the same name (in a directory named by the hash of the source), so
+    screenshots and videos are named as they would be for the original
+    """
+    digest = get_source_hash(path, support)
+    outfile = os.path.join(settings.bundles_dir, digest[:16], os.path.basename(path))
+    try:
+        runcmd(f'{shlex.quote(esbuild)} {shlex.quote(path)} --bundle --sourcemap=inline --platform=browser '
+               f'--log-level=error --outfile={shlex.quote(outfile)}', cwd=settings.app_dir)
+    except BuildFailedException as ex:
+        logger.warning(f'Failed to bundle {path}: {ex.msg}')
+        return None
+    # relative, as the runner may be using a copy of the workspace
+    return dict(hash=digest, bundle=os.path.relpath(outfile, settings.app_dir))
+
+
+def bundle_specs(specs: list[str]):
+    """
+    Bundle the Cypress e2e specs (and support file) in parallel, and write a manifest. Component specs are
+    left alone as they're built by the dev server
+    """
+    esbuild = get_esbuild()
+    if not esbuild:
+        logger.info('esbuild is not installed: not bundling specs')
+        return
+
+    logger.info('Bundling specs')
+    os.makedirs(settings.bundles_dir, exist_ok=True)
+    paths = [spec for spec in specs if 'component' not in spec.split('/')]
+    support = get_support_file()
+    if support:
+        paths.append(support)
+
+    with ThreadPoolExecutor(max_workers=settings.BUNDLE_WORKERS) as executor:
+        bundles = dict(zip(paths, executor.map(lambda path: bundle(esbuild, path, support), paths)))
+
+    manifest = {path: entry for path, entry in bundles.items() if entry}
+    if support in manifest:
+        manifest[support]['support'] = True
+    with open(os.path.join(settings.bundles_dir, 'manifest.json'), 'w') as f:
+        f.write(json.dumps(manifest, indent=2))
+    logger.info(f'Bundled {len(manifest)} of {len(paths)} files')
+
+
+class BundleManifest(object):
+    """
+    The bundles created by the builder. A bundle is only used if none of its sources have changed since it
+    was bundled
+    """
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        # loaded when first needed
+        self.manifest = None
+        self.support = None
+
+    def load(self):
+        self.manifest = dict()
+        self.support = get_support_file()
+        path = os.path.join(settings.bundles_dir, 'manifest.json')
+        if os.path.exists(path):
+            with open(path) as f:
+                self.manifest = json.loads(f.read())
+
+    def get_bundle(self, path: str) -> str | None:
+        if self.manifest is None:
+            self.load()
+        entry = self.manifest.get(path)
+        if not entry:
+            return None
+        bundle_file = os.path.join(settings.app_dir, entry['bundle'])
+        src = os.path.join(settings.app_dir, path)
+        if not os.path.exists(bundle_file) or not os.path.exists(src):
+            return None
+        if get_source_hash(path, self.support) != entry['hash']:
+            logger.debug(f'Bundle for {path} is stale: ignoring it')
+            return None
+        return bundle_file
+
+    def get_support_bundle(self) -> str | None:
+        if self.manifest is None:
+            self.load()
+        for path, entry in self.manifest.items():
+            if entry.get('support'):
+                return self.get_bundle(path)
+        return None
+
+
+bundle_manifest = BundleManifest()
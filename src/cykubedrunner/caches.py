@@ -0,0 +1,187 @@
+import fcntl
+import json
+import os
+from contextlib import contextmanager
+from typing import Callable
+
+from cykubedrunner.app import app
+from cykubedrunner.common.utils import utcnow
+from cykubedrunner.fsutils import remove_tree
+from cykubedrunner.settings import settings
+from cykubedrunner.utils import logger
+from cykubedrunner.workspaces import DEPENDENCY_KEYS, parse_json
+
+VERIFIED_STAMP = '.cykubed-verified'
+
+
+def get_package_version(name: str, wdir: str = None) -> str | None:
+    """
+    Return the installed version of a node package, if we can find it. In a monorepo it may be installed in
+    the app's workspace or hoisted to the root
+    """
+    for wdir in [wdir] if wdir else dict.fromkeys([settings.app_dir, settings.src_dir]):
+        try:
+            with open(os.path.join(wdir, 'node_modules', name, 'package.json')) as f:
+                return json.load(f).get('version')
+        except (OSError, ValueError):
+            pass
+    if app.is_yarn_pnp:
+        return get_locked_version(name)
+    return None
+
+
+def get_locked_version(name: str) -> str | None:
+    """
+    With Yarn Plug'n'Play there's no node_modules, so read the version from the lockfile instead. If the
+    package is locked at more than one version, use the one for the range the app depends on
+    """
+    try:
+        with open(os.path.join(settings.src_dir, 'yarn.lock')) as f:
+            lines = f.read().splitlines()
+    except OSError:
+        return None
+
+    # the version for each range of the package
+    versions = dict()
+    ranges = []
+    for line in lines:
+        if line and not line[0].isspace() and line.endswith(':'):
+            # e.g "cypress@npm:^12.0.0, cypress@npm:^12.17.1":
+            descriptors = [x.strip().strip('"') for x in line[:-1].split(',')]
+            ranges = [x.rpartition('@')[2].removeprefix('npm:') for x in descriptors
+                      if x.rpartition('@')[0] == name]
+        elif ranges and line.strip().startswith('version'):
+            version = line.split(None, 1)[1].strip('"')
+            versions.update({r: version for r in ranges})
+            ranges = []
+    if not versions:
+        return None
+
+    try:
+        with open(os.path.join(settings.app_dir, 'package.json')) as f:
+            manifest = parse_json(f.read())
+    except OSError:
+        manifest = dict()
+    for key in DEPENDENCY_KEYS:
+        wanted = (manifest.get(key) or dict()).get(name)
+        if wanted in versions:
+            return versions[wanted]
+    return next(iter(versions.values()))
+
+
+def get_dir_size(path: str) -> int:
+    total = 0
+    for root, dirs, files in os.walk(path):
+        for fname in files:
+            try:
+                total += os.lstat(os.path.join(root, fname)).st_size
+            except OSError:
+                pass
+    return total
+
+
+class VersionedCache(object):
+    """
+    A shared cache with a subdirectory per version (which is how Cypress lays out its binary cache anyway).
+    Each version is stamped once it has been verified, so this only happens once per version per volume
+    """
+    def __init__(self, name: str, root: str):
+        self.name = name
+        self.root = root
+
+    def path(self, version: str) -> str:
+        return os.path.join(self.root, version)
+
+    def stamp(self, version: str) -> str:
+        return os.path.join(self.path(version), VERIFIED_STAMP)
+
+    def is_verified(self, version: str) -> bool:
+        return os.path.exists(self.stamp(version))
+
+    def mark_verified(self, version: str):
+        os.makedirs(self.path(version), exist_ok=True)
+        with open(self.stamp(version), 'w') as f:
+            f.write(utcnow().isoformat())
+
+    def last_used(self, version: str) -> float:
+        if self.is_verified(version):
+            return os.path.getmtime(self.stamp(version))
+        return os.path.getmtime(self.path(version))
+
+    def versions(self) -> list[str]:
+        if not os.path.exists(self.root):
+            return []
+        return [x.name for x in os.scandir(self.root) if x.is_dir() and not x.name.startswith('.')]
+
+    @contextmanager
+    def lock(self, version: str, blocking=True):
+        """
+        Lock a version against other builders sharing the volume. Yields False if non-blocking and
+        someone else holds it
+        """
+        os.makedirs(self.root, exist_ok=True)
+        with open(os.path.join(self.root, f'.{version}.lock'), 'w') as f:
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                yield False
+                return
+            try:
+                yield True
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def ensure(self, version: str, verify: Callable[[], None]) -> bool:
+        """
+        Verify (or install) this version unless it has been already. Returns True if it was already verified
+        """
+        with self.lock(version):
+            if self.is_verified(version):
+                # mark it as recently used
+                os.utime(self.stamp(version))
+                return True
+            verify()
+            self.mark_verified(version)
+        self.prune(settings.FRAMEWORK_CACHE_MAX_SIZE, keep=version)
+        return False
+
+    def prune(self, max_size: int, keep: str = None):
+        """
+        Evict the least recently used versions until the cache fits in max_size bytes. Versions in use by
+        another builder are left alone
+        """
+        sizes = {v: get_dir_size(self.path(v)) for v in self.versions()}
+        total = sum(sizes.values())
+        for version in sorted(sizes.keys(), key=self.last_used):
+            if total <= max_size:
+                break
+            if version == keep:
+                continue
+            with self.lock(version, blocking=False) as locked:
+                if not locked:
+                    continue
+                logger.info(f'Evicting {self.name} {version} from the cache')
+                remove_tree(self.path(version))
+            total -= sizes[version]
+
+
+def get_cypress_cache() -> VersionedCache:
+    return VersionedCache('Cypress', settings.cypress_cache)
+
+
+def get_playwright_cache() -> VersionedCache:
+    return VersionedCache('Playwright', settings.playwright_browsers)
+
+
+def get_playwright_version() -> str | None:
+    return get_package_version('@playwright/test') or get_package_version('playwright')
+
+
+def get_playwright_browsers_path() -> str:
+    """
+    Browsers are kept per Playwright version. If we can't tell which one we have, keep them in node_modules
+    """
+    version = get_playwright_version()
+    if not version:
+        return '0'
+    return get_playwright_cache().path(version)
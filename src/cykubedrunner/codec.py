@@ -0,0 +1,42 @@
+"""
+JSON for reports and API payloads, using orjson if it's installed. The output is the same either way: compact
+and UTF-8 (which is all orjson can do). The exception is floats in exponent notation, which we don't send
+"""
+
+import json
+from typing import Any
+
+from pydantic import BaseModel
+from pydantic.json import pydantic_encoder
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def loads(data: str | bytes) -> Any:
+    if orjson:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def dumpb(obj: Any, default=pydantic_encoder) -> bytes:
+    if orjson:
+        return orjson.dumps(obj, default=default, option=orjson.OPT_NON_STR_KEYS)
+    return json.dumps(obj, default=default, separators=(',', ':'), ensure_ascii=False).encode()
+
+
+def dumps(obj: Any, default=pydantic_encoder) -> str:
+    if orjson:
+        return dumpb(obj, default).decode()
+    return json.dumps(obj, default=default, separators=(',', ':'), ensure_ascii=False)
+
+
+def encode_model(model: BaseModel, **extra) -> bytes:
+    """
+    Encode a schema (i.e what model.json() does, but faster), with any extra fields
+    """
+    data = model.dict()
+    data.update(extra)
+    return dumpb(data, default=model.__json_encoder__)
@@ -1,128 +1,239 @@
 import datetime
 import json
 import os
+from typing import Iterable
 
 from cykubedrunner.baserunner import BaseSpecRunner
+from cykubedrunner import codec, lean
+from cykubedrunner.app import app
+from cykubedrunner.bundler import bundle_manifest, get_support_file
+from cykubedrunner.common import schemas
 from cykubedrunner.common.enums import TestResultStatus
 from cykubedrunner.common.exceptions import RunFailedException
-from cykubedrunner.common.schemas import SpecTests, TestResult, SpecTest, CodeFrame, TestResultError, \
-    NewTestRun
+from cykubedrunner.common.schemas import SpecTests, SpecTest, NewTestRun
 from cykubedrunner.server import ServerThread
 from cykubedrunner.settings import settings
 from cykubedrunner.utils import logger
+from cykubedrunner.video import make_failure_clip
+
+
+def list_files(folder: str) -> list[str]:
+    fnames = []
+    for root, dirs, files in os.walk(folder):
+        fnames += [os.path.join(root, f) for f in files]
+    return fnames
+
+
+RERUN_SUPPORT_TEMPLATE = """
+const rerunTests = TESTS;
+beforeEach(function () {
+  const test = this.currentTest;
+  if (!rerunTests.some(([context, title]) => test.title === title && test.parent.title === context)) {
+    this.skip();
+  }
+});
+"""
 
 
 class CypressSpecRunner(BaseSpecRunner):
 
     def __init__(self, server: ServerThread,
-                 testrun: NewTestRun, file: str, browser):
-        super().__init__(server, testrun, file)
+                 testrun: NewTestRun, file: str | list[str], browser, only: list[SpecTest] = None):
+        super().__init__(server, testrun, file, only)
         self.browser = browser
-        srccypress = os.path.join(settings.BUILD_DIR, 'cypress_cache')
-        if not os.path.exists(srccypress):
+        # maps any prebundled spec back to the original
+        self.bundled_specs = dict()
+        if not os.path.exists(settings.cypress_cache):
             raise RunFailedException("Missing cypress cache folder")
 
-    def parse_results(self) -> SpecTests:
-        failures = 0
-        specresult = SpecTests(tests=[])
+    def match_spec(self, path: str) -> str | None:
+        for bundle, spec in self.bundled_specs.items():
+            if path == bundle or bundle.endswith(f'/{path}'):
+                return spec
+        return super().match_spec(path)
+
+    def get_specs_arg(self) -> tuple[str, str]:
+        """
+        Return the specs to run and any extra config. We use the bundles created by the builder if they're
+        available for every spec, as this saves Cypress from preprocessing them all again
+        """
+        if self.only:
+            return self.file, f',supportFile={self.create_rerun_support_file()}'
+        if settings.PREBUNDLE_SPECS:
+            bundles = [bundle_manifest.get_bundle(spec) for spec in self.files]
+            if all(bundles):
+                self.bundled_specs = dict(zip(bundles, self.files))
+                config = f',specPattern={settings.bundles_dir}/**/*'
+                support = bundle_manifest.get_support_bundle()
+                if support:
+                    config += f',supportFile={support}'
+                return ','.join(bundles), config
+        return self.file, ''
+
+    def create_rerun_support_file(self) -> str:
+        """
+        Cypress has no way to select tests, so we wrap the support file with a hook that skips all but the
+        tests we want to rerun. This goes in our scratch directory, as the source may be on a shared volume
+        """
+        tests = json.dumps([[test.context, test.title] for test in self.only])
+        support = get_support_file()
+        path = os.path.join(self.results_dir, 'rerun-support.js')
+        with open(path, 'w') as f:
+            if support:
+                f.write(f'import {json.dumps(os.path.join(settings.app_dir, support))};\n')
+            f.write(RERUN_SUPPORT_TEMPLATE.replace('TESTS', tests))
+        return path
 
+    def parse_results(self) -> SpecTests:
+        sshot_fnames = list_files(self.screenshots_folder)
+        video_fnames = list_files(self.videos_folder)
         with open(self.results_file) as f:
-            rawjson = json.loads(f.read())
-
-            sshot_fnames = []
-            for root, dirs, files in os.walk(self.screenshots_folder):
-                sshot_fnames += [os.path.join(root, f) for f in files]
-
-            for test in rawjson['tests']:
-                err = test.get('err')
-
-                if 'duration' not in test:
+            if self.use_lean_results:
+                # we only need the tests: the rest of the report is the same tests again, grouped by status
+                return self.parse_report(self.file, lean.iter_json_array(f, 'tests'), sshot_fnames, video_fnames,
+                                         records=lean)
+            rawjson = codec.loads(f.read())
+        return self.parse_report(self.file, rawjson['tests'], sshot_fnames, video_fnames)
+
+    def parse_batch_results(self) -> dict[str, SpecTests]:
+        """
+        In batch mode the reporter appends a line of JSON per spec
+        """
+        results = dict()
+        sshot_fnames = list_files(self.screenshots_folder)
+        video_fnames = list_files(self.videos_folder)
+        with open(self.results_file) as f:
+            for line in f:
+                if not line.strip():
                     continue
-                title, context = test['title'], test['context']
-
-                result = TestResult(status=TestResultStatus.failed if err else TestResultStatus.passed,
-                                    browser=self.browser,
-                                    retry=test['currentRetry'],
-                                    duration=test['duration'],
-                                    finished_at=datetime.datetime.now().isoformat())
-
-                spectest = SpecTest(results=[result],
-                                    title=title,
-                                    context=context,
-                                    status=result.status)
-
-                if result.status == TestResultStatus.passed and result.retry:
-                    # flakey
-                    spectest.status = TestResultStatus.flakey
-
-                # check for screenshots
-                prefix = f'{context} -- {title} (failed)'
-                sshots = []
-                for fname in sshot_fnames:
-                    if os.path.split(fname)[-1].startswith(prefix):
-                        sshots.append(fname)
-                if sshots:
-                    result.failure_screenshots = sshots
-
-                if err:
-                    failures += 1
-                    frame = err.get('codeFrame')
-                    if not frame:
-                        fullerror = json.dumps(err)
-                        logger.warning(f"No code frame: full error: {fullerror}")
-                    else:
-                        codeframe = CodeFrame(line=frame['line'],
-                                              file=frame['relativeFile'],
-                                              column=frame['column'],
-                                              language=frame['language'],
-                                              frame=frame['frame'])
-                    # get line number of test
-                    testline = 0
-                    for parsed in err['parsedStack']:
-                        if 'relativeFile' in parsed and parsed['relativeFile'].endswith(self.file):
-                            testline = parsed['line']
-                            break
-
-                    try:
-                        result.errors = [TestResultError(title=err['name'],
-                                                         type=err.get('type'),
-                                                         test_line=testline,
-                                                         message=err['message'],
-                                                         stack=err['stack'],
-                                                         code_frame=codeframe)]
-                    except:
-                        raise RunFailedException("Failed to parse test result")
-
-                specresult.tests.append(spectest)
+                rawjson = codec.loads(line)
+                spec = self.match_spec(rawjson.get('spec') or '')
+                if not spec:
+                    logger.warning(f'Results for unexpected spec {rawjson.get("spec")}: ignoring')
+                    continue
+                # screenshots and videos are named after the spec
+                name = os.path.basename(spec)
+                results[spec] = self.parse_report(spec, rawjson['tests'],
+                                                  [x for x in sshot_fnames if name in x.split(os.sep)],
+                                                  [x for x in video_fnames if os.path.basename(x).startswith(name)])
+        return results
+
+    def parse_report(self, spec: str, tests: Iterable[dict], sshot_fnames: list[str], video_fnames: list[str],
+                     records=schemas) -> SpecTests:
+        """
+        Parse the tests from the report, into either the schemas or the compact records in the lean module
+        """
+        failures = 0
+        specresult = records.SpecTests(tests=[])
+        # when the failing tests ran, in seconds from the start of the video
+        failure_windows = []
+
+        for test in tests:
+            err = test.get('err')
+
+            if 'duration' not in test:
+                continue
+            title, context = test['title'], test['context']
+
+            result = records.TestResult(status=TestResultStatus.failed if err else TestResultStatus.passed,
+                                        browser=self.browser,
+                                        retry=test['currentRetry'],
+                                        duration=test['duration'],
+                                        finished_at=datetime.datetime.now().isoformat())
+
+            spectest = records.SpecTest(results=[result],
+                                        title=title,
+                                        context=context,
+                                        status=result.status)
+
+            if result.status == TestResultStatus.passed and result.retry:
+                # flakey
+                spectest.status = TestResultStatus.flakey
+
+            # check for screenshots
+            prefix = f'{context} -- {title} (failed)'
+            sshots = []
+            for fname in sshot_fnames:
+                if os.path.split(fname)[-1].startswith(prefix):
+                    sshots.append(fname)
+            if sshots:
+                result.failure_screenshots = sshots
+
+            if err:
+                failures += 1
+                if test.get('offset') is not None:
+                    failure_windows.append((test['offset'] / 1000, (test['offset'] + test['duration']) / 1000))
+                frame = err.get('codeFrame')
+                if not frame:
+                    fullerror = codec.dumps(err)
+                    logger.warning(f"No code frame: full error: {fullerror}")
+                else:
+                    codeframe = records.CodeFrame(line=frame['line'],
+                                                  file=frame['relativeFile'],
+                                                  column=frame['column'],
+                                                  language=frame['language'],
+                                                  frame=frame['frame'])
+                # get line number of test
+                testline = 0
+                for parsed in err['parsedStack']:
+                    if 'relativeFile' in parsed and parsed['relativeFile'].endswith(spec):
+                        testline = parsed['line']
+                        break
+
+                try:
+                    result.errors = [records.TestResultError(title=err['name'],
+                                                             type=err.get('type'),
+                                                             test_line=testline,
+                                                             message=err['message'],
+                                                             stack=err['stack'],
+                                                             code_frame=codeframe)]
+                except:
+                    raise RunFailedException("Failed to parse test result")
+
+            specresult.tests.append(spectest)
 
         # we should have a single  - but only add it if we have failures
-        if failures:
-            video_fnames = []
-            for root, dirs, files in os.walk(self.videos_folder):
-                video_fnames += [os.path.join(root, f) for f in files]
-
-            if video_fnames:
-                specresult.video = video_fnames[0]
+        if failures and video_fnames:
+            specresult.video = video_fnames[0]
+            if settings.FAILURE_VIDEO:
+                specresult.video = make_failure_clip(video_fnames[0], failure_windows)
+        elif settings.FAILURE_VIDEO:
+            for fname in video_fnames:
+                os.remove(fname)
         return specresult
 
     def get_args(self):
         json_reporter = os.path.abspath(os.path.join(os.path.dirname(__file__), 'json-reporter.js'))
+        reporter_options = f'output={self.results_file}'
+        if settings.SPEC_OUTPUT_TIMEOUT:
+            reporter_options += ',progress=true'
+        if self.is_batch:
+            reporter_options += ',batch=true'
+
+        specs, config = self.get_specs_arg()
+        if settings.FAILURE_VIDEO:
+            # we do our own (much more aggressive) compression of the part we want
+            config += ',video=true,videoCompression=false'
+        else:
+            config += ',video=false'
 
         return ['cypress', 'run',
                 '-q',
                 '--browser', self.browser or 'electron',
-                '-s', self.file,
+                '-s', specs,
                 '--reporter', json_reporter,
-                '-o', f'output={self.results_file}',
+                '-o', reporter_options,
                 '-c', f'screenshotsFolder={self.screenshots_folder},screenshotOnRunFailure=true,'
-                      f'baseUrl={self.base_url},video=false,videosFolder={self.videos_folder}']
+                      f'baseUrl={self.base_url},videosFolder={self.videos_folder}{config}']
 
     def get_env(self):
         env = os.environ.copy()
-        env.update(CYPRESS_CACHE_FOLDER=f'{settings.BUILD_DIR}/cypress_cache',
+        env.update(CYPRESS_CACHE_FOLDER=settings.cypress_cache,
                    PATH=f'node_modules/.bin:{env["PATH"]}')
 
-        if self.testrun.project.runner_retries:
-            env['CYPRESS_RETRIES'] = str(self.testrun.project.runner_retries)
+        if self.in_process_retries:
+            env['CYPRESS_RETRIES'] = str(self.in_process_retries)
+        if app.proxy_url:
+            env.update(CYKUBED_PROXY_URL=app.proxy_url, CYPRESS_PROXY_URL=app.proxy_url)
         return env
 
@@ -0,0 +1,100 @@
+import fcntl
+import json
+import math
+import os
+import tempfile
+import threading
+
+from cykubedrunner.settings import settings
+from cykubedrunner.utils import logger
+
+
+class SpecDurations(object):
+    """
+    Recent wall-clock durations (in seconds) of each spec. These are kept in the build directory, so they
+    survive between test runs along with the rest of the cache
+    """
+    def __init__(self):
+        self.durations: dict[str, list[float]] = dict()
+        # the durations we've recorded but not yet saved
+        self.unsaved: dict[str, list[float]] = dict()
+        # specs may be run in parallel
+        self.lock = threading.Lock()
+
+    def reset(self):
+        with self.lock:
+            self.durations = dict()
+            self.unsaved = dict()
+
+    def read(self) -> dict[str, list[float]]:
+        if not os.path.exists(settings.spec_durations_file):
+            return dict()
+        try:
+            with open(settings.spec_durations_file) as f:
+                return json.loads(f.read())
+        except (OSError, ValueError):
+            logger.warning('Failed to read spec durations: ignoring them')
+            return dict()
+
+    def load(self):
+        with self.lock:
+            self.durations = self.read()
+            self.unsaved = dict()
+
+    def save(self):
+        """
+        Add our durations to those saved by the other runners since we loaded them
+        """
+        path = settings.spec_durations_file
+        try:
+            with self.lock, open(f'{path}.lock', 'w') as lockfile:
+                fcntl.flock(lockfile, fcntl.LOCK_EX)
+                durations = self.read()
+                for spec, samples in self.unsaved.items():
+                    history = durations.setdefault(spec, [])
+                    history.extend(samples)
+                    del history[:-settings.SPEC_DURATION_HISTORY]
+                fd, tmpfile = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.spec-durations-')
+                try:
+                    with os.fdopen(fd, 'w') as f:
+                        f.write(json.dumps(durations))
+                    os.replace(tmpfile, path)
+                except OSError:
+                    os.remove(tmpfile)
+                    raise
+                self.durations = durations
+                self.unsaved = dict()
+        except OSError as ex:
+            # not fatal - the build volume may be read-only for this runner
+            logger.debug(f'Failed to save spec durations: {ex}')
+
+    def record(self, spec: str, duration: float):
+        with self.lock:
+            for durations in [self.durations, self.unsaved]:
+                history = durations.setdefault(spec, [])
+                history.append(round(duration, 1))
+                del history[:-settings.SPEC_DURATION_HISTORY]
+
+    def percentile(self, spec: str, pct: float) -> float | None:
+        """
+        Nearest-rank percentile of the recorded durations of this spec
+        """
+        history = sorted(self.durations.get(spec, []))
+        if not history:
+            return None
+        rank = max(math.ceil(pct / 100 * len(history)), 1)
+        return history[rank - 1]
+
+    def get_deadline(self, spec: str, default: int | None) -> int | None:
+        """
+        Return the deadline for this spec, or the default if adaptive deadlines are disabled or
+        we don't have enough history for it
+        """
+        if not settings.ADAPTIVE_SPEC_DEADLINE or \
+                len(self.durations.get(spec, [])) < settings.SPEC_DEADLINE_MIN_SAMPLES:
+            return default
+        deadline = self.percentile(spec, 99) * settings.SPEC_DEADLINE_FACTOR
+        return int(min(max(deadline, settings.SPEC_DEADLINE_MIN), settings.SPEC_DEADLINE_MAX))
+
+
+spec_durations = SpecDurations()
@@ -0,0 +1,115 @@
+import ctypes
+import ctypes.util
+import errno
+import os
+import shutil
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from cykubedrunner.settings import settings
+from cykubedrunner.utils import logger
+
+
+def fsync_dir(path: str):
+    """
+    Make a rename or delete inside this directory durable
+    """
+    fd = os.open(path, os.O_RDONLY | os.O_DIRECTORY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def move(src: str, dest: str):
+    """
+    Move a file or directory to the (full) destination path. This is just a rename if they're on the
+    same device, otherwise we need to copy
+    """
+    try:
+        os.rename(src, dest)
+    except OSError as ex:
+        if ex.errno != errno.EXDEV:
+            raise
+        logger.debug(f'{src} and {dest} are on different devices: copying')
+        shutil.move(src, dest)
+    fsync_dir(os.path.dirname(os.path.abspath(dest)))
+    fsync_dir(os.path.dirname(os.path.abspath(src)))
+
+
+TRASH_PREFIX = '.trash-'
+
+
+def _remove(path: str):
+    if os.path.isdir(path) and not os.path.islink(path):
+        shutil.rmtree(path, ignore_errors=True)
+    else:
+        os.unlink(path)
+
+
+def _remove_tree(path: str):
+    # delete the top-level entries in parallel: unlink is a syscall, so we're not held up by the GIL
+    with ThreadPoolExecutor(max_workers=settings.FS_DELETE_WORKERS) as executor:
+        futures = {executor.submit(_remove, entry.path): entry.path for entry in os.scandir(path)}
+    for future, entry in futures.items():
+        if future.exception():
+            logger.warning(f'Failed to delete {entry}: {future.exception()}')
+    shutil.rmtree(path, ignore_errors=True)
+
+
+def remove_tree(path: str, background=False) -> threading.Thread | None:
+    """
+    Delete a (potentially large) directory tree. The tree is first renamed out of the way, so the
+    path is free for reuse immediately. If background is set then the deletion continues in a thread,
+    which is returned (it isn't a daemon, so we'll finish before the process exits).
+    """
+    if not os.path.exists(path):
+        return None
+    path = os.path.abspath(path)
+    trash = os.path.join(os.path.dirname(path), f'{TRASH_PREFIX}{uuid.uuid4().hex}')
+    os.rename(path, trash)
+    if background:
+        thread = threading.Thread(target=_remove_tree, args=(trash,))
+        thread.start()
+        return thread
+    _remove_tree(trash)
+    return None
+
+
+def _reap_trash(paths: list[str]):
+    for path in paths:
+        logger.debug(f'Deleting {path}, left behind by an earlier process')
+        _remove_tree(path)
+
+
+def reap_trash(dirs: list[str]) -> threading.Thread | None:
+    """
+    Delete, in the background, any trees in these directories that remove_tree didn't finish deleting
+    before the process exited. Call this before we start deleting anything ourselves
+    """
+    paths = [entry.path for path in dirs if os.path.isdir(path) for entry in os.scandir(path)
+             if entry.name.startswith(TRASH_PREFIX) and entry.is_dir(follow_symlinks=False)]
+    if not paths:
+        return None
+    thread = threading.Thread(target=_reap_trash, args=(paths,))
+    thread.start()
+    return thread
+
+
+def sync_filesystem(path: str):
+    """
+    Flush the filesystem containing this path to disk. Unlike os.sync this leaves other volumes on the
+    node alone
+    """
+    libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    if not hasattr(libc, 'syncfs'):
+        os.sync()
+        return
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        if libc.syncfs(fd) != 0:
+            logger.debug(f'syncfs failed: {os.strerror(ctypes.get_errno())}')
+            os.sync()
+    finally:
+        os.close(fd)
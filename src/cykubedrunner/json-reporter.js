@@ -14,6 +14,8 @@ var EVENT_TEST_FAIL = constants.EVENT_TEST_FAIL;
 var EVENT_TEST_END = constants.EVENT_TEST_END;
 var EVENT_RUN_END = constants.EVENT_RUN_END;
 var EVENT_TEST_PENDING = constants.EVENT_TEST_PENDING;
+var EVENT_TEST_BEGIN = constants.EVENT_TEST_BEGIN;
+var EVENT_RUN_BEGIN = constants.EVENT_RUN_BEGIN;
 
 /**
  * Expose `JSON`.
@@ -39,9 +41,36 @@ function JSONReporter(runner, options) {
   var pending = [];
   var failures = [];
   var passes = [];
+  // emit a line per test so the runner knows we're still making progress
+  var progress = options.reporterOptions && options.reporterOptions.progress;
+  // when each test started, relative to the start of the run (and so roughly the start of the video)
+  var runStart = Date.now();
+  var offsets = {};
+
+  // each attempt at a test has its own offset
+  function offsetKey(test) {
+    return test.fullTitle() + '#' + test.currentRetry();
+  }
+
+  runner.on(EVENT_RUN_BEGIN, function() {
+    runStart = Date.now();
+  });
+
+  runner.on(EVENT_TEST_BEGIN, function(test) {
+    offsets[offsetKey(test)] = Date.now() - runStart;
+  });
+
+  function cleanWithOffset(test) {
+    var result = clean(test);
+    result.offset = offsets[offsetKey(test)];
+    return result;
+  }
 
   runner.on(EVENT_TEST_END, function(test) {
     tests.push(test);
+    if (progress) {
+      console.log('Completed test: ' + test.fullTitle());
+    }
   });
 
   runner.on(EVENT_TEST_PASS, function(test) {
@@ -59,15 +88,22 @@ function JSONReporter(runner, options) {
   runner.once(EVENT_RUN_END, function() {
     var obj = {
       stats: self.stats,
-      tests: tests.map(clean),
+      tests: tests.map(cleanWithOffset),
       pending: pending.map(clean),
-      failures: failures.map(clean),
-      passes: passes.map(clean)
+      failures: failures.map(cleanWithOffset),
+      passes: passes.map(cleanWithOffset)
     };
 
     runner.testResults = obj;
 
-    fs.writeFileSync(options.reporterOptions && options.reporterOptions.output ? options.reporterOptions.output :  'test-report.json', JSON.stringify(obj, null, 2));
+    var output = options.reporterOptions && options.reporterOptions.output ? options.reporterOptions.output :  'test-report.json';
+    if (options.reporterOptions && options.reporterOptions.batch) {
+      // several specs are being run in the same process: append a line per spec
+      obj.spec = runner.suite.file || (tests.length ? tests[0].file : null);
+      fs.appendFileSync(output, JSON.stringify(obj) + '\n');
+    } else {
+      fs.writeFileSync(output, JSON.stringify(obj, null, 2));
+    }
   });
 }
 
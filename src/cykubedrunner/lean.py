@@ -0,0 +1,282 @@
+"""
+Compact records for the results of very large specs. Building the pydantic schemas for tens of thousands of
+tests (on top of the raw report) takes more memory than a runner pod has, so instead we stream the report
+into these: they have the same names and fields as the schemas in cykubedrunner.common.schemas (so the
+parsers can build either, and the rest of the runner doesn't care which it has), and serialise directly to
+the same JSON as codec.encode_model
+"""
+
+import datetime
+import json
+from json import JSONDecodeError
+from typing import Iterable, Iterator, TextIO
+
+from cykubedrunner import codec
+
+CHUNK_SIZE = 64 * 1024
+WHITESPACE = ' \t\n\r'
+STATUS_RANKS = {'passed': 0, 'flakey': 1, 'failed': 2}
+
+decoder = json.JSONDecoder()
+dumps = codec.dumps
+
+
+def dumps_enum(value) -> str:
+    return dumps(getattr(value, 'value', value))
+
+
+def status_rank(status) -> int:
+    return STATUS_RANKS.get(getattr(status, 'value', status), 0)
+
+
+class CodeFrame(object):
+    __slots__ = ('file', 'line', 'column', 'frame', 'language')
+
+    def __init__(self, file=None, line=None, column=None, frame=None, language=None):
+        self.file = file
+        self.line = line
+        self.column = column
+        self.frame = frame
+        self.language = language
+
+
+class TestResultError(object):
+    __slots__ = ('message', 'title', 'type', 'test_line', 'stack', 'code_frame', 'video')
+
+    def __init__(self, message=None, title=None, type=None, test_line=None, stack=None, code_frame=None,
+                 video=None):
+        self.message = message
+        self.title = title
+        self.type = type
+        self.test_line = test_line
+        self.stack = stack
+        self.code_frame = code_frame
+        self.video = video
+
+
+class TestResult(object):
+    __slots__ = ('browser', 'status', 'retry', 'duration', 'failure_screenshots', 'errors')
+
+    def __init__(self, browser=None, status=None, retry=None, duration=None, failure_screenshots=None,
+                 errors=None, finished_at=None):
+        # finished_at isn't part of the wire format
+        self.browser = browser
+        self.status = status
+        self.retry = retry
+        self.duration = duration
+        self.failure_screenshots = failure_screenshots
+        self.errors = errors
+
+
+class SpecTest(object):
+    __slots__ = ('title', 'line', 'context', 'status', 'results')
+
+    def __init__(self, title=None, line=None, context=None, status=None, results=None):
+        self.title = title
+        self.line = line
+        self.context = context
+        self.status = status
+        self.results = results if results is not None else []
+
+
+class SpecTests(object):
+    __slots__ = ('tests', 'video', 'timeout')
+
+    def __init__(self, tests=None, video=None, timeout=False):
+        self.tests = tests if tests is not None else []
+        self.video = video
+        self.timeout = timeout
+
+    def merge(self, other):
+        """
+        Add the results from another browser
+        """
+        tests = {(test.context, test.title, test.line): test for test in self.tests}
+        for other_test in other.tests:
+            test = tests.get((other_test.context, other_test.title, other_test.line))
+            if not test:
+                self.tests.append(other_test)
+                continue
+            test.results += other_test.results
+            # the worst status wins
+            if status_rank(other_test.status) > status_rank(test.status):
+                test.status = other_test.status
+        self.video = self.video or other.video
+
+    def copy(self, update: dict = None) -> 'SpecTests':
+        result = SpecTests(self.tests, self.video, self.timeout)
+        for name, value in (update or {}).items():
+            setattr(result, name, value)
+        return result
+
+    def iter_json(self) -> Iterator[str]:
+        yield '{"tests":['
+        for i, test in enumerate(self.tests):
+            if i:
+                yield ','
+            yield from iter_test_json(test)
+        yield f'],"video":{dumps(self.video)},"timeout":{dumps(self.timeout)}}}'
+
+    def json(self) -> str:
+        return ''.join(self.iter_json())
+
+    def spec_completed_json(self, file: str, finished: datetime.datetime, video: str | None, **extra) -> str:
+        return encode_spec_completed(file, finished, self.iter_json(), video, **extra)
+
+
+def encode_spec_completed(file: str, finished: datetime.datetime, result: Iterable[str], video: str | None,
+                          **extra) -> str:
+    """
+    The payload for spec-completed (i.e an AgentSpecCompleted), given the JSON of the result, with any extra
+    fields
+    """
+    parts = [f'{{"file":{dumps(file)},"finished":{dumps(finished.isoformat())},"result":',
+             *result,
+             f',"video":{dumps(video)}']
+    for name, value in extra.items():
+        parts.append(f',{dumps(name)}:{dumps(value)}')
+    parts.append('}')
+    return ''.join(parts)
+
+
+def is_lean(spectests) -> bool:
+    return isinstance(spectests, SpecTests)
+
+
+def merge(spectests, other):
+    """
+    Merge the results for another browser, either of which may be lean. Returns the merged results
+    """
+    if is_lean(other) and not is_lean(spectests):
+        spectests = SpecTests(spectests.tests, spectests.video, spectests.timeout)
+    spectests.merge(other)
+    return spectests
+
+
+#
+# Serialisation. These only use attributes, so they work for a mixture of records and schemas (e.g if
+# the results of rerunning some tests are merged in)
+#
+
+def iter_test_json(test) -> Iterator[str]:
+    yield (f'{{"title":{dumps(test.title)},"line":{dumps(test.line)},"context":{dumps(test.context)},'
+           f'"status":{dumps_enum(test.status)},"results":[')
+    for i, result in enumerate(test.results):
+        if i:
+            yield ','
+        yield (f'{{"browser":{dumps(result.browser)},"status":{dumps_enum(result.status)},'
+               f'"retry":{dumps(result.retry)},"duration":{dumps(result.duration)},'
+               f'"failure_screenshots":{dumps(result.failure_screenshots)},"errors":')
+        if result.errors is None:
+            yield 'null}'
+        else:
+            yield f'[{",".join(error_json(err) for err in result.errors)}]}}'
+    yield ']}'
+
+
+def error_json(err) -> str:
+    frame = err.code_frame
+    if frame is None:
+        frame_json = 'null'
+    else:
+        frame_json = (f'{{"file":{dumps(frame.file)},"line":{dumps(frame.line)},'
+                      f'"column":{dumps(frame.column)},"frame":{dumps(frame.frame)},'
+                      f'"language":{dumps(frame.language)}}}')
+    return (f'{{"message":{dumps(err.message)},"title":{dumps(err.title)},"type":{dumps(err.type)},'
+            f'"test_line":{dumps(err.test_line)},"stack":{dumps(err.stack)},"code_frame":{frame_json},'
+            f'"video":{dumps(err.video)}}}')
+
+
+#
+# Incremental parsing
+#
+
+class JsonScanner(object):
+    """
+    Read JSON values from a file a chunk at a time, so we never need the whole document in memory
+    """
+    def __init__(self, f: TextIO, chunk_size: int = CHUNK_SIZE):
+        self.f = f
+        self.chunk_size = chunk_size
+        self.buf = ''
+        self.pos = 0
+        self.eof = False
+
+    def fill(self, size: int):
+        data = self.f.read(size)
+        if not data:
+            self.eof = True
+        self.buf = self.buf[self.pos:] + data
+        self.pos = 0
+
+    def peek(self) -> str:
+        while True:
+            while self.pos < len(self.buf) and self.buf[self.pos] in WHITESPACE:
+                self.pos += 1
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if self.eof:
+                raise ValueError('Unexpected end of JSON')
+            self.fill(self.chunk_size)
+
+    def expect(self, chars: str) -> str:
+        c = self.peek()
+        if c not in chars:
+            raise ValueError(f'Expected one of {chars!r} at offset {self.pos} but found {c!r}')
+        self.pos += 1
+        return c
+
+    def value(self):
+        self.peek()
+        size = self.chunk_size
+        while True:
+            try:
+                value, end = decoder.raw_decode(self.buf, self.pos)
+                # a number could continue in the next chunk
+                if end < len(self.buf) or self.eof:
+                    self.pos = end
+                    return value
+            except JSONDecodeError:
+                if self.eof:
+                    raise
+            # read enough that a large value isn't parsed from the start too many times
+            self.fill(size)
+            size = max(size, len(self.buf))
+
+
+def iter_json_array(f: TextIO, *path: str) -> Iterator:
+    """
+    Yield the items of the array `path` in the object in the file, one at a time. The path can go through
+    arrays of objects: e.g ('suites', 'specs') yields the specs of every suite. Anything after the array in the
+    top-level object isn't read at all
+    """
+    yield from iter_object_array(JsonScanner(f), path, top=True)
+
+
+def iter_object_array(scanner: JsonScanner, path: tuple[str, ...], top=False) -> Iterator:
+    key, rest = path[0], path[1:]
+    scanner.expect('{')
+    if scanner.peek() == '}':
+        scanner.pos += 1
+        return
+    while True:
+        name = scanner.value()
+        scanner.expect(':')
+        if name != key:
+            scanner.value()
+        else:
+            scanner.expect('[')
+            if scanner.peek() == ']':
+                scanner.pos += 1
+            else:
+                while True:
+                    if rest:
+                        yield from iter_object_array(scanner, rest)
+                    else:
+                        yield scanner.value()
+                    if scanner.expect(',]') == ']':
+                        break
+            if top:
+                return
+        if scanner.expect(',}') == '}':
+            return
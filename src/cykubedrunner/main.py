@@ -1,20 +1,17 @@
 import argparse
-import os.path
-import shutil
+import os
+import subprocess
 import sys
 import time
 
-import sentry_sdk
-from sentry_sdk.integrations.httpx import HttpxIntegration
-
-from cykubedrunner import builder
 from cykubedrunner.app import app
-from cykubedrunner.common.cloudlogging import configure_stackdriver_logging
 from cykubedrunner.common.exceptions import BuildFailedException
-from cykubedrunner.runner import run
+from cykubedrunner.fsutils import remove_tree, reap_trash
 from cykubedrunner.settings import settings
 from cykubedrunner.utils import logger, log_build_failed_exception
 
+IMPORTTIME_REPORT_SIZE = 25
+
 
 def handle_sigterm_builder(signum, frame):
     """
@@ -23,22 +20,107 @@ def handle_sigterm_builder(signum, frame):
     sys.exit(1)
 
 
-def main() -> int:
-    parser = argparse.ArgumentParser('Cykubed Runner')
-    parser.add_argument('command', choices=['build', 'prepare_cache', 'run'], help='Command')
-    parser.add_argument('testrun_id', type=int, help='Test run ID')
-    args = parser.parse_args()
+def get_command(cmd: str):
+    """
+    Return the entry point for a command. Imports are deferred until we know which command we're running, as
+    each only needs a subset of them and we start a great many short-lived pods
+    """
+    if cmd == 'build':
+        from cykubedrunner.builder import build
+        return build
+    if cmd == 'prepare_cache':
+        from cykubedrunner.builder import prepare_cache
+        return prepare_cache
+    if cmd == 'pool':
+        from cykubedrunner.pool import serve
+        return serve
+    from cykubedrunner.runner import run
+    return run
 
+
+def init_sentry():
     if settings.SENTRY_DSN:
+        import sentry_sdk
+        from sentry_sdk.integrations.httpx import HttpxIntegration
+
         sentry_sdk.init(
             dsn=settings.SENTRY_DSN,
             integrations=[HttpxIntegration(), ], )
 
+
+def configure_logging(cmd: str):
+    from cykubedrunner.common.cloudlogging import configure_stackdriver_logging
+    configure_stackdriver_logging(f'cykubed-{cmd}')
+
+
+def profile_startup(cmd: str) -> int:
+    """
+    Report how long it takes to start the command, in the style of python -X importtime
+    """
+    code = f'from cykubedrunner import main; main.get_command({cmd!r}); main.init_sentry(); ' \
+           f'main.configure_logging({cmd!r})'
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path))
+    t = time.time()
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', code], env=env, capture_output=True,
+                            text=True)
+    t = time.time() - t
+
+    timings = []
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:'):
+            continue
+        fields = line[len('import time:'):].split('|')
+        if len(fields) != 3 or not fields[0].strip().isdigit():
+            continue
+        timings.append((int(fields[1]), int(fields[0]), fields[2].rstrip()))
+
+    total = sum(x[1] for x in timings)
+    print(f'Startup for {cmd}: {t:.2f}s, of which imports {total / 1e6:.2f}s ({len(timings)} modules)')
+    print(f'{"cumulative [us]":>16} | {"self [us]":>10} | imported package')
+    for cumulative, selftime, name in sorted(timings, reverse=True)[:IMPORTTIME_REPORT_SIZE]:
+        print(f'{cumulative:>16} | {selftime:>10} | {name}')
+    if result.returncode:
+        print(result.stderr.splitlines()[-1] if result.stderr else 'Startup failed')
+    return result.returncode
+
+
+def reap_stale_trash():
+    """
+    Trees being deleted when an earlier pod was killed are left behind next to where they were
+    """
+    reap_trash([settings.BUILD_DIR, settings.cypress_cache, settings.playwright_browsers, settings.SCRATCH_DIR,
+                os.path.dirname(settings.WORKSPACE_DIR)])
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser('Cykubed Runner')
+    parser.add_argument('command', choices=['build', 'prepare_cache', 'run', 'pool'], help='Command')
+    parser.add_argument('testrun_id', type=int, nargs='?', help='Test run ID (not used in pool mode)')
+    parser.add_argument('--profile-startup', action='store_true',
+                        help='Report the import time for the command and exit')
+    args = parser.parse_args()
+
     cmd = args.command
+    if args.profile_startup:
+        return profile_startup(cmd)
+
+    if cmd != 'pool' and args.testrun_id is None:
+        parser.error('the testrun_id argument is required')
+
+    init_sentry()
+    command = get_command(cmd)
+    reap_stale_trash()
+
+    if cmd == 'pool':
+        # long-lived runner serving many test runs
+        settings.init_build_dirs()
+        configure_logging(cmd)
+        return command()
+
     if cmd == 'build':
-        # in case this is a retry, make sure the build directory is clean
-        if os.path.exists(settings.src_dir):
-            shutil.rmtree(settings.src_dir)
+        # in case this is a retry, make sure the build directory is clean. The old tree is moved out of
+        # the way immediately, and deleted while we get on with the build
+        remove_tree(settings.src_dir, background=True)
 
     settings.init_build_dirs()
 
@@ -47,13 +129,8 @@ def main() -> int:
     exit_code = 0
 
     try:
-        configure_stackdriver_logging(f'cykubed-{cmd}')
-        if cmd == 'build':
-            builder.build()
-        elif cmd == 'prepare_cache':
-            builder.prepare_cache()
-        else:
-            run()
+        configure_logging(cmd)
+        command()
 
     except BuildFailedException as ex:
         logger.error(f'{cmd.capitalize()} failed: {ex}')
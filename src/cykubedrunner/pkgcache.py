@@ -0,0 +1,232 @@
+import base64
+import binascii
+import fcntl
+import json
+import os
+import re
+import time
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+
+from cykubedrunner.caches import get_dir_size
+from cykubedrunner.fsutils import remove_tree
+from cykubedrunner.settings import settings
+from cykubedrunner.utils import logger
+
+YARN1_RESOLVED_REGEX = re.compile(r'^\s+resolved\s+"[^"#]+#([0-9a-f]{40})"', re.MULTILINE)
+YARN1_ENTRY_REGEX = re.compile(r'-([0-9a-f]{40})(-integrity)?$')
+YARN_BERRY_CHECKSUM_REGEX = re.compile(r'^\s+checksum:\s+(?:\w+/)?([0-9a-f]{10})', re.MULTILINE)
+YARN_BERRY_ENTRY_REGEX = re.compile(r'-([0-9a-f]{10})\.zip$')
+
+
+class PackageCache(ABC):
+    """
+    The download cache for a package manager, shared by all builds on the volume. Each entry in the cache
+    (a tarball or a zip) has a key that we can also get from the lockfile, so we can tell which entries
+    are used by an install
+    """
+    name: str
+
+    def __init__(self):
+        self.root = os.path.join(settings.package_cache, self.name)
+
+    @abstractmethod
+    def entries(self) -> dict[str, str]:
+        """
+        Map the cache entries (relative to the root) to their keys
+        """
+        pass
+
+    @abstractmethod
+    def used_keys(self) -> set[str]:
+        """
+        Return the keys of the packages in the lockfile
+        """
+        pass
+
+
+def iter_integrity(deps: dict):
+    for dep in deps.values():
+        if isinstance(dep, dict):
+            yield from dep.get('integrity', '').split()
+            yield from iter_integrity(dep.get('dependencies', {}))
+
+
+class NpmCache(PackageCache):
+    """
+    npm's cache stores the tarballs by their integrity hash (in content-v2/<algorithm>/<hex digest>)
+    """
+    name = 'npm'
+
+    def entries(self) -> dict[str, str]:
+        result = dict()
+        for root, dirs, files in os.walk(os.path.join(self.root, 'content-v2')):
+            for fname in files:
+                rel = os.path.relpath(os.path.join(root, fname), self.root)
+                parts = rel.split(os.sep)
+                if len(parts) == 5:
+                    result[rel] = f'{parts[1]}-{"".join(parts[2:])}'
+        return result
+
+    def used_keys(self) -> set[str]:
+        with open(os.path.join(settings.src_dir, 'package-lock.json')) as f:
+            lock = json.load(f)
+        keys = set()
+        # lockfile v2 and v3 have a flat list of packages: v1 has nested dependencies
+        for integrity in [*iter_integrity(lock.get('packages', {})), *iter_integrity(lock.get('dependencies', {}))]:
+            algorithm, _, digest = integrity.partition('-')
+            try:
+                keys.add(f'{algorithm}-{base64.b64decode(digest).hex()}')
+            except binascii.Error:
+                pass
+        return keys
+
+
+class YarnCache(PackageCache):
+    """
+    Yarn 1 unpacks each package into a directory named with the hash in its resolved URL
+    """
+    name = 'yarn'
+
+    def entries(self) -> dict[str, str]:
+        result = dict()
+        if not os.path.exists(self.root):
+            return result
+        for version in os.scandir(self.root):
+            if version.is_dir():
+                for entry in os.scandir(version.path):
+                    m = YARN1_ENTRY_REGEX.search(entry.name)
+                    if m:
+                        result[os.path.join(version.name, entry.name)] = m.group(1)
+        return result
+
+    def used_keys(self) -> set[str]:
+        with open(os.path.join(settings.src_dir, 'yarn.lock')) as f:
+            return set(YARN1_RESOLVED_REGEX.findall(f.read()))
+
+
+class YarnBerryCache(PackageCache):
+    """
+    Yarn 2+ keeps a zip per package in <globalFolder>/cache, named with the start of its checksum
+    """
+    name = 'yarn-berry'
+
+    def entries(self) -> dict[str, str]:
+        result = dict()
+        cache_dir = os.path.join(self.root, 'cache')
+        if not os.path.exists(cache_dir):
+            return result
+        for entry in os.scandir(cache_dir):
+            m = YARN_BERRY_ENTRY_REGEX.search(entry.name)
+            if m:
+                result[os.path.join('cache', entry.name)] = m.group(1)
+        return result
+
+    def used_keys(self) -> set[str]:
+        with open(os.path.join(settings.src_dir, 'yarn.lock')) as f:
+            return set(YARN_BERRY_CHECKSUM_REGEX.findall(f.read()))
+
+
+def get_index_path() -> str:
+    return os.path.join(settings.package_cache, 'index.json')
+
+
+def load_index() -> dict[str, dict[str, dict]]:
+    try:
+        with open(get_index_path()) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return dict()
+
+
+def save_index(index: dict):
+    path = get_index_path()
+    tmpfile = f'{path}.{os.getpid()}'
+    with open(tmpfile, 'w') as f:
+        json.dump(index, f)
+    os.replace(tmpfile, path)
+
+
+@contextmanager
+def lock_cache(name: str, mode: int):
+    os.makedirs(settings.package_cache, exist_ok=True)
+    with open(os.path.join(settings.package_cache, f'.{name}.lock'), 'w') as f:
+        try:
+            fcntl.flock(f, mode)
+        except BlockingIOError:
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+@contextmanager
+def use_package_cache(cache: PackageCache):
+    """
+    Use the cache for an install, yielding the cache directory. Any number of builders can use the cache
+    at the same time, but it's only pruned when no-one else is using it
+    """
+    os.makedirs(cache.root, exist_ok=True)
+    used = cache.used_keys()
+    with lock_cache('usage', fcntl.LOCK_SH):
+        before = set(cache.entries().values())
+        yield cache.root
+        entries = cache.entries()
+
+    hits = len(used & before)
+    logger.info(f'Package cache: {hits} hits, {len(used) - hits} misses')
+    update_index(cache, entries, used)
+
+
+def update_index(cache: PackageCache, entries: dict[str, str], used: set[str]):
+    """
+    Record the size of any new entries and the time we last used each one, and then prune the cache
+    """
+    now = time.time()
+    with lock_cache('index', fcntl.LOCK_EX):
+        index = load_index()
+        old = index.get(cache.name, dict())
+        section = dict()
+        for rel, key in entries.items():
+            info = old.get(rel)
+            if not info:
+                path = os.path.join(cache.root, rel)
+                size = get_dir_size(path) if os.path.isdir(path) else os.path.getsize(path)
+                info = dict(size=size, last_used=now)
+            elif key in used:
+                info['last_used'] = now
+            section[rel] = info
+        index[cache.name] = section
+
+        with lock_cache('usage', fcntl.LOCK_EX | fcntl.LOCK_NB) as locked:
+            if locked:
+                prune(index, settings.PACKAGE_CACHE_MAX_SIZE)
+            else:
+                logger.debug('Package cache in use: not pruning')
+        save_index(index)
+
+
+def prune(index: dict[str, dict[str, dict]], max_size: int):
+    """
+    Delete the least recently used entries until the cache fits in max_size bytes
+    """
+    entries = sorted((info['last_used'], name, rel, info['size'])
+                     for name, section in index.items() for rel, info in section.items())
+    total = sum(x[3] for x in entries)
+    if total <= max_size:
+        return
+    removed = 0
+    for last_used, name, rel, size in entries:
+        if total <= max_size:
+            break
+        path = os.path.join(settings.package_cache, name, rel)
+        if os.path.isdir(path):
+            remove_tree(path)
+        elif os.path.exists(path):
+            os.unlink(path)
+        del index[name][rel]
+        total -= size
+        removed += 1
+    logger.debug(f'Pruned {removed} entries from the package cache')
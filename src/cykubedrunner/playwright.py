@@ -1,10 +1,17 @@
-import json
 import os
 import re
+from typing import Iterable
 
+from cykubedrunner import codec, lean
+from cykubedrunner.app import app
 from cykubedrunner.baserunner import BaseSpecRunner
+from cykubedrunner.caches import get_playwright_browsers_path
+from cykubedrunner.common import schemas
 from cykubedrunner.common.enums import TestResultStatus
-from cykubedrunner.common.schemas import TestResult, TestResultError, CodeFrame, SpecTests, SpecTest
+from cykubedrunner.common.schemas import SpecTests
+from cykubedrunner.resources import get_playwright_workers
+from cykubedrunner.settings import settings
+from cykubedrunner.utils import logger
 
 ansi_escape_regex = re.compile(r'\x1B(?:[@-Z\\-_]|\[[0-?]*[ -/]*[@-~])')
 
@@ -12,94 +19,129 @@ ansi_escape_regex = re.compile(r'\x1B(?:[@-Z\\-_]|\[[0-?]*[ -/]*[@-~])')
 class PlaywrightSpecRunner(BaseSpecRunner):
 
     def parse_results(self) -> SpecTests:
-        specresult = SpecTests(tests=[])
-
         with open(self.results_file) as f:
-            rawjson = json.loads(f.read())
+            if self.use_lean_results:
+                # there's a suite per file, so it's the specs we need to stream
+                return self.parse_specs(lean.iter_json_array(f, 'suites', 'specs'), records=lean)
+            rawjson = codec.loads(f.read())
+        return self.parse_suites(rawjson['suites'])
+
+    def parse_batch_results(self) -> dict[str, SpecTests]:
+        """
+        There is a top-level suite for each file, so we can split the results by spec
+        """
+        with open(self.results_file) as f:
+            rawjson = codec.loads(f.read())
 
-        # first group by line
-        byline = dict()
+        byspec = dict()
         for suite in rawjson['suites']:
-            for spec in suite['specs']:
-                if spec['ok'] and spec['tests'] and spec['tests'][0]['status'] == 'skipped':
+            spec = self.match_spec(suite['file'])
+            if not spec:
+                logger.warning(f'Results for unexpected spec {suite["file"]}: ignoring')
+                continue
+            byspec.setdefault(spec, []).append(suite)
+        return {spec: self.parse_suites(suites) for spec, suites in byspec.items()}
+
+    def parse_suites(self, suites: list[dict]) -> SpecTests:
+        return self.parse_specs(spec for suite in suites for spec in suite['specs'])
+
+    def parse_specs(self, specs: Iterable[dict], records=schemas) -> SpecTests:
+        """
+        Parse the specs from the report, into either the schemas or the compact records in the lean module.
+        Each spec is dealt with as it arrives, so we can stream them from the report
+        """
+        specresult = records.SpecTests(tests=[])
+
+        # group by line: there's a spec per project (i.e browser)
+        byline = dict()
+        for spec in specs:
+            if spec['ok'] and spec['tests'] and spec['tests'][0]['status'] == 'skipped':
+                continue
+            spectest = byline.get(spec['line'])
+            if not spectest:
+                # these will all have the same title
+                spectest = records.SpecTest(title=spec['title'],
+                                            line=spec['line'],
+                                            results=[],
+                                            status=TestResultStatus.passed)
+                byline[spec['line']] = spectest
+                specresult.tests.append(spectest)
+
+            if not spec['ok']:
+                spectest.status = TestResultStatus.failed
+
+            if spec['tests']:
+                test = spec['tests'][0]
+
+                if test['status'] == 'skipped':
                     continue
-                byline.setdefault(spec['line'], []).append(spec)
-
-        for specs in byline.values():
-            # these will all have the same title
-            spectest = SpecTest(title=specs[0]['title'],
-                                line=specs[0]['line'],
-                                results=[],
-                                status=TestResultStatus.passed)
-            specresult.tests.append(spectest)
-            for spec in specs:
-                if not spec['ok']:
-                    spectest.status = TestResultStatus.failed
-
-                if spec['tests']:
-                    test = spec['tests'][0]
-
-                    if test['status'] == 'skipped':
-                        continue
-                    if test['status'] == 'flaky' and spec['ok']:
-                        spectest.status = TestResultStatus.flakey
-
-                    for pwresult in test['results']:
-
-                        status = TestResultStatus.passed if pwresult['status'] == 'passed' else \
-                            TestResultStatus.failed
-
-                        testresult = TestResult(
-                            browser=test['projectName'],
-                            status=status)
-
-                        spectest.results.append(testresult)
-
-                        testresult.retry = pwresult['retry']
-                        testresult.duration = pwresult['duration']
-
-                        attachments = pwresult.get('attachments')
-                        if attachments:
-                            testresult.failure_screenshots = [x['path'] for x in attachments if
-                                                              x['name'] == 'screenshot']
-
-                        errors = pwresult.get('errors')
-                        if errors:
-                            testresult.errors = []
-                            # collate the messages from the blocks without code frames (usually just the first one)
-                            msg = "\n".join([ansi_escape_regex.sub('', err['message'])
-                                              for err in errors if 'location' not in err])
-                            trerr = TestResultError(message=msg)
-                            code_frame_errors = [err for err in errors if 'location' in err]
-                            if code_frame_errors:
-                                # just take the first one
-                                err = code_frame_errors[0]
-                                loc = err['location']
-                                trerr.test_line = loc['line']
-                                trerr.code_frame = CodeFrame(file=loc['file'],
-                                                             line=loc['line'],
-                                                             column=loc['column'],
-                                                             frame=ansi_escape_regex.sub('', err['message']))
-                                testresult.errors.append(trerr)
+                if test['status'] == 'flaky' and spec['ok']:
+                    spectest.status = TestResultStatus.flakey
+
+                for pwresult in test['results']:
+
+                    status = TestResultStatus.passed if pwresult['status'] == 'passed' else \
+                        TestResultStatus.failed
+
+                    testresult = records.TestResult(
+                        browser=test['projectName'],
+                        status=status)
+
+                    spectest.results.append(testresult)
+
+                    testresult.retry = pwresult['retry']
+                    testresult.duration = pwresult['duration']
+
+                    attachments = pwresult.get('attachments')
+                    if attachments:
+                        testresult.failure_screenshots = [x['path'] for x in attachments if
+                                                          x['name'] == 'screenshot']
+
+                    errors = pwresult.get('errors')
+                    if errors:
+                        testresult.errors = []
+                        # collate the messages from the blocks without code frames (usually just the first one)
+                        msg = "\n".join([ansi_escape_regex.sub('', err['message'])
+                                          for err in errors if 'location' not in err])
+                        trerr = records.TestResultError(message=msg)
+                        code_frame_errors = [err for err in errors if 'location' in err]
+                        if code_frame_errors:
+                            # just take the first one
+                            err = code_frame_errors[0]
+                            loc = err['location']
+                            trerr.test_line = loc['line']
+                            trerr.code_frame = records.CodeFrame(file=loc['file'],
+                                                                 line=loc['line'],
+                                                                 column=loc['column'],
+                                                                 frame=ansi_escape_regex.sub('', err['message']))
+                            testresult.errors.append(trerr)
 
 #        print(specresult.json(indent=4))
         return specresult
 
     def get_env(self):
         env = os.environ.copy()
-        return dict(PLAYWRIGHT_JSON_OUTPUT_NAME=self.results_file,
-                    PLAYWRIGHT_BROWSERS_PATH='0',
-                    PATH=f'node_modules/.bin:{env["PATH"]}')
+        result = dict(PLAYWRIGHT_JSON_OUTPUT_NAME=self.results_file,
+                      PLAYWRIGHT_BROWSERS_PATH=get_playwright_browsers_path(),
+                      PATH=f'node_modules/.bin:{env["PATH"]}')
+        if app.proxy_url:
+            result['CYKUBED_PROXY_URL'] = app.proxy_url
+        return result
 
     def get_args(self, **kwargs):
+        # the list reporter gives us a line per test, so we can tell if the spec has hung
+        reporter = 'json,list' if settings.SPEC_OUTPUT_TIMEOUT else 'json'
         args = ['npx', 'playwright', 'test',
-                '--reporter', 'json',
-                '-j', '1',
+                '--reporter', reporter,
+                '-j', str(get_playwright_workers(self.testrun.project.browsers or ['chromium'])),
                 '--quiet',
                 '--forbid-only',
                 '--output', self.screenshots_folder]
-        if self.testrun.project.runner_retries:
-            args += ['--retries', f'{self.testrun.project.runner_retries}']
-        args.append(self.file)
+        if self.in_process_retries:
+            args += ['--retries', f'{self.in_process_retries}']
+        if self.only:
+            args += [f'{self.file}:{test.line}' for test in self.only]
+        else:
+            args += self.files
         return args
 
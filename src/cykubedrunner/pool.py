@@ -0,0 +1,85 @@
+import signal
+import time
+
+from cykubedrunner.app import app
+from cykubedrunner.bundler import bundle_manifest
+from cykubedrunner.common.exceptions import BuildFailedException
+from cykubedrunner.common.utils import get_hostname
+from cykubedrunner.durations import spec_durations
+from cykubedrunner.resultcache import result_cache
+from cykubedrunner.runner import run
+from cykubedrunner.scratch import scratch
+from cykubedrunner.settings import settings
+from cykubedrunner.spool import spool
+from cykubedrunner.utils import logger, log_build_failed_exception, default_sigterm_runner
+from cykubedrunner.watchdog import spec_usage
+
+
+def get_next_testrun(hostname: str) -> int | None:
+    r = app.http_client.post('runner-pool/next-testrun', json={'pod_name': hostname})
+    if r.status_code == 204:
+        return None
+    if r.status_code != 200:
+        logger.warning(f'Failed to fetch next test run: {r.status_code}')
+        return None
+    return int(r.text)
+
+
+def run_testrun(trid: int):
+    """
+    Run a single test run, resetting any state left over from the last one
+    """
+    settings.SRC_DIR = None
+    app.reset()
+    for state in [spool, result_cache, spec_durations, bundle_manifest, scratch, spec_usage]:
+        state.reset()
+    app.init_http_client(trid)
+    try:
+        run()
+    except BuildFailedException as ex:
+        logger.error(f'Run failed: {ex}')
+        log_build_failed_exception(ex)
+    except Exception as ex:
+        logger.exception(f'Run failed: {ex}')
+    finally:
+        # stop logging to the finished test run, and drop any per-spec signal handler
+        logger.init(None, source="runner")
+        if settings.K8 and not settings.TEST:
+            signal.signal(signal.SIGTERM, default_sigterm_runner)
+            signal.signal(signal.SIGINT, default_sigterm_runner)
+
+
+def serve() -> int:
+    """
+    Warm runner pool: register with the server and then run each test run we're assigned, until we've been
+    idle for too long or are asked to terminate. This saves each test run paying for the runner start-up.
+    """
+    hostname = get_hostname()
+    app.init_http_client()
+    r = app.http_client.post('runner-pool/register', json={'pod_name': hostname})
+    if r.status_code != 200:
+        logger.error(f'Failed to register with the runner pool: {r.status_code}')
+        return 1
+
+    # so we still deregister if we're terminated while idle
+    if settings.K8 and not settings.TEST:
+        signal.signal(signal.SIGTERM, default_sigterm_runner)
+        signal.signal(signal.SIGINT, default_sigterm_runner)
+
+    idle_since = time.time()
+    try:
+        while not app.is_terminating:
+            trid = get_next_testrun(hostname)
+            if trid:
+                logger.info(f'Assigned test run {trid}')
+                run_testrun(trid)
+                idle_since = time.time()
+            elif time.time() - idle_since > settings.POOL_IDLE_TIMEOUT:
+                logger.info('Idle for too long: leaving the pool')
+                break
+            else:
+                time.sleep(settings.POOL_POLL_INTERVAL)
+    finally:
+        app.reset()
+        app.http_client.post('runner-pool/deregister', json={'pod_name': hostname})
+    return 0
@@ -0,0 +1,318 @@
+"""
+A caching reverse proxy in front of the upstream APIs and CDNs called by the app under test, so every spec
+on every runner doesn't pay their latency again (and, replaying recorded responses, specs don't depend on
+them at all)
+"""
+import base64
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+from enum import Enum
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import httpx
+
+from cykubedrunner import codec
+from cykubedrunner.settings import settings
+from cykubedrunner.utils import logger
+
+# these only apply to a single connection, and httpx gives us the decoded body
+HOP_BY_HOP_HEADERS = {'connection', 'keep-alive', 'proxy-authenticate', 'proxy-authorization', 'te', 'trailer',
+                      'transfer-encoding', 'upgrade', 'host', 'content-length', 'content-encoding'}
+CACHEABLE_METHODS = {'GET', 'HEAD'}
+# the statuses that are cacheable by default (RFC 9110)
+CACHEABLE_STATUSES = {200, 203, 204, 300, 301, 308, 404, 405, 410, 414, 501}
+# the response may depend on who's asking, but not on anything else in the headers
+KEY_HEADERS = ['authorization', 'cookie']
+
+
+class ProxyMode(str, Enum):
+    cache = 'cache'
+    record = 'record'
+    replay = 'replay'
+
+
+class ProxyResponse(object):
+    def __init__(self, status: int, headers: list[tuple[str, str]], body: bytes, source: str):
+        self.status = status
+        self.headers = headers
+        self.body = body
+        # where the response came from: HIT (the cache or a recording), MISS (the upstream) or ERROR
+        self.source = source
+
+    def to_dict(self) -> dict:
+        return dict(status=self.status, headers=self.headers, body=base64.b64encode(self.body).decode())
+
+    @classmethod
+    def from_dict(cls, d: dict) -> 'ProxyResponse':
+        return cls(d['status'], [tuple(x) for x in d['headers']], base64.b64decode(d['body']), 'HIT')
+
+
+class ProxyRoute(object):
+    def __init__(self, prefix: str, upstream: str):
+        self.prefix = prefix
+        self.upstream = upstream.rstrip('/')
+
+    def get_url(self, path: str) -> str:
+        return self.upstream + '/' + path[len(self.prefix):].lstrip('/')
+
+
+def parse_routes(routes: str) -> list[ProxyRoute]:
+    """
+    Parse a comma-separated list of <path prefix>=<upstream URL>. The longest matching prefix wins
+    """
+    result = []
+    for route in routes.split(','):
+        if route.strip():
+            prefix, _, upstream = route.strip().partition('=')
+            result.append(ProxyRoute(prefix, upstream))
+    return sorted(result, key=lambda x: len(x.prefix), reverse=True)
+
+
+def get_cache_ttl(headers: httpx.Headers, ttl: int) -> int:
+    """
+    Return how many seconds (up to ttl) a response can be shared from the cache for, given its headers
+    """
+    if headers.get('vary', '').strip() == '*':
+        return 0
+    directives = dict()
+    for directive in headers.get('cache-control', '').lower().split(','):
+        name, _, value = directive.strip().partition('=')
+        directives[name] = value.strip('"')
+    # we don't revalidate, so no-cache is as good as no-store
+    if {'no-store', 'no-cache', 'private'} & directives.keys():
+        return 0
+    max_age = directives.get('s-maxage') or directives.get('max-age')
+    if max_age:
+        try:
+            return max(0, min(ttl, int(max_age)))
+        except ValueError:
+            return 0
+    return ttl
+
+
+class RouteStats(object):
+    def __init__(self):
+        self.requests = 0
+        self.hits = 0
+        self.errors = 0
+        self.bytes_saved = 0
+
+    def dict(self) -> dict:
+        return dict(requests=self.requests, hits=self.hits, misses=self.requests - self.hits - self.errors,
+                    errors=self.errors, bytes_saved=self.bytes_saved)
+
+
+class ResponseCache(object):
+    """
+    An in-memory cache of responses, which expire after `ttl` seconds. The least recently used are evicted to
+    keep the total size of the bodies within max_size bytes
+    """
+    def __init__(self, max_size: int, ttl: int):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.size = 0
+        self.entries: OrderedDict[str, tuple[float, ProxyResponse]] = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key: str) -> ProxyResponse | None:
+        with self.lock:
+            entry = self.entries.get(key)
+            if not entry:
+                return None
+            expires, response = entry
+            if time.monotonic() > expires:
+                self.remove(key)
+                return None
+            self.entries.move_to_end(key)
+            return response
+
+    def put(self, key: str, response: ProxyResponse, ttl: int | None = None):
+        if len(response.body) > self.max_size:
+            return
+        with self.lock:
+            if key in self.entries:
+                self.remove(key)
+            self.entries[key] = (time.monotonic() + (self.ttl if ttl is None else ttl), response)
+            self.size += len(response.body)
+            while self.size > self.max_size:
+                self.remove(next(iter(self.entries)))
+
+    def remove(self, key: str):
+        self.size -= len(self.entries.pop(key)[1].body)
+
+
+class Recordings(object):
+    """
+    Responses saved on the build volume, so they can be replayed by later runners
+    """
+    def __init__(self, root: str):
+        self.root = root
+
+    def path(self, key: str) -> str:
+        return os.path.join(self.root, key[:2], f'{key}.json')
+
+    def get(self, key: str) -> ProxyResponse | None:
+        try:
+            with open(self.path(key), 'rb') as f:
+                return ProxyResponse.from_dict(codec.loads(f.read()))
+        except (OSError, ValueError):
+            return None
+
+    def put(self, key: str, response: ProxyResponse):
+        path = self.path(key)
+        # other runners may be recording the same response
+        tmpfile = f'{path}.{threading.get_ident()}.tmp'
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(tmpfile, 'wb') as f:
+                f.write(codec.dumpb(response.to_dict()))
+            os.replace(tmpfile, path)
+        except OSError as ex:
+            # the spec still gets the response
+            logger.warning(f'Failed to record the response to {path}: {ex}')
+
+
+class CachingProxy(object):
+    def __init__(self, routes: list[ProxyRoute], mode: str = ProxyMode.cache):
+        self.routes = routes
+        self.mode = mode
+        self.cache = ResponseCache(settings.PROXY_CACHE_MAX_SIZE, settings.PROXY_CACHE_TTL)
+        self.recordings = Recordings(settings.proxy_recordings_dir)
+        self.stats: dict[str, RouteStats] = {route.prefix: RouteStats() for route in routes}
+        self.stats_lock = threading.Lock()
+        self.client = httpx.Client(timeout=settings.PROXY_TIMEOUT)
+
+    def get_route(self, path: str) -> ProxyRoute | None:
+        for route in self.routes:
+            if path.startswith(route.prefix):
+                return route
+        return None
+
+    def handle(self, method: str, path: str, headers: dict[str, str], body: bytes) -> ProxyResponse:
+        route = self.get_route(path)
+        if not route:
+            return ProxyResponse(HTTPStatus.NOT_FOUND, [], b'No proxy route', 'ERROR')
+
+        url = route.get_url(path)
+        response = self.fetch(method, url, headers, body)
+        with self.stats_lock:
+            stats = self.stats[route.prefix]
+            stats.requests += 1
+            if response.source == 'HIT':
+                stats.hits += 1
+                stats.bytes_saved += len(response.body)
+            elif response.source == 'ERROR':
+                stats.errors += 1
+        return response
+
+    def fetch(self, method: str, url: str, headers: dict[str, str], body: bytes) -> ProxyResponse:
+        key = hashlib.sha256(b'\n'.join([method.encode(), url.encode()] +
+                                        [headers.get(name, '').encode() for name in KEY_HEADERS] +
+                                        [body])).hexdigest()
+        if self.mode == ProxyMode.replay:
+            response = self.recordings.get(key)
+            if not response:
+                logger.warning(f'No recorded response for {method} {url}')
+                return ProxyResponse(HTTPStatus.BAD_GATEWAY, [], b'No recorded response', 'ERROR')
+            return response
+
+        cacheable = method in CACHEABLE_METHODS
+        if cacheable:
+            response = self.cache.get(key)
+            if response:
+                return response
+
+        try:
+            r = self.client.request(method, url, headers=headers, content=body)
+        except httpx.HTTPError as ex:
+            logger.debug(f'Proxy request {method} {url} failed: {ex}')
+            return ProxyResponse(HTTPStatus.BAD_GATEWAY, [], str(ex).encode(), 'ERROR')
+
+        response = ProxyResponse(r.status_code,
+                                 [(k, v) for k, v in r.headers.multi_items() if k.lower() not in HOP_BY_HOP_HEADERS],
+                                 r.content, 'MISS')
+        if self.mode == ProxyMode.record:
+            self.recordings.put(key, response)
+        ttl = get_cache_ttl(r.headers, self.cache.ttl) if cacheable and r.status_code in CACHEABLE_STATUSES else 0
+        if ttl:
+            self.cache.put(key, ProxyResponse(response.status, response.headers, response.body, 'HIT'), ttl)
+        return response
+
+    def get_stats(self) -> dict[str, dict]:
+        with self.stats_lock:
+            return {prefix: stats.dict() for prefix, stats in self.stats.items()}
+
+    def close(self):
+        self.client.close()
+
+
+class ProxyHandler(BaseHTTPRequestHandler):
+    # keep connections from the browser open
+    protocol_version = 'HTTP/1.1'
+
+    def proxy_request(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length) if length else b''
+        headers = {k.lower(): v for k, v in self.headers.items() if k.lower() not in HOP_BY_HOP_HEADERS}
+        response = self.server.proxy.handle(self.command, self.path, headers, body)
+
+        self.send_response(response.status)
+        for name, value in response.headers:
+            self.send_header(name, value)
+        self.send_header('X-Cache', response.source)
+        self.send_header('Content-Length', str(len(response.body)))
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(response.body)
+
+    do_GET = do_HEAD = do_POST = do_PUT = do_PATCH = do_DELETE = do_OPTIONS = proxy_request
+
+    def log_message(self, format, *args):
+        # far too noisy for the test run log
+        pass
+
+
+class ProxyThread(threading.Thread):
+    """
+    Run the proxy in the background, like the SPA server
+    """
+    def __init__(self, proxy: CachingProxy, port: int = 0, **kwargs):
+        super().__init__(daemon=True, **kwargs)
+        self.proxy = proxy
+        self.httpd = ThreadingHTTPServer(('', port), ProxyHandler)
+        self.httpd.daemon_threads = True
+        self.httpd.proxy = proxy
+        self.port = self.httpd.server_address[1]
+
+    @property
+    def url(self) -> str:
+        return f'http://localhost:{self.port}'
+
+    def run(self):
+        self.httpd.serve_forever()
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        self.proxy.close()
+        for prefix, stats in self.proxy.get_stats().items():
+            logger.info(f'Proxy {prefix}: {stats["requests"]} requests, {stats["hits"]} hits, '
+                        f'{stats["errors"]} errors, {stats["bytes_saved"] // 1024}KB saved')
+
+
+def start_proxy() -> ProxyThread | None:
+    """
+    Start the proxy, if there are any routes configured
+    """
+    if not settings.PROXY_ROUTES:
+        return None
+    routes = parse_routes(settings.PROXY_ROUTES)
+    thread = ProxyThread(CachingProxy(routes, settings.PROXY_MODE), settings.PROXY_PORT)
+    thread.start()
+    logger.debug(f'Proxy ({settings.PROXY_MODE}) running on port {thread.port} for '
+                 f'{", ".join(f"{r.prefix} -> {r.upstream}" for r in routes)}')
+    return thread
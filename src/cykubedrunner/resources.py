@@ -0,0 +1,132 @@
+import math
+import os
+
+from cykubedrunner.settings import settings
+from cykubedrunner.utils import logger
+
+CGROUP_ROOT = '/sys/fs/cgroup'
+GiB = 1024 * 1024 * 1024
+# cgroup v1 reports "no limit" as a huge number (the max page-aligned int64)
+CGROUP_V1_UNLIMITED = 1 << 60
+
+# rough peak memory of a test framework process running each browser (including the browser itself)
+BROWSER_MEMORY = {
+    'electron': int(1.5 * GiB),
+    'chrome': int(1.5 * GiB),
+    'chromium': int(1.5 * GiB),
+    'edge': int(1.5 * GiB),
+    'firefox': 2 * GiB,
+    'webkit': GiB,
+}
+DEFAULT_BROWSER_MEMORY = 2 * GiB
+
+
+def read_cgroup_file(path: str) -> str | None:
+    try:
+        with open(os.path.join(CGROUP_ROOT, path)) as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+
+def read_cgroup_stat(path: str, key: str) -> int:
+    for line in (read_cgroup_file(path) or '').splitlines():
+        name, _, value = line.partition(' ')
+        if name == key:
+            return int(value)
+    return 0
+
+
+def get_cpu_limit() -> float:
+    """
+    Return the number of CPUs we can use: the cgroup quota if there is one, otherwise the CPUs we can run on
+    """
+    cpumax = read_cgroup_file('cpu.max')
+    if cpumax:
+        # cgroup v2: "<quota> <period>", or "max <period>"
+        quota, _, period = cpumax.partition(' ')
+        if quota != 'max':
+            return int(quota) / int(period)
+    else:
+        quota, period = read_cgroup_file('cpu/cpu.cfs_quota_us'), read_cgroup_file('cpu/cpu.cfs_period_us')
+        if quota and period and int(quota) > 0:
+            return int(quota) / int(period)
+    return float(len(os.sched_getaffinity(0)))
+
+
+def get_memory_limit() -> int | None:
+    """
+    Return the cgroup memory limit, or None if there isn't one
+    """
+    limit = read_cgroup_file('memory.max')
+    if limit is not None:
+        return None if limit == 'max' else int(limit)
+    limit = read_cgroup_file('memory/memory.limit_in_bytes')
+    if limit is not None and int(limit) < CGROUP_V1_UNLIMITED:
+        return int(limit)
+    return None
+
+
+def get_memory_usage() -> int | None:
+    """
+    Return the working set of the cgroup (what the OOM killer looks at): this doesn't include page cache that
+    can be reclaimed
+    """
+    usage = read_cgroup_file('memory.current')
+    if usage is not None:
+        return int(usage) - read_cgroup_stat('memory.stat', 'inactive_file')
+    usage = read_cgroup_file('memory/memory.usage_in_bytes')
+    if usage is not None:
+        return int(usage) - read_cgroup_stat('memory/memory.stat', 'total_inactive_file')
+    return None
+
+
+def get_available_memory() -> int:
+    """
+    Return the memory we can still use, within the cgroup limit and on the node
+    """
+    import psutil
+
+    available = psutil.virtual_memory().available
+    limit = get_memory_limit()
+    if limit:
+        usage = get_memory_usage()
+        if usage is not None:
+            available = min(available, limit - usage)
+    return max(0, available)
+
+
+def get_browser_memory(browsers: list[str]) -> int:
+    return max(BROWSER_MEMORY.get(browser, DEFAULT_BROWSER_MEMORY) for browser in browsers)
+
+
+def get_slots(browsers: list[str]) -> int:
+    """
+    Return how many test framework processes (each running one of these browsers) we can run at once, given
+    the CPUs we have and the memory that's free right now (so this goes down under memory pressure)
+    """
+    if not settings.AUTO_CONCURRENCY:
+        return 1
+    cpus = get_cpu_limit()
+    available = get_available_memory()
+    slots = max(1, min(math.floor(cpus), available // get_browser_memory(browsers), settings.MAX_CONCURRENCY))
+    logger.debug(f'Concurrency {slots}: {cpus:.1f} CPUs and {available // (1024 * 1024)}MB memory available')
+    return slots
+
+
+def get_cypress_concurrency(browsers: list[str]) -> tuple[int, int]:
+    """
+    Return the number of specs to run at once, and the number of browsers to run each spec in at once.
+    We'd rather run the browsers for a spec in parallel, so each spec finishes sooner
+    """
+    slots = get_slots(browsers)
+    parallel_browsers = min(len(browsers), slots)
+    return max(1, slots // parallel_browsers), parallel_browsers
+
+
+def get_playwright_workers(browsers: list[str]) -> int:
+    """
+    Playwright runs the tests in a spec in its own worker processes, so we run one spec at a time and give
+    it all the workers
+    """
+    return get_slots(browsers)
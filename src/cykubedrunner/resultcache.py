@@ -0,0 +1,138 @@
+import glob
+import hashlib
+import json
+import os
+import time
+
+from cykubedrunner.bundler import get_support_file, get_dependencies, hash_files
+from cykubedrunner.caches import get_package_version, get_playwright_version
+from cykubedrunner.common.enums import TestFramework, TestResultStatus
+from cykubedrunner.common.schemas import NewTestRun, SpecTests
+from cykubedrunner.settings import settings
+from cykubedrunner.utils import logger
+
+CONFIG_GLOBS = ['cypress.json', 'cypress.config.*', 'playwright.config.*']
+# at the root of the repository, even in a monorepo
+LOCKFILES = ['package-lock.json', 'yarn.lock', 'pnpm-lock.yaml']
+
+
+def is_cacheable(spectests: SpecTests) -> bool:
+    """
+    We only cache clean passes
+    """
+    if spectests.timeout or not spectests.tests:
+        return False
+    return all(result.status == TestResultStatus.passed for test in spectests.tests for result in test.results)
+
+
+class ResultCache(object):
+    """
+    Results of specs that passed, keyed by everything that could change the result: the spec and the files
+    it imports, the built app, the test framework (version and config), the lockfile and the browsers
+    """
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.testrun: NewTestRun = None
+        self.base_digest = None
+
+    @property
+    def enabled(self) -> bool:
+        return settings.RESULT_CACHE and self.testrun is not None
+
+    def init(self, testrun: NewTestRun):
+        self.testrun = testrun
+        self.base_digest = None
+        if settings.RESULT_CACHE:
+            self.prune()
+
+    def get_base_digest(self):
+        """
+        The part of the key that's common to all specs
+        """
+        if self.base_digest:
+            return self.base_digest.copy()
+
+        digest = hashlib.sha256()
+        project = self.testrun.project
+        if project.test_framework == TestFramework.cypress:
+            version = get_package_version('cypress')
+            support = get_support_file()
+            config_files = get_dependencies(support) if support else []
+        else:
+            version = get_playwright_version()
+            config_files = []
+        digest.update(json.dumps([str(project.test_framework), version, project.browsers or []]).encode())
+
+        for pattern in CONFIG_GLOBS:
+            config_files += sorted(glob.glob(pattern, root_dir=settings.app_dir))
+        config_files += [os.path.relpath(os.path.join(settings.src_dir, x), settings.app_dir) for x in LOCKFILES
+                         if os.path.exists(os.path.join(settings.src_dir, x))]
+        hash_files(digest, config_files)
+
+        distdir = os.path.join(settings.app_dir, 'dist')
+        dist = []
+        for root, dirs, files in os.walk(distdir):
+            dirs.sort()
+            dist += [os.path.relpath(os.path.join(root, f), settings.app_dir) for f in sorted(files)]
+        hash_files(digest, dist)
+
+        self.base_digest = digest
+        return digest.copy()
+
+    def get_key(self, spec: str) -> str:
+        digest = self.get_base_digest()
+        hash_files(digest, get_dependencies(spec))
+        return digest.hexdigest()
+
+    def get_path(self, spec: str) -> str:
+        return os.path.join(settings.result_cache_dir, f'{self.get_key(spec)}.json')
+
+    def get(self, spec: str) -> SpecTests | None:
+        if not self.enabled or settings.FORCE_RERUN:
+            return None
+        path = self.get_path(spec)
+        try:
+            if time.time() - os.path.getmtime(path) > settings.RESULT_CACHE_TTL:
+                return None
+            with open(path) as f:
+                return SpecTests.parse_raw(f.read())
+        except (OSError, ValueError):
+            return None
+
+    def put(self, spec: str, spectests: SpecTests):
+        if not self.enabled or not is_cacheable(spectests):
+            return
+        path = self.get_path(spec)
+        tmpfile = f'{path}.{os.getpid()}'
+        try:
+            os.makedirs(settings.result_cache_dir, exist_ok=True)
+            # the video will have gone by the time we use this
+            with open(tmpfile, 'w') as f:
+                f.write(spectests.copy(update=dict(video=None)).json())
+            os.replace(tmpfile, path)
+        except OSError as ex:
+            # not fatal: the results have been sent
+            logger.warning(f'Failed to cache the results for {spec}: {ex}')
+
+    def prune(self):
+        """
+        Remove expired results
+        """
+        if not os.path.exists(settings.result_cache_dir):
+            return
+        now = time.time()
+        removed = 0
+        for entry in os.scandir(settings.result_cache_dir):
+            try:
+                if now - entry.stat().st_mtime > settings.RESULT_CACHE_TTL:
+                    os.unlink(entry.path)
+                    removed += 1
+            except OSError:
+                pass
+        if removed:
+            logger.debug(f'Removed {removed} expired results from the result cache')
+
+
+result_cache = ResultCache()
@@ -1,47 +1,266 @@
 import os
 import signal
 import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from typing import Callable, Iterator, Iterable
 
+from cykubedrunner import lean
 from cykubedrunner.app import app
+from cykubedrunner.baserunner import SpecInterrupted, BaseSpecRunner, get_failed_tests, merge_rerun
 from cykubedrunner.common.enums import TestFramework
 from cykubedrunner.common.exceptions import RunFailedException
-from cykubedrunner.common.schemas import NewTestRun
+from cykubedrunner.common.schemas import NewTestRun, SpecTests
 from cykubedrunner.common.utils import get_hostname
 from cykubedrunner.cypress import CypressSpecRunner
+from cykubedrunner.durations import spec_durations
 from cykubedrunner.playwright import PlaywrightSpecRunner
+from cykubedrunner.proxy import start_proxy
+from cykubedrunner.resources import get_cypress_concurrency
+from cykubedrunner.resultcache import result_cache
+from cykubedrunner.scratch import scratch
 from cykubedrunner.server import start_server, ServerThread
 from cykubedrunner.settings import settings
+from cykubedrunner.snapshot import snapshot_exists, extract_snapshot
+from cykubedrunner.spool import spool
 from cykubedrunner.utils import logger, log_build_failed_exception, default_sigterm_runner, upload_results
+from cykubedrunner.watchdog import spec_usage
+
+
+def spec_terminated(specfile: str):
+    """
+    Return the spec to the pool
+    """
+    app.post('return-spec', json={'file': specfile})
+
+
+def lease_specs(count: int) -> list[str]:
+    """
+    Fetch the next spec(s) to run. The server returns one spec per line
+    """
+    payload = {'pod_name': get_hostname()}
+    if count > 1:
+        payload['count'] = count
+    r = app.post('next-spec', json=payload)
+    if r.status_code == 204:
+        return []
+    return [spec for spec in r.text.splitlines() if spec]
+
+
+def make_batches(specs: list[str]) -> list[list[str]]:
+    """
+    Group specs that are short (according to their history) so they can be run in a single invocation of
+    the test framework. Anything we don't have a history for, or that is too long, is run on its own
+    """
+    batches = []
+    current, current_duration = [], 0
+    for spec in specs:
+        duration = spec_durations.percentile(spec, 90)
+        if duration is None or duration > settings.SPEC_BATCH_MAX_DURATION:
+            batches.append([spec])
+            continue
+        if current and current_duration + duration > settings.SPEC_BATCH_MAX_DURATION:
+            batches.append(current)
+            current, current_duration = [], 0
+        current.append(spec)
+        current_duration += duration
+    if current:
+        batches.append(current)
+    return batches
+
+
+def run_parallel(fn: Callable, items: Iterable, workers: int, name: str) -> Iterator:
+    """
+    Map fn over the items, running up to `workers` at once. The results are returned in order
+    """
+    if workers <= 1:
+        yield from map(fn, items)
+        return
+    executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix=name)
+    try:
+        yield from executor.map(fn, items)
+    except BaseException:
+        # don't wait for the specs that are still running if we're bailing out
+        executor.shutdown(wait=False, cancel_futures=True)
+        raise
+    executor.shutdown()
+
+
+def use_cached_result(spec: str) -> bool:
+    """
+    Report the result from the cache, if the spec passed last time and nothing it depends on has changed
+    """
+    spectests = result_cache.get(spec)
+    if not spectests:
+        return False
+    logger.info(f'Using cached result for {spec}')
+    upload_results(spec, spectests, cached=True)
+    app.specs_completed.add(spec)
+    return True
+
+
+def run_with_reruns(testrun: NewTestRun, create_runner: Callable[..., BaseSpecRunner]) -> SpecTests | None:
+    """
+    Run the spec, and then (if RETRY_FAILED_TESTS is set) rerun any failed tests in a new process, so
+    the cost of a retry depends on the number of failures rather than the size of the spec
+    """
+    spectests = create_runner().run()
+    if not settings.RETRY_FAILED_TESTS or not spectests:
+        return spectests
+
+    for attempt in range(testrun.project.runner_retries or 0):
+        failed = get_failed_tests(spectests)
+        if not failed:
+            break
+        logger.info(f'Rerunning {len(failed)} failed tests (attempt {attempt + 1})')
+        rerun = create_runner(only=failed).run()
+        if not rerun:
+            break
+        merge_rerun(spectests, rerun)
+    return spectests
+
+
+def run_spec(server: ServerThread, testrun: NewTestRun, spec: str):
+    if use_cached_result(spec):
+        return
+
+    spectests = None
+    if testrun.project.test_framework == TestFramework.cypress:
+        # Cypress needs to be run explicitly for each required browser
+        browsers = testrun.project.browsers or ['electron']
+        logger.debug(f'Browsers = {browsers}')
+
+        def run_browser(browser: str) -> SpecTests | None:
+            logger.debug(f'Running Cypress tests for file {spec} on browser {browser}')
+            return run_with_reruns(testrun, partial(CypressSpecRunner, server, testrun, spec, browser=browser))
+
+        parallel_browsers = get_cypress_concurrency(browsers)[1]
+        for browser_spectests in run_parallel(run_browser, browsers, parallel_browsers, 'browser'):
+            if not spectests:
+                spectests = browser_spectests
+            else:
+                spectests = lean.merge(spectests, browser_spectests)
+    else:
+        # Playwright handles browser support natively
+        logger.debug(f'Running Playwright tests for file {spec}')
+        spectests = run_with_reruns(testrun, partial(PlaywrightSpecRunner, server, testrun, spec))
+
+    if spectests:
+        upload_results(spec, spectests, usage=spec_usage.pop(spec))
+        # only cache what we managed to upload (or spool)
+        result_cache.put(spec, spectests)
+    scratch.release(spec)
+
+    app.specs_completed.add(spec)
+
+
+def run_spec_batch(server: ServerThread, testrun: NewTestRun, batch: list[str]) -> list[str]:
+    """
+    Run a batch of specs in a single process (per browser), and post the results for each spec separately.
+    Returns the specs that didn't complete
+    """
+    batch = [spec for spec in batch if not use_cached_result(spec)]
+    if not batch:
+        return []
+
+    if testrun.project.test_framework == TestFramework.cypress:
+        browsers = testrun.project.browsers or ['electron']
+
+        def run_browser(browser: str) -> dict[str, SpecTests]:
+            logger.debug(f'Running Cypress tests for files {batch} on browser {browser}')
+            return CypressSpecRunner(server, testrun, batch, browser=browser).run_batch()
+
+        results = None
+        parallel_browsers = get_cypress_concurrency(browsers)[1]
+        for browser_results in run_parallel(run_browser, browsers, parallel_browsers, 'browser'):
+            if results is None:
+                results = browser_results
+            else:
+                # a spec is only complete if it completed on every browser
+                for spec in list(results.keys()):
+                    if spec in browser_results:
+                        results[spec] = lean.merge(results[spec], browser_results[spec])
+                    else:
+                        del results[spec]
+    else:
+        logger.debug(f'Running Playwright tests for files {batch}')
+        results = PlaywrightSpecRunner(server, testrun, batch).run_batch()
+
+    for spec, spectests in results.items():
+        upload_results(spec, spectests, usage=spec_usage.pop(spec))
+        result_cache.put(spec, spectests)
+        app.specs_completed.add(spec)
+
+    # the specs that didn't complete are run again, with new scratch directories
+    for spec in batch:
+        scratch.release(spec)
+    return [spec for spec in batch if spec not in results]
+
+
+def run_specs(server: ServerThread, testrun: NewTestRun, batch: list[str]) -> list[str]:
+    """
+    Run a batch of specs (or a single spec). Returns the specs that didn't complete
+    """
+    if app.is_terminating:
+        # don't start anything new: the termination budget is for the specs already running
+        return batch
+    if len(batch) == 1:
+        run_spec(server, testrun, batch[0])
+        return []
+    return run_spec_batch(server, testrun, batch)
+
+
+def get_spec_workers(testrun: NewTestRun) -> int:
+    """
+    The number of specs (or batches) to run at once. Playwright runs the tests in a spec in parallel itself
+    """
+    if testrun.project.test_framework == TestFramework.cypress:
+        return get_cypress_concurrency(testrun.project.browsers or ['electron'])[0]
+    return 1
 
 
 def run_tests(server: ServerThread, testrun: NewTestRun):
 
-    def spec_terminated(specfile: str):
-        """
-        Return the spec to the pool
-        """
-        app.post('return-spec', json={'file': specfile})
+    batching = settings.SPEC_BATCH_SIZE > 1
 
     while not app.is_terminating:
 
-        hostname = get_hostname()
-        r = app.post('next-spec', json={'pod_name': hostname})
-        if r.status_code == 204:
+        # re-evaluated for each lease, as the memory available may have changed
+        workers = get_spec_workers(testrun)
+        if workers > 1:
+            logger.debug(f'Running {workers} specs at once')
+        lease = lease_specs((settings.SPEC_BATCH_SIZE if batching else 1) * workers)
+        if not lease:
             # we're finished
             logger.debug('No more spec file - quitting')
             return
 
-        spec = r.text
+        def relinquish_unfinished():
+            unfinished = [spec for spec in lease if spec not in app.specs_completed]
+            for spec in unfinished:
+                spec_terminated(spec)
+            return unfinished
 
         def handle_sigterm_runner(signum, frame):
             """
             We can tell the agent that they should reassign the spec
             """
+            if app.is_spot and not app.is_terminating and settings.SPOT_TERMINATION_BUDGET:
+                # spot preemption: use the grace period to try and finish the current spec. The runner
+                # will upload the results and then stop, or relinquish the spec if it runs out of time
+                app.is_terminating = True
+                app.terminate_by = time.time() + settings.SPOT_TERMINATION_BUDGET
+                logger.warning(f"SIGTERM/SIGINT caught on spot node: "
+                               f"allowing {settings.SPOT_TERMINATION_BUDGET}s to complete specs {lease}")
+                return
+
             # it's possible we've actually just finished this (pretty edge case, but it has happened)
             app.is_terminating = True
-            if spec not in app.specs_completed:
-                spec_terminated(spec)
-            logger.warning(f"SIGTERM/SIGINT caught: relinquish spec {spec}")
+            # we'll be killed once the grace period is up, so that's all the time we have to send any results
+            app.terminate_by = time.time() + settings.TERMINATION_GRACE_PERIOD
+            unfinished = relinquish_unfinished()
+            logger.warning(f"SIGTERM/SIGINT caught: relinquish specs {unfinished}")
             sys.exit(1)
 
         if settings.K8 and not settings.TEST:
@@ -49,36 +268,32 @@ def run_tests(server: ServerThread, testrun: NewTestRun):
             signal.signal(signal.SIGINT, handle_sigterm_runner)
 
         try:
-            spectests = None
-            if testrun.project.test_framework == TestFramework.cypress:
-                # Cypress needs to be run explicitly for each required browser
-                browsers = testrun.project.browsers or ['electron']
-                logger.debug(f'Browsers = {browsers}')
-                for browser in browsers:
-                    logger.debug(f'Running Cypress tests for file {spec} on browser {browser}')
-                    browser_spectests = CypressSpecRunner(server, testrun, spec,
-                                                          browser=browser).run()
-                    if not spectests:
-                        spectests = browser_spectests
+            batches = make_batches(lease) if batching else [[spec] for spec in lease]
+            for unfinished in run_parallel(partial(run_specs, server, testrun), batches, workers, 'spec'):
+                if unfinished:
+                    if app.is_terminating:
+                        logger.warning(f'Terminating: relinquish specs {unfinished}')
                     else:
-                        spectests.merge(browser_spectests)
-            else:
-                # Playwright handles browser support natively
-                logger.debug(f'Running Playwright tests for file {spec}')
-                spectests = PlaywrightSpecRunner(server, testrun, spec).run()
-
-            if spectests:
-                upload_results(spec, spectests)
+                        # run specs singly from now on so a broken spec can't take down a whole batch again
+                        logger.warning(f'Batch did not complete: relinquish specs {unfinished}')
+                        batching = False
+                    for spec in unfinished:
+                        spec_terminated(spec)
+                    lease = [spec for spec in lease if spec not in unfinished]
 
+        except SpecInterrupted as ex:
+            unfinished = relinquish_unfinished()
+            logger.warning(f"{ex}: relinquish specs {unfinished}")
+            sys.exit(1)
         except RunFailedException as ex:
             log_build_failed_exception(ex)
             return
         except Exception as ex:
-            # something went wrong - push the spec back onto the stack
-            logger.exception(f'Runner failed unexpectedly: adding the spec back to the stack')
+            # something went wrong - push the specs back onto the stack
+            logger.exception(f'Runner failed unexpectedly: adding the specs back to the stack')
             # FIXME too broad? Probably, although in this case we probably do want to catch stuff
             # like OOM, etc
-            spec_terminated(spec)
+            relinquish_unfinished()
             raise ex
 
 
@@ -95,15 +310,38 @@ def run():
         signal.signal(signal.SIGTERM, default_sigterm_runner)
         signal.signal(signal.SIGINT, default_sigterm_runner)
 
-    srcnode = os.path.join(settings.src_dir, 'node_modules')
-    if not os.path.exists(srcnode):
+    if settings.WORKSPACE_SNAPSHOT and snapshot_exists():
+        # work from a local copy of the workspace rather than the shared volume
+        extract_snapshot(settings.WORKSPACE_DIR)
+        settings.SRC_DIR = settings.WORKSPACE_DIR
+
+    app.detect_package_manager()
+    if app.is_yarn_pnp:
+        logger.debug("Using Yarn Plug'n'Play")
+    elif not os.path.exists(os.path.join(settings.src_dir, 'node_modules')):
         raise RunFailedException("Missing node_modules")
 
-    # start the server
+    spec_durations.load()
+    result_cache.init(testrun)
+
+    # start the proxy (so the server command can use it too) and the server
+    proxy = start_proxy()
+    if proxy:
+        app.proxy_url = proxy.url
     server = start_server(testrun.project)
     logger.debug(f"Server running on port {server.port}")
 
     # now fetch specs until we're done or the build is cancelled
-    run_tests(server, testrun)
-
-    server.stop()
+    try:
+        run_tests(server, testrun)
+    finally:
+        if settings.RESULT_SPOOL:
+            timeout = settings.SPOOL_DRAIN_TIMEOUT
+            if app.terminate_by:
+                # we're being terminated, so we can only wait as long as we've got
+                timeout = max(0.0, min(timeout, app.terminate_by - time.time()))
+            spool.drain(timeout)
+        # a pooled runner goes on to the next test run
+        server.stop()
+        if proxy:
+            proxy.stop()
@@ -0,0 +1,98 @@
+import os
+import shutil
+import tempfile
+import threading
+
+from cykubedrunner.caches import get_dir_size
+from cykubedrunner.fsutils import remove_tree
+from cykubedrunner.settings import settings
+from cykubedrunner.utils import logger
+
+SHM_DIR = '/dev/shm'
+
+
+def get_scratch_root() -> str:
+    """
+    Use tmpfs if asked to and there's room for it, both on /dev/shm and in memory (as it's charged to the
+    pod's memory limit), otherwise SCRATCH_DIR
+    """
+    if settings.SCRATCH_TMPFS:
+        from cykubedrunner.resources import get_available_memory
+
+        try:
+            free = min(shutil.disk_usage(SHM_DIR).free, get_available_memory())
+        except OSError:
+            free = 0
+        if free >= settings.SCRATCH_TMPFS_MIN_FREE:
+            return os.path.join(SHM_DIR, 'cykubed-scratch')
+        logger.debug(f'Only {free // (1024 * 1024)}MB free for tmpfs: using {settings.SCRATCH_DIR}')
+    return settings.SCRATCH_DIR
+
+
+class Scratch(object):
+    """
+    A directory for the results, screenshots and videos of each spec run. These are deleted once the
+    results for all the specs in the run have been uploaded. If the scratch space goes over SCRATCH_MAX_SIZE
+    then directories left behind (e.g by a failed upload or an earlier runner) are deleted, oldest first
+    """
+    def __init__(self):
+        # the specs each directory holds results for, that haven't been uploaded yet
+        self.dirs: dict[str, set[str]] = dict()
+        # specs may be run in parallel
+        self.lock = threading.Lock()
+        self.evict_lock = threading.Lock()
+
+    def create(self, specs: list[str]) -> str:
+        root = get_scratch_root()
+        os.makedirs(root, exist_ok=True)
+        if settings.SCRATCH_MAX_SIZE:
+            self.evict(root, settings.SCRATCH_MAX_SIZE)
+        path = tempfile.mkdtemp(dir=root, prefix='spec-')
+        with self.lock:
+            self.dirs[path] = set(specs)
+        return path
+
+    def release(self, spec: str):
+        """
+        The results for this spec have been uploaded (or spooled, which takes a copy of the artifacts)
+        """
+        with self.lock:
+            done = []
+            for path, specs in self.dirs.items():
+                specs.discard(spec)
+                if not specs:
+                    done.append(path)
+            for path in done:
+                del self.dirs[path]
+        for path in done:
+            remove_tree(path)
+
+    def reset(self):
+        """
+        Delete the directories of any specs whose results were never uploaded
+        """
+        with self.lock:
+            dirs = list(self.dirs.keys())
+            self.dirs = dict()
+        for path in dirs:
+            remove_tree(path)
+
+    def evict(self, root: str, max_size: int):
+        with self.evict_lock:
+            with self.lock:
+                active = set(self.dirs.keys())
+            # ignore anything remove_tree is still deleting
+            entries = [x for x in os.scandir(root) if x.is_dir() and not x.name.startswith('.')]
+            sizes = {x.path: get_dir_size(x.path) for x in entries}
+            total = sum(sizes.values())
+            for entry in sorted(entries, key=lambda x: x.stat().st_mtime):
+                if total <= max_size:
+                    break
+                if entry.path in active:
+                    continue
+                logger.warning(f'Scratch space is over quota: deleting {entry.path}')
+                remove_tree(entry.path)
+                total -= sizes[entry.path]
+
+
+scratch = Scratch()
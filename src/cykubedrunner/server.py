@@ -11,12 +11,11 @@ from http.server import SimpleHTTPRequestHandler
 from time import time, sleep
 
 import httpx
-import psutil
 
 from cykubedrunner.common.exceptions import BuildFailedException
 from cykubedrunner.common.schemas import Project
 from cykubedrunner.settings import settings
-from cykubedrunner.utils import get_env_and_args, logger
+from cykubedrunner.utils import get_env_and_args, logger, kill_process_tree
 
 
 class ServerThread(threading.Thread):
@@ -40,7 +39,7 @@ class ServerThread(threading.Thread):
             logger.cmd(args)
             with subprocess.Popen(shlex.split(args), env=cmdenv, encoding=settings.ENCODING,
                                   stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
-                                  cwd=settings.src_dir) as proc:
+                                  cwd=settings.app_dir) as proc:
                 self.proc = proc
                 while not self.stopping:
                     line = proc.stdout.readline()
@@ -74,16 +73,13 @@ class ServerThread(threading.Thread):
             # not strictly necessary if running in a Pod as this is a daemon thread and
             # so will not stop the pod exiting
             if self.proc:
-                parent = psutil.Process(self.proc.pid)
-                for child in parent.children(recursive=True):
-                    child.kill()
-                self.proc.kill()
+                kill_process_tree(self.proc)
             logger.debug('Server killed')
 
 
 class SPAHandler(SimpleHTTPRequestHandler):
     def __init__(self, *args, **kwargs):
-        self.root = os.path.join(settings.src_dir, 'dist')
+        self.root = os.path.join(settings.app_dir, 'dist')
         self.index_file = None
         for index in "index.html", "index.htm":
             index = os.path.join(self.root, index)
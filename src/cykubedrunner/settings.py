@@ -31,30 +31,158 @@ class RunnerSettings(BaseSettings):
     HOSTNAME: str = None  # for testing
 
     BUILD_DIR = '/tmp/cykubed/build'
+    # overrides BUILD_DIR/src, e.g for an extracted workspace snapshot
+    SRC_DIR: str = None
+    # the app's workspace within a monorepo
+    APP_PATH: str = ''
+
+    # on a spot node, SIGTERM gives the running spec this many seconds to finish
+    SPOT: bool = False
+    SPOT_TERMINATION_BUDGET: int = 25
+    # the pod's terminationGracePeriodSeconds
+    TERMINATION_GRACE_PERIOD: int = 30
+
+    # per-spec deadlines computed from recent durations: factor x p99, clamped to [min, max]
+    ADAPTIVE_SPEC_DEADLINE: bool = False
+    SPEC_DEADLINE_FACTOR: float = 3.0
+    SPEC_DEADLINE_MIN: int = 60
+    SPEC_DEADLINE_MAX: int = 3600
+    SPEC_DEADLINE_MIN_SAMPLES: int = 3
+    SPEC_DURATION_HISTORY: int = 20
+
+    # lease up to this many specs at a time, running short ones together in one process
+    SPEC_BATCH_SIZE: int = 1
+    SPEC_BATCH_MAX_DURATION: int = 60
+
+    # size the spec, Playwright worker and browser concurrency by the pod's CPU and memory
+    AUTO_CONCURRENCY: bool = False
+    MAX_CONCURRENCY: int = 8
+
+    # maximum number of build steps run at once
+    BUILD_CONCURRENCY: int = 4
+
+    # bundle Cypress e2e specs (with esbuild) once in the builder, rather than in every runner
+    PREBUNDLE_SPECS: bool = False
+    BUNDLE_WORKERS: int = 4
+
+    # runners extract a snapshot of the workspace to local disk (WORKSPACE_DIR)
+    WORKSPACE_SNAPSHOT: bool = False
+    SNAPSHOT_SHARDS: int = 8
+    SNAPSHOT_COMPRESS_LEVEL: int = 1
+    WORKSPACE_DIR = '/tmp/cykubed/workspace'
+
+    # pool mode: how long to wait between asking for work, and how long to stay idle before exiting
+    POOL_POLL_INTERVAL: int = 5
+    POOL_IDLE_TIMEOUT: int = 1800
+
+    # number of threads used to delete large directory trees
+    FS_DELETE_WORKERS: int = 8
+
+    # kill a spec if it produces no output for this many seconds (0 to disable)
+    SPEC_OUTPUT_TIMEOUT: int = 0
+
+    # kill a spec whose processes use more than this many bytes (0 for 90% of the pod's limit)
+    SPEC_MEMORY_LIMIT: int = 0
+
+    # evict the least recently used Cypress and Playwright versions beyond this many bytes
+    FRAMEWORK_CACHE_MAX_SIZE: int = 4 * 1024 ** 3
+
+    # prune the shared package download cache (least recently used first) to this many bytes
+    PACKAGE_CACHE_MAX_SIZE: int = 10 * 1024 ** 3
+
+    # report specs that passed last time, if nothing they depend on has changed
+    RESULT_CACHE: bool = False
+    RESULT_CACHE_TTL: int = 7 * 24 * 3600
+    FORCE_RERUN: bool = False
+
+    # rerun just the failed tests in a new process, rather than retrying them in place
+    RETRY_FAILED_TESTS: bool = False
+
+    # which screenshots to upload ('all' or 'final'), and how to re-encode them
+    SCREENSHOT_POLICY: str = 'all'
+    SCREENSHOT_FORMAT: str = ''
+    SCREENSHOT_QUALITY: int = 80
+    SCREENSHOT_MAX_BYTES: int = 0
+
+    # only keep the video of a failing Cypress spec, cut down to the failing tests
+    FAILURE_VIDEO: bool = False
+    VIDEO_CLIP_PADDING: int = 5
+    VIDEO_BITRATE: str = '500k'
+
+    # send results in the background from a local spool, waiting up to SPOOL_DRAIN_TIMEOUT when we exit
+    RESULT_SPOOL: bool = False
+    SPOOL_DIR = '/tmp/cykubed/spool'
+    SPOOL_DRAIN_TIMEOUT: int = 300
+    SPOOL_MAX_BACKOFF: int = 60
+
+    # per-spec scratch directories for results and artifacts, optionally on tmpfs
+    SCRATCH_DIR = '/tmp/cykubed/scratch'
+    SCRATCH_TMPFS: bool = False
+    SCRATCH_TMPFS_MIN_FREE: int = 2 * 1024 ** 3
+    SCRATCH_MAX_SIZE: int = 0
+
+    # comma-separated <path prefix>=<upstream URL> routes for a caching proxy in front of the app's APIs
+    PROXY_ROUTES: str = ''
+    PROXY_PORT: int = 0
+    PROXY_MODE: str = 'cache'
+    PROXY_CACHE_TTL: int = 300
+    PROXY_CACHE_MAX_SIZE: int = 256 * 1024 * 1024
+    PROXY_TIMEOUT: int = 30
+
+    # stream result files of at least this many bytes into compact records
+    LEAN_RESULTS_MIN_SIZE: int = 32 * 1024 * 1024
 
     @property
     def src_dir(self):
-        return os.path.join(self.BUILD_DIR, 'src')
+        return self.SRC_DIR or os.path.join(self.BUILD_DIR, 'src')
+
+    @property
+    def app_dir(self):
+        return os.path.join(self.src_dir, self.APP_PATH) if self.APP_PATH else self.src_dir
+
+    @property
+    def package_cache(self):
+        return os.path.join(self.BUILD_DIR, 'package-cache')
 
     @property
     def yarn2_global_cache(self):
-        return f'{settings.BUILD_DIR}/yarn2-cache'
+        return os.path.join(self.package_cache, 'yarn-berry')
 
     @property
     def cached_node_modules(self):
         return f'{settings.BUILD_DIR}/node_modules'
 
-    # def get_results_dir(self):
-    #     return os.path.join(self.SCRATCH_DIR, 'results')
-    #
-    # def get_temp_dir(self):
-    #     return os.path.join(self.SCRATCH_DIR, 'tmp')
-    #
-    # def get_screenshots_folder(self):
-    #     return os.path.join(self.get_results_dir(), 'screenshots')
-    #
-    # def get_videos_folder(self):
-    #     return os.path.join(self.get_results_dir(), 'videos')
+    @property
+    def pnpm_store(self):
+        return f'{settings.BUILD_DIR}/pnpm-store'
+
+    @property
+    def cypress_cache(self):
+        return os.path.join(self.BUILD_DIR, 'cypress_cache')
+
+    @property
+    def playwright_browsers(self):
+        return os.path.join(self.BUILD_DIR, 'playwright-browsers')
+
+    @property
+    def snapshot_dir(self):
+        return os.path.join(self.BUILD_DIR, 'snapshot')
+
+    @property
+    def bundles_dir(self):
+        return os.path.join(self.src_dir, '.cykubed', 'bundles')
+
+    @property
+    def result_cache_dir(self):
+        return os.path.join(self.BUILD_DIR, 'result-cache')
+
+    @property
+    def proxy_recordings_dir(self):
+        return os.path.join(self.BUILD_DIR, 'proxy-recordings')
+
+    @property
+    def spec_durations_file(self):
+        return os.path.join(self.BUILD_DIR, 'spec-durations.json')
 
     def init_build_dirs(self):
         os.makedirs(self.BUILD_DIR, exist_ok=True)
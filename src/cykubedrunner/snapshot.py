@@ -0,0 +1,143 @@
+import hashlib
+import json
+import os
+import tarfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from cykubedrunner.common.exceptions import RunFailedException
+from cykubedrunner.fsutils import remove_tree
+from cykubedrunner.settings import settings
+from cykubedrunner.utils import logger
+
+# not needed by the runners
+EXCLUDED_DIRS = {'.git'}
+
+READ_CHUNK_SIZE = 1 << 20
+
+
+class HashingReader(object):
+    """
+    File wrapper that hashes everything read through it, so we can verify a shard as we extract it
+    """
+    def __init__(self, f):
+        self.f = f
+        self.sha = hashlib.sha256()
+
+    def read(self, size=-1):
+        data = self.f.read(size)
+        self.sha.update(data)
+        return data
+
+    def hexdigest(self) -> str:
+        # make sure we've hashed the whole file
+        while self.read(READ_CHUNK_SIZE):
+            pass
+        return self.sha.hexdigest()
+
+
+def list_workspace(root: str) -> tuple[list[str], list[tuple[int, str]]]:
+    """
+    Return the directories and the (size, path) of everything else in the workspace, relative to the root
+    """
+    dirs, files = [], []
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames[:] = [d for d in dirnames if not (dirpath == root and d in EXCLUDED_DIRS)]
+        for d in dirnames:
+            path = os.path.join(dirpath, d)
+            if os.path.islink(path):
+                files.append((0, os.path.relpath(path, root)))
+            else:
+                dirs.append(os.path.relpath(path, root))
+        for f in filenames:
+            path = os.path.join(dirpath, f)
+            files.append((os.lstat(path).st_size, os.path.relpath(path, root)))
+    return dirs, files
+
+
+def write_shard(root: str, filename: str, paths: list[str]) -> dict:
+    with tarfile.open(filename, 'w:gz', compresslevel=settings.SNAPSHOT_COMPRESS_LEVEL) as tar:
+        for path in paths:
+            tar.add(os.path.join(root, path), arcname=path, recursive=False)
+    with open(filename, 'rb') as f:
+        reader = HashingReader(f)
+        sha256 = reader.hexdigest()
+    return dict(file=os.path.basename(filename), sha256=sha256, files=len(paths))
+
+
+def create_snapshot():
+    """
+    Write the workspace as a set of compressed tar shards of roughly equal size, plus a manifest, so the
+    runners can extract it in parallel
+    """
+    t = time.time()
+    remove_tree(settings.snapshot_dir)
+    os.makedirs(settings.snapshot_dir)
+
+    dirs, files = list_workspace(settings.src_dir)
+    # largest first, each into the emptiest shard
+    sizes = [0] * settings.SNAPSHOT_SHARDS
+    shard_paths = [[] for _ in range(settings.SNAPSHOT_SHARDS)]
+    for size, path in sorted(files, reverse=True):
+        i = sizes.index(min(sizes))
+        sizes[i] += size
+        shard_paths[i].append(path)
+    shard_paths = [paths for paths in shard_paths if paths]
+    # directory entries go in the first shard, so permissions and empty directories are preserved
+    if shard_paths:
+        shard_paths[0] = dirs + shard_paths[0]
+    else:
+        shard_paths = [dirs]
+
+    with ThreadPoolExecutor(max_workers=len(shard_paths)) as executor:
+        entries = list(executor.map(
+            lambda x: write_shard(settings.src_dir, os.path.join(settings.snapshot_dir, f'shard-{x[0]}.tar.gz'), x[1]),
+            enumerate(shard_paths)))
+
+    manifest = dict(shards=entries,
+                    files=len(files),
+                    bytes=sum(size for size, path in files))
+    with open(os.path.join(settings.snapshot_dir, 'manifest.json'), 'w') as f:
+        f.write(json.dumps(manifest, indent=2))
+    logger.info(f'Created workspace snapshot of {len(files)} files in {time.time() - t:.1f}s')
+
+
+def extract_shard(filename: str, dest: str) -> str:
+    with open(filename, 'rb') as f:
+        reader = HashingReader(f)
+        with tarfile.open(fileobj=reader, mode='r|gz') as tar:
+            if hasattr(tarfile, 'tar_filter'):
+                tar.extractall(dest, filter='tar')
+            else:
+                tar.extractall(dest)
+        return reader.hexdigest()
+
+
+def snapshot_exists() -> bool:
+    return os.path.exists(os.path.join(settings.snapshot_dir, 'manifest.json'))
+
+
+def extract_snapshot(dest: str) -> float:
+    """
+    Extract the workspace snapshot to local disk in parallel, verifying each shard against the manifest.
+    Returns the time taken
+    """
+    t = time.time()
+    with open(os.path.join(settings.snapshot_dir, 'manifest.json')) as f:
+        manifest = json.loads(f.read())
+
+    remove_tree(dest)
+    os.makedirs(dest)
+    shards = manifest['shards']
+    with ThreadPoolExecutor(max_workers=len(shards)) as executor:
+        digests = list(executor.map(
+            lambda shard: extract_shard(os.path.join(settings.snapshot_dir, shard['file']), dest), shards))
+
+    for shard, digest in zip(shards, digests):
+        if shard['sha256'] != digest:
+            raise RunFailedException(f'Workspace snapshot shard {shard["file"]} is corrupt')
+
+    t = time.time() - t
+    logger.info(f'Extracted workspace snapshot of {manifest["files"]} files '
+                f'({manifest["bytes"] / 1e6:.0f}MB) in {t:.1f}s')
+    return t
@@ -0,0 +1,194 @@
+import json
+import os
+import queue
+import shutil
+import threading
+import time
+import uuid
+
+import loguru
+
+from cykubedrunner import lean
+from cykubedrunner.app import app
+from cykubedrunner.artifacts import ScreenshotUpload
+from cykubedrunner.common.schemas import SpecTests
+from cykubedrunner.common.utils import utcnow
+from cykubedrunner.settings import settings
+from cykubedrunner.utils import logger, upload_files, get_spec_completed_extra
+
+
+# ASCII, so it's encoded the same way whichever JSON encoder wrote the result
+ARTIFACT_PLACEHOLDER = 'spool-artifact:'
+
+
+def copy_artifact(path: str, destdir: str) -> str:
+    """
+    Keep our own copy of an artifact: a hard link if we can
+    """
+    os.makedirs(destdir, exist_ok=True)
+    dest = os.path.join(destdir, f'{uuid.uuid4().hex[:8]}-{os.path.basename(path)}')
+    try:
+        os.link(path, dest)
+    except OSError:
+        shutil.copyfile(path, dest)
+    return dest
+
+
+class Spool(object):
+    """
+    Results waiting to be sent. Each is recorded in an append-only journal (along with a copy of its
+    artifacts) and then sent by a background thread, retrying with backoff until it succeeds. A result
+    that was spooled but not sent (e.g if the process was restarted) is sent when we next start
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        # specs may be run in parallel, and only one of them should start the sender
+        self.start_lock = threading.Lock()
+        self.thread: threading.Thread = None
+        self.reset()
+
+    def reset(self):
+        """
+        Stop sending, so a pooled runner can start afresh. Anything not yet sent is still in the journal, and is
+        sent when the spool is next started
+        """
+        if self.thread and self.thread.is_alive():
+            self.stopping.set()
+            self.queue.put(None)
+            self.thread.join()
+        self.queue = queue.Queue()
+        self.stopping = threading.Event()
+        self.thread = None
+
+    @property
+    def journal(self) -> str:
+        return os.path.join(settings.SPOOL_DIR, 'journal.jsonl')
+
+    def append(self, record: dict):
+        with self.lock:
+            with open(self.journal, 'a') as f:
+                f.write(json.dumps(record) + '\n')
+                f.flush()
+                os.fsync(f.fileno())
+
+    def load(self) -> list[dict]:
+        """
+        Return the entries in the journal that haven't been sent, and rewrite it with just those
+        """
+        if not os.path.exists(self.journal):
+            return []
+        entries = dict()
+        with open(self.journal) as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # a partial write
+                    continue
+                if record.get('done'):
+                    entries.pop(record['id'], None)
+                else:
+                    entries[record['id']] = record
+        tmpfile = f'{self.journal}.tmp'
+        with open(tmpfile, 'w') as f:
+            for record in entries.values():
+                f.write(json.dumps(record) + '\n')
+        os.replace(tmpfile, self.journal)
+        return list(entries.values())
+
+    def start(self):
+        with self.start_lock:
+            if self.thread and self.thread.is_alive():
+                return
+            os.makedirs(settings.SPOOL_DIR, exist_ok=True)
+            # don't rewrite the journal while another thread is appending to it
+            with self.lock:
+                pending = self.load()
+            if pending:
+                logger.info(f'Sending {len(pending)} results from a previous run')
+            for record in pending:
+                self.queue.put(record)
+            self.thread = threading.Thread(target=self.send_loop, args=(self.queue, self.stopping), daemon=True,
+                                           name='spool')
+            self.thread.start()
+
+    def add(self, spec: str, specresult: SpecTests, cached=False, usage: dict = None):
+        """
+        Spool the results for a spec, and return immediately
+        """
+        self.start()
+        entry_id = uuid.uuid4().hex
+        artifacts = os.path.join(settings.SPOOL_DIR, entry_id)
+        # the result refers to the artifacts by placeholders, which are replaced by their URLs once uploaded
+        screenshots = ScreenshotUpload(specresult)
+        placeholders = [f'{ARTIFACT_PLACEHOLDER}{entry_id}/{i}' for i in range(len(screenshots.files))]
+        screenshots.set_urls(placeholders)
+        video = None
+        if specresult.video:
+            video = copy_artifact(specresult.video, artifacts)
+            specresult.video = f'{ARTIFACT_PLACEHOLDER}{entry_id}/video'
+
+        record = dict(id=entry_id, trid=app.trid, spec=spec, cached=cached, usage=usage,
+                      screenshots=[copy_artifact(x, artifacts) for x in screenshots.files], video=video,
+                      result=specresult.json())
+        self.append(record)
+        self.queue.put(record)
+
+    def send(self, record: dict):
+        """
+        Upload the artifacts and post the journalled result, without parsing it again
+        """
+        result = record['result']
+        if record['screenshots']:
+            urls = upload_files([('files', open(x, 'rb')) for x in record['screenshots']], record['trid'])
+            for i, url in enumerate(urls):
+                result = result.replace(json.dumps(f'{ARTIFACT_PLACEHOLDER}{record["id"]}/{i}'), json.dumps(url))
+        video = None
+        if record['video']:
+            video = upload_files([('files', open(record['video'], 'rb'))], record['trid'])[0]
+            result = result.replace(json.dumps(f'{ARTIFACT_PLACEHOLDER}{record["id"]}/video'), json.dumps(video))
+
+        content = lean.encode_spec_completed(record['spec'], utcnow(), [result], video,
+                                             **get_spec_completed_extra(record['cached'], record.get('usage')))
+        app.post('spec-completed', trid=record['trid'], content=content.encode())
+        self.append(dict(id=record['id'], done=True))
+        shutil.rmtree(os.path.join(settings.SPOOL_DIR, record['id']), ignore_errors=True)
+
+    def send_loop(self, records: queue.Queue, stopping: threading.Event):
+        backoff = 1
+        while not stopping.is_set():
+            record = records.get()
+            if record is None:
+                records.task_done()
+                break
+            try:
+                self.send(record)
+                backoff = 1
+            except Exception as ex:
+                # just log locally: the API is probably down
+                loguru.logger.warning(f'Failed to send results for {record["spec"]}: {ex}: '
+                                      f'retrying in {backoff}s')
+                stopping.wait(backoff)
+                backoff = min(backoff * 2, settings.SPOOL_MAX_BACKOFF)
+                # to the back of the queue, so one bad result doesn't hold up the rest
+                records.put(record)
+            finally:
+                records.task_done()
+
+    def drain(self, timeout: float) -> bool:
+        """
+        Wait for the spool to empty. Returns False if there are still results to send
+        """
+        deadline = time.time() + timeout
+        with self.queue.all_tasks_done:
+            while self.queue.unfinished_tasks:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    loguru.logger.error(f'Timed out sending results: {self.queue.unfinished_tasks} '
+                                        f'left in the spool')
+                    return False
+                self.queue.all_tasks_done.wait(remaining)
+        return True
+
+
+spool = Spool()
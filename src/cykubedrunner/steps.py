@@ -0,0 +1,78 @@
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from typing import Callable, Any
+
+from cykubedrunner.common.exceptions import BuildFailedException
+from cykubedrunner.utils import logger, cancel_commands, reset_cancelled_commands
+
+
+class BuildStep(object):
+    """
+    A unit of work in the build, which can start once all the steps it requires have completed
+    """
+    def __init__(self, name: str, fn: Callable[[], Any], requires: list['BuildStep'] = None):
+        self.name = name
+        self.fn = fn
+        self.requires = requires or []
+        self.result = None
+        self.duration: float = None
+
+    def __call__(self):
+        # the thread may have run another step's commands
+        logger.clear_step()
+        t = time.time()
+        try:
+            self.result = self.fn()
+        finally:
+            self.duration = time.time() - t
+            logger.clear_step()
+        return self.result
+
+    def __repr__(self):
+        return f'BuildStep({self.name})'
+
+
+def run_steps(steps: list[BuildStep], concurrency: int) -> dict[str, float]:
+    """
+    Run the steps, each as soon as its dependencies have completed and with at most `concurrency` at a time.
+    If a step fails no more are started, any commands still running are killed and the exception is re-raised.
+
+    Returns the time taken for each step
+    """
+    for step in steps:
+        for dep in step.requires:
+            if dep not in steps:
+                raise BuildFailedException(f'Build step {step.name} requires unknown step {dep.name}')
+
+    pending = list(steps)
+    completed = set()
+    running = dict()
+
+    try:
+        with ThreadPoolExecutor(max_workers=max(1, concurrency), thread_name_prefix='build') as executor:
+            try:
+                while pending or running:
+                    for step in [s for s in pending if all(d in completed for d in s.requires)]:
+                        pending.remove(step)
+                        running[executor.submit(step)] = step
+
+                    if not running:
+                        raise BuildFailedException(f'Circular dependency in build steps: {pending}')
+
+                    finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                    for future in finished:
+                        step = running.pop(future)
+                        # re-raises any failure
+                        future.result()
+                        completed.add(step)
+                        logger.debug(f'Build step {step.name} completed in {step.duration:.1f}s')
+            except BaseException:
+                # fail fast: don't start anything new and stop what's running
+                for future in running:
+                    future.cancel()
+                cancel_commands()
+                raise
+    finally:
+        reset_cancelled_commands()
+
+    return {step.name: step.duration for step in steps}
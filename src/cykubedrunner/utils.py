@@ -2,12 +2,14 @@ import os
 import shlex
 import subprocess
 import sys
+import threading
 import traceback
 
 import httpx
 import loguru
 from tenacity import retry, retry_if_not_exception_type, stop_after_attempt, wait_fixed, wait_random
 
+from cykubedrunner import codec, lean
 from cykubedrunner.app import app
 from cykubedrunner.common import schemas
 from cykubedrunner.common.enums import loglevelToInt, LogLevel, AgentEventType
@@ -25,16 +27,40 @@ def get_git_sha(testrun: NewTestRun):
 
 def get_env_and_args(args: str, node=False, **kwargs):
     cmdenv = os.environ.copy()
-    cmdenv['CYPRESS_CACHE_FOLDER'] = f'{settings.BUILD_DIR}/cypress_cache'
+    cmdenv['CYPRESS_CACHE_FOLDER'] = settings.cypress_cache
     if 'path' in kwargs:
         cmdenv['PATH'] = kwargs['path']+':'+cmdenv['PATH']
     else:
-        cmdenv['PATH'] = f'{settings.src_dir}/node_modules/.bin:' + os.environ['PATH']
-    if node and app.is_yarn and not args.startswith('yarn '):
+        # in a monorepo the binaries may be in the app's workspace or hoisted to the root
+        bindirs = [f'{wdir}/node_modules/.bin' for wdir in dict.fromkeys([settings.app_dir, settings.src_dir])]
+        cmdenv['PATH'] = ':'.join(bindirs + [os.environ['PATH']])
+    if app.proxy_url:
+        cmdenv['CYKUBED_PROXY_URL'] = app.proxy_url
+    if node and app.is_pnpm and not args.startswith('pnpm '):
+        args = f'pnpm exec {args}'
+    elif node and app.is_yarn and not args.startswith('yarn '):
         args = f'yarn run {args}'
     return cmdenv, args
 
 
+# long-running commands (i.e runcmd with cmd=True), so that a failed build step can stop the others
+running_commands: set[subprocess.Popen] = set()
+commands_cancelled = threading.Event()
+
+
+def cancel_commands():
+    """
+    Kill any running commands, and refuse to start any more until reset_cancelled_commands is called
+    """
+    commands_cancelled.set()
+    for proc in list(running_commands):
+        kill_process_tree(proc)
+
+
+def reset_cancelled_commands():
+    commands_cancelled.clear()
+
+
 def runcmd(args: str, cmd=False, env=None, log=False, node=False, **kwargs):
     cmdenv, args = get_env_and_args(args, node, **kwargs)
 
@@ -51,27 +77,37 @@ def runcmd(args: str, cmd=False, env=None, log=False, node=False, **kwargs):
             logger.error(f"Command failed: {result.returncode}: {result.stderr}")
             raise BuildFailedException(msg=f'Command failed: {result.stderr}', status_code=result.returncode)
     else:
+        if commands_cancelled.is_set():
+            raise BuildFailedException(msg='Command cancelled')
         logger.cmd(args)
         with subprocess.Popen(shlex.split(args), env=cmdenv, encoding=settings.ENCODING,
                               stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
                               **kwargs) as proc:
-            while True:
-                line = proc.stdout.readline()
-                if not line and proc.returncode is not None:
-                    break
-                if line:
-                    logger.cmdout(line)
-                proc.poll()
-
+            running_commands.add(proc)
+            if commands_cancelled.is_set():
+                # cancelled while we were starting it
+                kill_process_tree(proc)
+            try:
+                while True:
+                    line = proc.stdout.readline()
+                    if not line and proc.returncode is not None:
+                        break
+                    if line:
+                        logger.cmdout(line)
+                    proc.poll()
+            finally:
+                running_commands.discard(proc)
+
+            if commands_cancelled.is_set():
+                raise BuildFailedException(msg='Command cancelled', status_code=proc.returncode)
             if proc.returncode:
                 logger.error(f"Command failed: error code {proc.returncode}")
                 raise BuildFailedException(msg='Command failed', status_code=proc.returncode)
-    os.sync()
     return result
 
 
 def send_agent_event(event: AgentEvent):
-    r = app.post('/event', content=event.json())
+    r = app.post('/event', content=codec.encode_model(event))
     if r.status_code != 200:
         raise BuildFailedException('Failed to send event to server')
 
@@ -79,21 +115,40 @@ def send_agent_event(event: AgentEvent):
 def log_build_failed_exception(ex: BuildFailedException):
     # tell the agent
     app.post('error',
-             content=TestRunErrorReport(msg=ex.msg, stage=ex.stage, error_code=ex.status_code).json())
+             content=codec.encode_model(TestRunErrorReport(msg=ex.msg, stage=ex.stage,
+                                                           error_code=ex.status_code)))
 
 
 class TestRunLogger:
     def __init__(self):
         self.testrun_id = None
         self.source = None
-        self.step = 0
+        self.lock = threading.Lock()
+        self.init_steps()
         self.level = loglevelToInt[LogLevel.info]
 
     def init(self, testrun_id: int, source: str, level: LogLevel = LogLevel.info):
         self.testrun_id = testrun_id
         self.source = source
+        self.init_steps()
         self.level = loglevelToInt[level]
 
+    def init_steps(self):
+        # each command is a new step, and build steps run commands concurrently: so the output of each is
+        # logged against the step of the last command run by the same thread
+        self.last_step = 0
+        self.local = threading.local()
+
+    @property
+    def step(self) -> int:
+        return getattr(self.local, 'step', self.last_step)
+
+    def clear_step(self):
+        """
+        Stop logging against the last command run by this thread, e.g when it goes on to another build step
+        """
+        self.local.__dict__.pop('step', None)
+
     def log(self, msg: str, level: LogLevel):
         if level == LogLevel.cmd:
             loguru_level = 'info'
@@ -118,17 +173,20 @@ class TestRunLogger:
                                                 msg=msg,
                                                 step=self.step,
                                                 source=self.source))
+            content = codec.encode_model(event)
             if settings.AGENT_URL:
                 # via the agent websocket
-                r = httpx.post(f'{settings.AGENT_URL}/log', content=event.json())
+                r = httpx.post(f'{settings.AGENT_URL}/log', content=content)
             else:
                 # direct to the server
-                r = app.post('log', content=event.json())
+                r = app.post('log', content=content)
             if r.status_code != 200:
                 loguru.logger.warning('Failed to send log message')
 
     def cmd(self, msg: str):
-        self.step += 1
+        with self.lock:
+            self.last_step += 1
+            self.local.step = self.last_step
         self.log(msg, LogLevel.cmd)
 
     def cmdout(self, msg: str):
@@ -164,9 +222,9 @@ def root_file_exists(name):
 @retry(retry=retry_if_not_exception_type(RunFailedException),
        stop=stop_after_attempt(settings.MAX_HTTP_RETRIES if not settings.TEST else 1),
        wait=wait_fixed(2) + wait_random(0, 4))
-def upload_files(files) -> list[str]:
-    resp = app.post('upload-artifacts', files=files)
-    return resp.json()['urls']
+def upload_files(files, trid: int = None) -> list[str]:
+    resp = app.post('upload-artifacts', trid=trid, files=files)
+    return codec.loads(resp.content)['urls']
 
 
 def all_results_with_screenshots_generator(specresult: SpecTests):
@@ -176,32 +234,73 @@ def all_results_with_screenshots_generator(specresult: SpecTests):
                 yield result
 
 
-def upload_results(spec: str, specresult: SpecTests):
-    files = []
+def upload_results(spec: str, specresult: SpecTests, cached=False, usage: dict = None):
+    if settings.RESULT_SPOOL:
+        # the spool uses send_results
+        from cykubedrunner.spool import spool
+        spool.add(spec, specresult, cached, usage)
+    else:
+        send_results(spec, specresult, cached, usage=usage)
 
-    for result in all_results_with_screenshots_generator(specresult):
-        for sshot in result.failure_screenshots:
-            files.append(('files', open(sshot, 'rb')))
 
-    if files:
-        urls = upload_files(files)
-        for result in all_results_with_screenshots_generator(specresult):
-            num = len(result.failure_screenshots)
-            result.failure_screenshots = urls[:num]
-            urls = urls[num:]
+def get_spec_completed_extra(cached: bool, usage: dict | None) -> dict:
+    """
+    The fields we send alongside those of AgentSpecCompleted
+    """
+    extra = dict()
+    if cached:
+        extra['cached'] = True
+    if usage:
+        extra['usage'] = usage
+    return extra
 
-    msg = AgentSpecCompleted(
-        result=specresult,
-        file=spec,
-        finished=utcnow())
 
-    logger.debug(f'Uploading results: {msg.json()}')
+def send_results(spec: str, specresult: SpecTests, cached=False, trid: int = None, usage: dict = None):
+    """
+    Upload the artifacts and post the results. `usage` is the memory and CPU used to run the spec
+    """
+    # artifacts uses our logger
+    from cykubedrunner.artifacts import ScreenshotUpload
 
+    screenshots = ScreenshotUpload(specresult)
+    if screenshots.files:
+        urls = upload_files([('files', open(sshot, 'rb')) for sshot in screenshots.files], trid)
+        screenshots.set_urls(urls)
+
+    video = None
     if specresult.video:
-        urls = upload_files([('files', open(specresult.video, 'rb'))])
-        msg.video = urls[0]
+        urls = upload_files([('files', open(specresult.video, 'rb'))], trid)
+        video = urls[0]
+
+    extra = get_spec_completed_extra(cached, usage)
+    if lean.is_lean(specresult):
+        # serialised directly, as building the schema for a huge spec takes too much memory
+        content = specresult.spec_completed_json(spec, utcnow(), video, **extra)
+        logger.debug(f'Uploading results for {len(specresult.tests)} tests')
+    else:
+        msg = AgentSpecCompleted(
+            result=specresult,
+            file=spec,
+            finished=utcnow(),
+            video=video)
+        content = codec.encode_model(msg, **extra)
+        logger.debug(f'Uploading results: {content.decode()}')
+    app.post('spec-completed', trid=trid, content=content)
+
 
-    app.post('spec-completed', content=msg.json())
+def kill_process_tree(proc: subprocess.Popen):
+    """
+    Kill a process and all its children
+    """
+    import psutil
+
+    try:
+        parent = psutil.Process(proc.pid)
+        for child in parent.children(recursive=True):
+            child.kill()
+    except psutil.NoSuchProcess:
+        pass
+    proc.kill()
 
 
 def default_sigterm_runner(signum, frame):
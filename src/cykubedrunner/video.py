@@ -0,0 +1,51 @@
+import os
+import shutil
+import subprocess
+
+from cykubedrunner.settings import settings
+from cykubedrunner.utils import logger
+
+
+def merge_windows(windows: list[tuple[float, float]]) -> list[tuple[float, float]]:
+    """
+    Pad the (start, end) windows around each failing test, and merge any that overlap
+    """
+    merged = []
+    for start, end in sorted(windows):
+        start, end = max(0.0, start - settings.VIDEO_CLIP_PADDING), end + settings.VIDEO_CLIP_PADDING
+        if merged and start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+
+def get_ffmpeg_args(video: str, outfile: str, windows: list[tuple[float, float]]) -> list[str]:
+    args = ['ffmpeg', '-y', '-loglevel', 'error', '-i', video]
+    if windows:
+        # keep just the frames in the windows, and close up the gaps
+        select = '+'.join(f'between(t,{start:.2f},{end:.2f})' for start, end in windows)
+        args += ['-vf', f"select='{select}',setpts=N/FRAME_RATE/TB"]
+    bitrate = settings.VIDEO_BITRATE
+    return args + ['-an', '-c:v', 'libx264', '-preset', 'veryfast', '-b:v', bitrate, '-maxrate', bitrate,
+                   '-bufsize', bitrate, outfile]
+
+
+def make_failure_clip(video: str, windows: list[tuple[float, float]]) -> str:
+    """
+    Cut the video down to the failing tests (if we know when they ran) and transcode it at a bounded bitrate.
+    If we can't, just return the original
+    """
+    if not shutil.which('ffmpeg'):
+        logger.warning('ffmpeg is not installed: uploading the full video')
+        return video
+
+    outfile = f'{os.path.splitext(video)[0]}.clip.mp4'
+    args = get_ffmpeg_args(video, outfile, merge_windows(windows))
+    result = subprocess.run(args, capture_output=True, text=True)
+    if result.returncode or not os.path.exists(outfile):
+        logger.warning(f'Failed to create video clip: {result.stderr}')
+        return video
+    logger.debug(f'Created video clip of {os.path.getsize(outfile)} bytes from {os.path.getsize(video)}')
+    os.remove(video)
+    return outfile
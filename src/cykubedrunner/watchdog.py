@@ -0,0 +1,135 @@
+import threading
+import time
+from contextlib import contextmanager
+
+import psutil
+
+from cykubedrunner.resources import get_memory_limit
+from cykubedrunner.settings import settings
+
+MB = 1024 * 1024
+
+
+class ResourceUsage(object):
+    """
+    The peak memory (RSS) and CPU (percent of a CPU), the total CPU time (in seconds) and the bytes written
+    to scratch space used by a spec
+    """
+    def __init__(self, peak_rss: int = 0, peak_cpu: float = 0.0, cpu_time: float = 0.0, scratch_bytes: int = 0):
+        self.peak_rss = peak_rss
+        self.peak_cpu = peak_cpu
+        self.cpu_time = cpu_time
+        self.scratch_bytes = scratch_bytes
+
+    def add(self, other: 'ResourceUsage'):
+        self.peak_rss = max(self.peak_rss, other.peak_rss)
+        self.peak_cpu = max(self.peak_cpu, other.peak_cpu)
+        self.cpu_time += other.cpu_time
+        self.scratch_bytes += other.scratch_bytes
+
+    def dict(self) -> dict:
+        return dict(peak_rss=self.peak_rss, peak_cpu=round(self.peak_cpu, 1), cpu_time=round(self.cpu_time, 1),
+                    scratch_bytes=self.scratch_bytes)
+
+
+class ProcessWatchdog(object):
+    """
+    Sample the memory and CPU used by a process and all its children (i.e the test framework and the browser)
+    """
+    def __init__(self, pid: int):
+        self.pid = pid
+        self.usage = ResourceUsage()
+        # the CPU time of every process we've seen, so we still count those that have exited
+        self.cpu_times: dict[tuple[int, float], float] = dict()
+        self.last_sample: tuple[float, float] = None
+
+    def sample(self) -> int:
+        """
+        Return the total RSS of the process tree
+        """
+        try:
+            root = psutil.Process(self.pid)
+            processes = [root] + root.children(recursive=True)
+        except psutil.NoSuchProcess:
+            return 0
+
+        rss = 0
+        for process in processes:
+            try:
+                with process.oneshot():
+                    rss += process.memory_info().rss
+                    times = process.cpu_times()
+                    self.cpu_times[(process.pid, process.create_time())] = times.user + times.system
+            except (psutil.NoSuchProcess, psutil.AccessDenied):
+                pass
+
+        now, cpu_time = time.monotonic(), sum(self.cpu_times.values())
+        if self.last_sample and now > self.last_sample[0]:
+            cpu = 100 * (cpu_time - self.last_sample[1]) / (now - self.last_sample[0])
+            self.usage.peak_cpu = max(self.usage.peak_cpu, cpu)
+        self.last_sample = (now, cpu_time)
+        self.usage.cpu_time = cpu_time
+        self.usage.peak_rss = max(self.usage.peak_rss, rss)
+        return rss
+
+
+class RunningSpecs(object):
+    """
+    The number of spec processes running at once, which share the pod's memory
+    """
+    def __init__(self):
+        self.count = 0
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def track(self):
+        with self.lock:
+            self.count += 1
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.count -= 1
+
+
+running_specs = RunningSpecs()
+
+
+def get_spec_memory_limit() -> int | None:
+    """
+    Return the most memory a spec's process tree can use before we kill it: if not set, we leave a little
+    headroom below the pod's limit so the runner survives, and share it between the specs running at once
+    """
+    if settings.SPEC_MEMORY_LIMIT:
+        return settings.SPEC_MEMORY_LIMIT
+    limit = get_memory_limit()
+    return int(limit * 0.9) // max(running_specs.count, 1) if limit else None
+
+
+class SpecUsage(object):
+    """
+    The resources used to run each spec (over all browsers and reruns), until they're reported
+    """
+    def __init__(self):
+        self.usage: dict[str, ResourceUsage] = dict()
+        self.lock = threading.Lock()
+
+    def record(self, specs: list[str], usage: ResourceUsage):
+        """
+        Specs run in a batch share a process, so each gets the usage of the whole batch
+        """
+        with self.lock:
+            for spec in specs:
+                self.usage.setdefault(spec, ResourceUsage()).add(usage)
+
+    def reset(self):
+        with self.lock:
+            self.usage = dict()
+
+    def pop(self, spec: str) -> dict | None:
+        with self.lock:
+            usage = self.usage.pop(spec, None)
+        return usage.dict() if usage else None
+
+
+spec_usage = SpecUsage()
@@ -0,0 +1,85 @@
+"""
+Monorepo workspaces: we only check out and install the app's workspace and the workspaces it depends on
+"""
+import json
+import os
+from typing import Callable
+
+DEPENDENCY_KEYS = ['dependencies', 'devDependencies', 'peerDependencies', 'optionalDependencies']
+
+
+def parse_json(source: str | None) -> dict:
+    try:
+        result = json.loads(source) if source else dict()
+    except ValueError:
+        return dict()
+    return result if isinstance(result, dict) else dict()
+
+
+def get_workspace_globs(files: set[str], read: Callable[[str], str]) -> list[str]:
+    """
+    Return the workspace globs declared in the root package.json (npm and Yarn) or pnpm-workspace.yaml
+    """
+    if 'pnpm-workspace.yaml' in files:
+        import yaml
+
+        globs = (yaml.safe_load(read('pnpm-workspace.yaml')) or dict()).get('packages', [])
+    else:
+        globs = parse_json(read('package.json') if 'package.json' in files else None).get('workspaces') or []
+        if isinstance(globs, dict):
+            # Yarn 1 also allows {"packages": [...], "nohoist": [...]}
+            globs = globs.get('packages', [])
+    return [glob.strip().removeprefix('./').rstrip('/') for glob in globs]
+
+
+def get_workspace_paths(app_path: str, files: list[str], read: Callable[[str], str]) -> list[str]:
+    """
+    Return the app's workspace and the workspaces it depends on (transitively), given the files in the
+    repository and a way to read them
+    """
+    from wcmatch import glob
+
+    app_path = app_path.strip('/')
+    files = set(files)
+    globs = get_workspace_globs(files, read)
+    if not globs:
+        return [app_path]
+
+    # map the package names to their workspace
+    workspaces = dict()
+    manifests = dict()
+    for path in sorted(files):
+        wdir = os.path.dirname(path)
+        if os.path.basename(path) == 'package.json' and wdir and \
+                glob.globmatch(wdir, globs, flags=glob.GLOBSTAR | glob.NEGATE):
+            manifest = parse_json(read(path))
+            manifests[wdir] = manifest
+            if manifest.get('name'):
+                workspaces[manifest['name']] = wdir
+
+    if app_path not in manifests:
+        manifests[app_path] = parse_json(read(f'{app_path}/package.json')
+                                         if f'{app_path}/package.json' in files else None)
+
+    found = [app_path]
+    pending = [app_path]
+    while pending:
+        manifest = manifests.get(pending.pop(), dict())
+        for key in DEPENDENCY_KEYS:
+            for name in manifest.get(key) or dict():
+                wdir = workspaces.get(name)
+                if wdir and wdir not in found:
+                    found.append(wdir)
+                    pending.append(wdir)
+    return found
+
+
+def get_workspace_name(wdir: str) -> str | None:
+    """
+    Return the package name of a workspace, which is what the package managers use to select it
+    """
+    try:
+        with open(os.path.join(wdir, 'package.json')) as f:
+            return parse_json(f.read()).get('name')
+    except OSError:
+        return None
@@ -13,6 +13,7 @@ from cykubedrunner.app import app
 from cykubedrunner.common.enums import PlatformEnum
 from cykubedrunner.common.schemas import Project, NewTestRun, AgentLogMessage, TestRunBuildState
 from cykubedrunner.settings import settings
+from cykubedrunner.utils import logger as testrun_logger
 
 
 @pytest.fixture(autouse=True)
@@ -20,6 +21,9 @@ def initdb():
     settings.TEST = True
     settings.BUILD_DIR = tempfile.mkdtemp()
     logger.remove()
+    # don't post logs for a test run from an earlier test
+    testrun_logger.init(None, source='test')
+    app.reset()
     yield
     shutil.rmtree(settings.BUILD_DIR)
 
@@ -0,0 +1,75 @@
+import os
+
+from cykubedrunner.artifacts import ScreenshotUpload, get_attempt
+from cykubedrunner.common.enums import TestResultStatus
+from cykubedrunner.common.schemas import SpecTests, SpecTest, TestResult
+from cykubedrunner.settings import settings
+
+
+def make_screenshot(name: str, content: bytes) -> str:
+    path = os.path.join(settings.BUILD_DIR, name)
+    with open(path, 'wb') as f:
+        f.write(content)
+    return path
+
+
+def make_result(browser: str, screenshots: list[str], retry: int = 0) -> TestResult:
+    return TestResult(browser=browser, status=TestResultStatus.failed, retry=retry, failure_screenshots=screenshots)
+
+
+def make_spec(results: list[TestResult]) -> SpecTests:
+    return SpecTests(tests=[SpecTest(title='fails', status=TestResultStatus.failed, results=results)])
+
+
+def test_get_attempt():
+    assert get_attempt('suite -- fails (failed).png') == 1
+    assert get_attempt('suite -- fails (failed) (attempt 3).png') == 3
+
+
+def test_dedup_screenshots():
+    first = make_screenshot('suite -- fails (failed).png', b'one')
+    second = make_screenshot('suite -- fails (failed) (attempt 2).png', b'two')
+    same_as_first = make_screenshot('firefox -- fails (failed).png', b'one')
+
+    results = [make_result('electron', [first, second]), make_result('firefox', [same_as_first])]
+    upload = ScreenshotUpload(make_spec(results))
+
+    assert upload.files == [first, second]
+    upload.set_urls(['http://first', 'http://second'])
+    assert results[0].failure_screenshots == ['http://first', 'http://second']
+    assert results[1].failure_screenshots == ['http://first']
+
+
+def test_keep_final_screenshot():
+    first = make_screenshot('suite -- fails (failed).png', b'one')
+    second = make_screenshot('suite -- fails (failed) (attempt 2).png', b'two')
+    settings.SCREENSHOT_POLICY = 'final'
+    try:
+        results = [make_result('electron', [second, first])]
+        upload = ScreenshotUpload(make_spec(results))
+    finally:
+        settings.SCREENSHOT_POLICY = 'all'
+
+    assert upload.files == [second]
+    upload.set_urls(['http://second'])
+    assert results[0].failure_screenshots == ['http://second']
+
+
+def test_keep_final_attempt_screenshot():
+    """
+    Playwright (and a rerun) gives each attempt its own result
+    """
+    first = make_screenshot('test-failed-1.png', b'one')
+    second = make_screenshot('test-retry1-failed-1.png', b'two')
+    other_browser = make_screenshot('firefox-failed-1.png', b'three')
+    settings.SCREENSHOT_POLICY = 'final'
+    try:
+        results = [make_result('chromium', [second], retry=1), make_result('chromium', [first]),
+                   make_result('firefox', [other_browser])]
+        upload = ScreenshotUpload(make_spec(results))
+    finally:
+        settings.SCREENSHOT_POLICY = 'all'
+
+    assert upload.files == [second, other_browser]
+    upload.set_urls(['http://second', 'http://firefox'])
+    assert [r.failure_screenshots for r in results] == [['http://second'], [], ['http://firefox']]
@@ -0,0 +1,208 @@
+import os
+import subprocess
+import time
+
+import pytest
+
+from cykubedrunner.app import app
+from cykubedrunner.baserunner import SpecInterrupted, SpecOutOfMemory, merge_rerun, get_failed_tests, \
+    OUT_OF_MEMORY_TITLE
+from cykubedrunner.common.enums import TestResultStatus
+from cykubedrunner.common.schemas import SpecTests, SpecTest, TestResult
+from cykubedrunner.cypress import CypressSpecRunner
+from cykubedrunner.durations import spec_durations
+from cykubedrunner.playwright import PlaywrightSpecRunner
+from cykubedrunner.runner import run_specs
+from cykubedrunner.settings import settings
+from cykubedrunner.watchdog import spec_usage
+
+
+@pytest.fixture
+def sleeper(mocker, testrun):
+    def create(seconds: int):
+        runner = PlaywrightSpecRunner(None, testrun, 'example.spec.ts')
+        mocker.patch.object(runner, 'get_args', return_value=['sleep', str(seconds)])
+        mocker.patch.object(runner, 'get_env', return_value=dict())
+        return runner
+    yield create
+    app.terminate_by = None
+
+
+def test_create_process(sleeper):
+    settings.init_build_dirs()
+    result = sleeper(0).create_process()
+    assert result.returncode == 0
+
+
+def test_spec_deadline(sleeper, testrun):
+    settings.init_build_dirs()
+    testrun.project.spec_deadline = 1
+    with pytest.raises(subprocess.TimeoutExpired):
+        sleeper(30).create_process()
+
+
+def test_spot_termination_budget_exceeded(sleeper):
+    """
+    If the spec can't complete before the spot termination deadline then it's interrupted
+    """
+    settings.init_build_dirs()
+    app.terminate_by = time.time() + 1
+    t = time.time()
+    with pytest.raises(SpecInterrupted):
+        sleeper(30).create_process()
+    assert time.time() - t < 10
+
+
+def test_spot_termination_no_time_left(sleeper):
+    settings.init_build_dirs()
+    app.terminate_by = time.time() - 1
+    with pytest.raises(SpecInterrupted):
+        sleeper(0).create_process()
+
+
+def test_no_output_watchdog(sleeper, monkeypatch):
+    settings.init_build_dirs()
+    monkeypatch.setattr(settings, 'SPEC_OUTPUT_TIMEOUT', 1)
+    t = time.time()
+    with pytest.raises(subprocess.TimeoutExpired):
+        sleeper(30).create_process()
+    assert time.time() - t < 10
+
+
+def test_sigterm_kills_spec(sleeper, mocker):
+    """
+    The SystemExit from the SIGTERM handler doesn't wait for the spec to finish
+    """
+    settings.init_build_dirs()
+    mocker.patch('cykubedrunner.baserunner.ProcessWatchdog.sample', side_effect=SystemExit(1))
+    t = time.time()
+    with pytest.raises(SystemExit):
+        sleeper(30).create_process()
+    assert time.time() - t < 10
+    spec_usage.pop('example.spec.ts')
+
+
+def test_memory_watchdog(sleeper, monkeypatch):
+    settings.init_build_dirs()
+    monkeypatch.setattr(settings, 'SPEC_MEMORY_LIMIT', 1024)
+    t = time.time()
+    with pytest.raises(SpecOutOfMemory):
+        sleeper(30).create_process()
+    assert time.time() - t < 10
+    usage = spec_usage.pop('example.spec.ts')
+    assert usage['peak_rss'] > 1024
+
+
+def test_out_of_memory_result(sleeper, monkeypatch):
+    settings.init_build_dirs()
+    monkeypatch.setattr(settings, 'SPEC_MEMORY_LIMIT', 1024)
+    spectests = sleeper(30).run()
+    spec_usage.pop('example.spec.ts')
+    assert [(t.title, t.status) for t in spectests.tests] == [(OUT_OF_MEMORY_TITLE, TestResultStatus.failed)]
+    assert spectests.tests[0].results[0].errors[0].title == 'OutOfMemory'
+    # there's nothing to rerun
+    assert get_failed_tests(spectests) == []
+
+
+def test_record_duration(sleeper, mocker):
+    settings.init_build_dirs()
+    spec_durations.reset()
+    runner = sleeper(1)
+    mocker.patch.object(runner, 'parse_results', return_value=SpecTests(tests=[]))
+    with open(runner.results_file, 'w') as f:
+        f.write('{}')
+    runner.run()
+    assert 1 <= spec_durations.durations['example.spec.ts'][0] < 10
+
+    # a rerun of just the failed tests says nothing about how long the spec takes
+    runner.only = [SpecTest(title='test1', status=TestResultStatus.failed, results=[])]
+    runner.run()
+    assert len(spec_durations.durations['example.spec.ts']) == 1
+    spec_usage.pop('example.spec.ts')
+
+
+def test_record_batch_durations(testrun):
+    spec_durations.reset()
+
+    def spectests(duration):
+        return SpecTests(tests=[SpecTest(title='test', status=TestResultStatus.passed, results=[
+            TestResult(browser='chromium', status=TestResultStatus.passed, retry=0, duration=duration)])])
+
+    runner = PlaywrightSpecRunner(None, testrun, ['short.spec.ts', 'long.spec.ts'])
+    runner.record_batch_durations({'short.spec.ts': spectests(1000), 'long.spec.ts': spectests(3000)}, 20)
+    assert spec_durations.durations == {'short.spec.ts': [5], 'long.spec.ts': [15]}
+
+
+def test_cypress_rerun_support_file(testrun):
+    settings.init_build_dirs()
+    os.makedirs(settings.cypress_cache)
+    only = [SpecTest(title='fails', context='suite', status=TestResultStatus.failed, results=[])]
+    runner = CypressSpecRunner(None, testrun, 'cypress/e2e/test1.cy.ts', 'electron', only=only)
+    path = runner.create_rerun_support_file()
+    # not on the shared volume
+    assert os.path.dirname(path) == runner.results_dir
+    with open(path) as f:
+        assert 'const rerunTests = [["suite", "fails"]];' in f.read()
+
+
+def test_yarn_pnp_command(testrun):
+    runner = PlaywrightSpecRunner(None, testrun, 'example.spec.ts')
+    assert runner.get_command()[:3] == ['npx', 'playwright', 'test']
+
+    app.is_yarn_pnp = True
+    assert runner.get_command()[:3] == ['yarn', 'playwright', 'test']
+
+
+def test_merge_rerun():
+    original = SpecTests(tests=[
+        SpecTest(title='flakes', context='suite', status=TestResultStatus.failed,
+                 results=[TestResult(browser='electron', status=TestResultStatus.failed, retry=0)]),
+        SpecTest(title='fails', context='suite', status=TestResultStatus.failed,
+                 results=[TestResult(browser='electron', status=TestResultStatus.failed, retry=0)]),
+        SpecTest(title='passes', context='suite', status=TestResultStatus.passed,
+                 results=[TestResult(browser='electron', status=TestResultStatus.passed, retry=0)]),
+    ])
+    assert [t.title for t in get_failed_tests(original)] == ['flakes', 'fails']
+
+    # in a fresh process each rerun is the first attempt
+    rerun = SpecTests(tests=[
+        SpecTest(title='flakes', context='suite', status=TestResultStatus.passed,
+                 results=[TestResult(browser='electron', status=TestResultStatus.passed, retry=0)]),
+        SpecTest(title='fails', context='suite', status=TestResultStatus.failed,
+                 results=[TestResult(browser='electron', status=TestResultStatus.failed, retry=0)]),
+    ])
+    merge_rerun(original, rerun)
+
+    flakes, fails, passes = original.tests
+    assert flakes.status == TestResultStatus.flakey
+    assert [(r.retry, r.status) for r in flakes.results] == [(0, TestResultStatus.failed),
+                                                              (1, TestResultStatus.passed)]
+    assert fails.status == TestResultStatus.failed
+    assert [r.retry for r in fails.results] == [0, 1]
+    assert len(passes.results) == 1
+    assert get_failed_tests(original) == [fails]
+
+
+def test_rerun_failed_playwright_tests(testrun):
+    testrun.project.runner_retries = 2
+    failed = [SpecTest(title='fails', line=12, status=TestResultStatus.failed, results=[])]
+
+    runner = PlaywrightSpecRunner(None, testrun, 'tests/example.spec.ts')
+    assert '--retries' in runner.get_args()
+
+    settings.RETRY_FAILED_TESTS = True
+    try:
+        runner = PlaywrightSpecRunner(None, testrun, 'tests/example.spec.ts', only=failed)
+        args = runner.get_args()
+        assert '--retries' not in args
+        assert args[-1] == 'tests/example.spec.ts:12'
+    finally:
+        settings.RETRY_FAILED_TESTS = False
+
+
+def test_no_new_specs_once_terminating(mocker, testrun):
+    run_spec = mocker.patch('cykubedrunner.runner.run_spec')
+    app.is_terminating = True
+    assert run_specs(None, testrun, ['a.spec.ts']) == ['a.spec.ts']
+    assert run_specs(None, testrun, ['b.spec.ts', 'c.spec.ts']) == ['b.spec.ts', 'c.spec.ts']
+    assert not run_spec.called
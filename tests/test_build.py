@@ -1,3 +1,4 @@
+import json
 import os
 import shutil
 
@@ -7,6 +8,19 @@ from cykubedrunner import builder
 from cykubedrunner.common.schemas import NewTestRun, AgentBuildCompleted
 from cykubedrunner.settings import settings
 
+# build steps that run concurrently once the node environment is ready, so can be called in either order
+CONCURRENT_COMMANDS = {'cypress verify', 'ng build --output-path=dist'}
+
+
+def assert_commands(runcmd, expected_commands):
+    commands = [x.args[0] for x in runcmd.call_args_list]
+    assert [x for x in commands if x not in CONCURRENT_COMMANDS] == \
+           [x for x in expected_commands if x not in CONCURRENT_COMMANDS]
+    assert sorted(commands) == sorted(expected_commands)
+    # but they can only start once the node environment has been created
+    sequential = [i for i, x in enumerate(commands) if x not in CONCURRENT_COMMANDS]
+    assert all(i < len(sequential) for i in sequential)
+
 
 @freeze_time('2022-04-03 14:10:00Z')
 def test_build_no_node_cache(mocker,
@@ -25,12 +39,11 @@ def test_build_no_node_cache(mocker,
     expected_commands = [
         'git clone --recursive git@github.org/dummy.git .',
         'git reset --hard deadbeef0101',
-        'npm ci',
+        f'npm ci --cache={settings.BUILD_DIR}/package-cache/npm --prefer-offline',
         'cypress verify',
         'ng build --output-path=dist'
     ]
-    commands = [x.args[0] for x in runcmd.call_args_list]
-    assert expected_commands == commands
+    assert_commands(runcmd, expected_commands)
 
     log_msgs = post_logs_mock()
 
@@ -40,6 +53,7 @@ def test_build_no_node_cache(mocker,
                         'Using node v18.17.0',
                         'Creating node distribution',
                         'Building new node cache using npm',
+                        'Package cache: 0 hits, 1117 misses',
                         'Created node environment in 0.0s',
                         'Building app']
 
@@ -69,11 +83,12 @@ def test_build_with_node_cache(mocker,
     expected_commands = [
         'git clone --recursive git@github.org/dummy.git .',
         'git reset --hard deadbeef0101',
-        f'mv {settings.BUILD_DIR}/node_modules {settings.src_dir}',
         'ng build --output-path=dist'
     ]
-    commands = [x.args[0] for x in runcmd.call_args_list]
-    assert commands == expected_commands
+    assert_commands(runcmd, expected_commands)
+    # the cached node_modules has been moved into place
+    assert os.path.exists(os.path.join(settings.src_dir, 'node_modules'))
+    assert not os.path.exists(settings.cached_node_modules)
 
 
 def test_build_yarn1_no_cache(mocker, fetch_testrun_mock,
@@ -88,13 +103,11 @@ def test_build_yarn1_no_cache(mocker, fetch_testrun_mock,
     expected_commands = [
         'git clone --recursive git@github.org/dummy.git .',
         'git reset --hard deadbeef0101',
-        f'yarn install --pure-lockfile --cache-folder={settings.BUILD_DIR}/.yarn-cache',
+        f'yarn install --pure-lockfile --cache-folder={settings.BUILD_DIR}/package-cache/yarn',
         'cypress verify',
         'ng build --output-path=dist'
     ]
-    commands = [x.args[0] for x in runcmd.call_args_list]
-    print(commands)
-    assert commands == expected_commands
+    assert_commands(runcmd, expected_commands)
 
 
 def test_build_yarn2_no_cache(mocker, fetch_testrun_mock,
@@ -114,8 +127,7 @@ def test_build_yarn2_no_cache(mocker, fetch_testrun_mock,
         'cypress verify',
         'ng build --output-path=dist'
     ]
-    commands = [x.args[0] for x in runcmd.call_args_list]
-    assert commands == expected_commands
+    assert_commands(runcmd, expected_commands)
 
 
 def test_build_yarn2_with_cache(mocker, fetch_testrun_mock,
@@ -124,7 +136,7 @@ def test_build_yarn2_with_cache(mocker, fetch_testrun_mock,
                                cypress_fixturedir):
     runcmd = mocker.patch('cykubedrunner.builder.runcmd')
     shutil.copytree(os.path.join(cypress_fixturedir, 'project-yarn2'), settings.src_dir, dirs_exist_ok=True)
-    os.mkdir(settings.yarn2_global_cache)
+    os.makedirs(settings.yarn2_global_cache)
 
     builder.build()
 
@@ -135,5 +147,126 @@ def test_build_yarn2_with_cache(mocker, fetch_testrun_mock,
         'yarn install',
         'ng build --output-path=dist'
     ]
-    commands = [x.args[0] for x in runcmd.call_args_list]
-    assert commands == expected_commands
+    assert_commands(runcmd, expected_commands)
+
+
+def test_build_cypress_already_verified(mocker, fetch_testrun_mock,
+                                        build_completed_mock,
+                                        post_logs_mock, testrun: NewTestRun,
+                                        cypress_fixturedir):
+    runcmd = mocker.patch('cykubedrunner.builder.runcmd')
+    shutil.copytree(os.path.join(cypress_fixturedir, 'project'), settings.src_dir, dirs_exist_ok=True)
+    # the node cache has a known version of Cypress
+    pkgdir = os.path.join(settings.cached_node_modules, 'cypress')
+    os.makedirs(pkgdir)
+    with open(os.path.join(pkgdir, 'package.json'), 'w') as f:
+        json.dump({'version': '12.17.1'}, f)
+
+    builder.build()
+
+    # even though the node_modules came from the cache, this version hasn't been verified
+    assert 'cypress verify' in [x.args[0] for x in runcmd.call_args_list]
+    assert os.path.exists(os.path.join(settings.cypress_cache, '12.17.1', '.cykubed-verified'))
+
+    # next time around we know it's good
+    runcmd.reset_mock()
+    builder.verify_test_framework(testrun, using_cache=True)
+    assert not runcmd.called
+
+
+def test_build_pnpm(mocker, fetch_testrun_mock,
+                    build_completed_mock,
+                    post_logs_mock, testrun: NewTestRun,
+                    cypress_fixturedir):
+    runcmd = mocker.patch('cykubedrunner.builder.runcmd')
+    shutil.copytree(os.path.join(cypress_fixturedir, 'project'), settings.src_dir, dirs_exist_ok=True)
+    os.remove(os.path.join(settings.src_dir, 'package-lock.json'))
+    with open(os.path.join(settings.src_dir, 'pnpm-lock.yaml'), 'w') as f:
+        f.write("lockfileVersion: '6.0'\n")
+
+    builder.build()
+
+    assert_commands(runcmd, [
+        'git clone --recursive git@github.org/dummy.git .',
+        'git reset --hard deadbeef0101',
+        f'pnpm install --frozen-lockfile --store-dir={settings.BUILD_DIR}/pnpm-store',
+        'cypress verify',
+        'ng build --output-path=dist'
+    ])
+    assert builder.app.is_pnpm
+
+    # node_modules is just links into the store, which stays where it is
+    os.makedirs(os.path.join(settings.src_dir, 'node_modules'))
+    mocker.patch('cykubedrunner.builder.app.post')
+    builder.prepare_cache()
+    assert not os.path.exists(settings.cached_node_modules)
+
+
+def test_build_monorepo_pnpm(mocker, fetch_testrun_mock,
+                             build_completed_mock,
+                             post_logs_mock, testrun: NewTestRun,
+                             cypress_fixturedir):
+    app_dir = os.path.join(settings.src_dir, 'apps', 'web')
+    shutil.copytree(os.path.join(cypress_fixturedir, 'project'), app_dir, dirs_exist_ok=True)
+    os.remove(os.path.join(app_dir, 'package-lock.json'))
+    with open(os.path.join(app_dir, 'package.json')) as f:
+        manifest = json.load(f)
+    manifest['dependencies']['@acme/ui'] = 'workspace:*'
+    files = {'pnpm-lock.yaml': "lockfileVersion: '6.0'\n",
+             'pnpm-workspace.yaml': "packages:\n  - 'apps/*'\n  - 'libs/*'\n",
+             'apps/web/package.json': json.dumps(manifest),
+             'libs/ui/package.json': json.dumps(dict(name='@acme/ui')),
+             'libs/unused/package.json': json.dumps(dict(name='@acme/unused'))}
+    for path in ['pnpm-lock.yaml', 'apps/web/package.json']:
+        with open(os.path.join(settings.src_dir, path), 'w') as f:
+            f.write(files[path])
+
+    def git(cmd, **kwargs):
+        if cmd == 'git ls-tree -r --name-only HEAD':
+            return mocker.Mock(stdout='\n'.join(files))
+        if cmd.startswith('git show HEAD:'):
+            return mocker.Mock(stdout=files[cmd.removeprefix('git show HEAD:')])
+    runcmd = mocker.patch('cykubedrunner.builder.runcmd', side_effect=git)
+    settings.APP_PATH = 'apps/web'
+    try:
+        builder.build()
+    finally:
+        settings.APP_PATH = ''
+
+    commands = [x.args[0] for x in runcmd.call_args_list if not x.args[0].startswith('git show')]
+    assert commands[:5] == [
+        'git clone --filter=blob:none --sparse --recursive git@github.org/dummy.git .',
+        'git reset --hard deadbeef0101',
+        'git ls-tree -r --name-only HEAD',
+        'git sparse-checkout set apps/web libs/ui',
+        f'pnpm install --frozen-lockfile --store-dir={settings.BUILD_DIR}/pnpm-store --filter=dummyui...',
+    ]
+    build_app = next(x for x in runcmd.call_args_list if x.args[0] == 'ng build --output-path=dist')
+    assert build_app.kwargs['cwd'] == app_dir
+
+    # the specs are relative to the app
+    event = AgentBuildCompleted.parse_raw(build_completed_mock.calls.last.request.content.decode())
+    assert 'cypress/e2e/stuff/test1.spec.ts' in event.specs
+
+
+def test_build_yarn2_pnp(mocker, fetch_testrun_mock,
+                         build_completed_mock,
+                         post_logs_mock, testrun: NewTestRun,
+                         cypress_fixturedir):
+    runcmd = mocker.patch('cykubedrunner.builder.runcmd')
+    shutil.copytree(os.path.join(cypress_fixturedir, 'project-yarn2'), settings.src_dir, dirs_exist_ok=True)
+    # yarn install would create the PnP loader
+    runcmd.side_effect = lambda cmd, **kwargs: \
+        open(os.path.join(settings.src_dir, '.pnp.cjs'), 'w').close() if cmd == 'yarn install' else None
+
+    builder.build()
+
+    assert builder.app.is_yarn_modern
+    assert builder.app.is_yarn_pnp
+    assert "Using Plug'n'Play" in post_logs_mock()
+
+
+def test_bundle_after_build(monkeypatch, testrun: NewTestRun):
+    monkeypatch.setattr(settings, 'PREBUNDLE_SPECS', True)
+    steps = {step.name: step for step in builder.build_steps(testrun)}
+    assert steps['build_app'] in steps['bundle'].requires
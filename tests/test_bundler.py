@@ -0,0 +1,40 @@
+import json
+import os
+
+from cykubedrunner.bundler import BundleManifest, bundle_specs, get_source_hash
+from cykubedrunner.settings import settings
+
+
+def write_spec(path: str, content: str):
+    fullpath = os.path.join(settings.src_dir, path)
+    os.makedirs(os.path.dirname(fullpath), exist_ok=True)
+    with open(fullpath, 'w') as f:
+        f.write(content)
+    return fullpath
+
+
+def test_no_esbuild():
+    settings.init_build_dirs()
+    write_spec('cypress/e2e/test1.cy.ts', 'it("works", () => {})')
+    bundle_specs(['cypress/e2e/test1.cy.ts'])
+    assert not os.path.exists(settings.bundles_dir)
+
+
+def test_stale_bundles_are_ignored():
+    settings.init_build_dirs()
+    spec = 'cypress/e2e/test1.cy.ts'
+    write_spec(spec, 'import { login } from "../support/login";\nit("works", () => {})')
+    write_spec('cypress/support/login.ts', 'export function login() {}')
+    bundle = write_spec('.cykubed/bundles/abc/test1.cy.ts', '(() => { it("works", () => {}) })()')
+    with open(os.path.join(settings.bundles_dir, 'manifest.json'), 'w') as f:
+        f.write(json.dumps({spec: {'hash': get_source_hash(spec, None),
+                                   'bundle': '.cykubed/bundles/abc/test1.cy.ts'}}))
+
+    manifest = BundleManifest()
+    assert manifest.get_bundle(spec) == bundle
+    assert manifest.get_bundle('cypress/e2e/unknown.cy.ts') is None
+    assert manifest.get_support_bundle() is None
+
+    # the spec imports this
+    write_spec('cypress/support/login.ts', 'export function login() { return true; }')
+    assert manifest.get_bundle(spec) is None
@@ -0,0 +1,114 @@
+import json
+import os
+import time
+
+from cykubedrunner.app import app
+from cykubedrunner.caches import VersionedCache, get_package_version, get_playwright_browsers_path
+from cykubedrunner.settings import settings
+
+
+def add_version(cache: VersionedCache, version: str, size: int, verified=True, age=0):
+    os.makedirs(cache.path(version))
+    with open(os.path.join(cache.path(version), 'binary'), 'wb') as f:
+        f.write(b'x' * size)
+    if verified:
+        cache.mark_verified(version)
+    t = time.time() - age
+    os.utime(cache.stamp(version) if verified else cache.path(version), (t, t))
+
+
+def add_package(name: str, version: str):
+    pkgdir = os.path.join(settings.src_dir, 'node_modules', name)
+    os.makedirs(pkgdir)
+    with open(os.path.join(pkgdir, 'package.json'), 'w') as f:
+        json.dump({'name': name, 'version': version}, f)
+
+
+def test_get_package_version():
+    assert get_package_version('cypress') is None
+    add_package('cypress', '12.17.1')
+    assert get_package_version('cypress') == '12.17.1'
+
+
+def test_get_package_version_with_pnp():
+    settings.init_build_dirs()
+    with open(os.path.join(settings.src_dir, 'yarn.lock'), 'w') as f:
+        f.write('''__metadata:
+  version: 6
+
+"@playwright/test@npm:1.38.0":
+  version: 1.38.0
+  resolution: "@playwright/test@npm:1.38.0"
+
+"cypress@npm:^10.0.0":
+  version: 10.11.0
+  resolution: "cypress@npm:10.11.0"
+
+"cypress@npm:^12.0.0, cypress@npm:^12.17.1":
+  version: 12.17.1
+  resolution: "cypress@npm:12.17.1"
+''')
+    with open(os.path.join(settings.src_dir, 'package.json'), 'w') as f:
+        json.dump({'devDependencies': {'cypress': '^12.17.1'}}, f)
+
+    assert get_package_version('cypress') is None
+    # there's no node_modules with Plug'n'Play
+    app.is_yarn_pnp = True
+    assert get_package_version('cypress') == '12.17.1'
+    assert get_playwright_browsers_path() == os.path.join(settings.BUILD_DIR, 'playwright-browsers', '1.38.0')
+    assert get_package_version('react') is None
+
+
+def test_playwright_browsers_path():
+    assert get_playwright_browsers_path() == '0'
+    add_package('@playwright/test', '1.38.0')
+    assert get_playwright_browsers_path() == os.path.join(settings.BUILD_DIR, 'playwright-browsers', '1.38.0')
+
+
+def test_ensure_only_verifies_once():
+    cache = VersionedCache('Cypress', settings.cypress_cache)
+    calls = []
+
+    assert not cache.ensure('12.0.0', lambda: calls.append(1))
+    assert cache.is_verified('12.0.0')
+    assert cache.ensure('12.0.0', lambda: calls.append(1))
+    assert len(calls) == 1
+
+
+def test_failed_verify_is_not_stamped():
+    cache = VersionedCache('Cypress', settings.cypress_cache)
+
+    def fail():
+        raise ValueError()
+
+    try:
+        cache.ensure('12.0.0', fail)
+    except ValueError:
+        pass
+    assert not cache.is_verified('12.0.0')
+
+
+def test_prune_evicts_least_recently_used():
+    cache = VersionedCache('Cypress', settings.cypress_cache)
+    add_version(cache, '10.0.0', 1000, age=300)
+    add_version(cache, '11.0.0', 1000, age=200)
+    add_version(cache, '12.0.0', 1000, verified=False, age=100)
+    add_version(cache, '13.0.0', 1000, age=400)
+
+    cache.prune(3500, keep='13.0.0')
+
+    assert sorted(cache.versions()) == ['11.0.0', '12.0.0', '13.0.0']
+
+    cache.prune(2500, keep='13.0.0')
+    assert sorted(cache.versions()) == ['12.0.0', '13.0.0']
+
+
+def test_prune_skips_locked_versions():
+    cache = VersionedCache('Cypress', settings.cypress_cache)
+    add_version(cache, '10.0.0', 1000, age=300)
+    add_version(cache, '11.0.0', 1000, age=200)
+
+    with cache.lock('10.0.0'):
+        cache.prune(1000)
+
+    assert cache.versions() == ['10.0.0']
@@ -0,0 +1,57 @@
+import json
+import os
+from unittest.mock import patch
+
+from cykubedrunner import codec
+from cykubedrunner.common.enums import AgentEventType, LogLevel
+from cykubedrunner.common.schemas import AgentSpecCompleted, SpecTests, AgentLogMessage, AppLogMessage, \
+    AgentBuildCompleted
+from cykubedrunner.common.utils import utcnow
+
+
+def get_payloads(json_fixture_fetcher) -> list:
+    spectests = SpecTests.parse_raw(json_fixture_fetcher('cypress/full-run/expected/test1.json'))
+    return [
+        AgentSpecCompleted(file='cypress/e2e/stuff/test1.spec.ts', finished=utcnow(), result=spectests),
+        AgentLogMessage(type=AgentEventType.log, testrun_id=20,
+                        msg=AppLogMessage(ts=utcnow(), level=LogLevel.info, host='runner-1', step=2,
+                                          source='builder', msg='Installed 1117 packages ✔ in 3.5s\n\t"done"')),
+        AgentBuildCompleted(specs=['cypress/e2e/stuff/test1.spec.ts', 'cypress/e2e/nonsense/tést4.spec.ts']),
+    ]
+
+
+def test_orjson_installed():
+    # otherwise the comparisons below are between the stdlib and itself
+    assert codec.orjson is not None
+
+
+def with_stdlib(fn, *args, **kwargs):
+    with patch('cykubedrunner.codec.orjson', None):
+        return fn(*args, **kwargs)
+
+
+def test_encode_model_identical_with_stdlib(json_fixture_fetcher):
+    for model in get_payloads(json_fixture_fetcher):
+        encoded = codec.encode_model(model)
+        assert encoded == with_stdlib(codec.encode_model, model)
+        # and it's the same as the schema would give us
+        assert json.loads(encoded) == json.loads(model.json())
+
+
+def test_encode_model_extra_fields(json_fixture_fetcher):
+    model = get_payloads(json_fixture_fetcher)[0]
+    encoded = codec.encode_model(model, cached=True)
+    assert encoded == with_stdlib(codec.encode_model, model, cached=True)
+    assert json.loads(encoded) == dict(json.loads(model.json()), cached=True)
+
+
+def test_dumps_identical_with_stdlib():
+    obj = {'file': 'tést.spec.ts', 'count': 3, 'ratio': 0.25, 'ok': True, 'video': None, 2: [' ', '\x01']}
+    assert codec.dumps(obj) == with_stdlib(codec.dumps, obj)
+    assert codec.dumpb(obj) == with_stdlib(codec.dumpb, obj)
+
+
+def test_loads_report(cypress_fixturedir):
+    with open(os.path.join(cypress_fixturedir, 'two-fails-with-retries', 'out.json')) as f:
+        report = f.read()
+    assert codec.loads(report) == with_stdlib(codec.loads, report) == json.loads(report)
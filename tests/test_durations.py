@@ -0,0 +1,85 @@
+import os
+
+from cykubedrunner.durations import SpecDurations, spec_durations
+from cykubedrunner.runner import make_batches
+from cykubedrunner.settings import settings
+
+
+def test_percentile():
+    durations = SpecDurations()
+    for d in range(1, 101):
+        durations.record('test1.spec.ts', d)
+    # we only keep the most recent
+    assert len(durations.durations['test1.spec.ts']) == settings.SPEC_DURATION_HISTORY
+    assert durations.percentile('test1.spec.ts', 99) == 100
+    assert durations.percentile('test1.spec.ts', 50) == 90
+    assert durations.percentile('missing.spec.ts', 99) is None
+
+
+def test_adaptive_deadline(monkeypatch):
+    monkeypatch.setattr(settings, 'ADAPTIVE_SPEC_DEADLINE', True)
+    durations = SpecDurations()
+    durations.record('short.spec.ts', 5)
+    # not enough history yet
+    assert durations.get_deadline('short.spec.ts', 1800) == 1800
+    durations.record('short.spec.ts', 10)
+    durations.record('short.spec.ts', 8)
+    # clamped to the minimum
+    assert durations.get_deadline('short.spec.ts', 1800) == settings.SPEC_DEADLINE_MIN
+
+    for i in range(3):
+        durations.record('medium.spec.ts', 100 + i)
+    assert durations.get_deadline('medium.spec.ts', 1800) == 306
+
+    for i in range(3):
+        durations.record('long.spec.ts', 2000)
+    # clamped to the maximum
+    assert durations.get_deadline('long.spec.ts', 1800) == settings.SPEC_DEADLINE_MAX
+
+
+def test_adaptive_deadline_disabled():
+    durations = SpecDurations()
+    for i in range(3):
+        durations.record('short.spec.ts', 5)
+    assert durations.get_deadline('short.spec.ts', 1800) == 1800
+
+
+def test_save_and_load():
+    durations = SpecDurations()
+    durations.record('test1.spec.ts', 12.34)
+    durations.save()
+
+    loaded = SpecDurations()
+    loaded.load()
+    assert loaded.durations == {'test1.spec.ts': [12.3]}
+
+
+def test_save_merges_other_runners():
+    first, second = SpecDurations(), SpecDurations()
+    first.load()
+    second.load()
+    first.record('test1.spec.ts', 10)
+    first.save()
+    second.record('test1.spec.ts', 20)
+    second.record('test2.spec.ts', 30)
+    second.save()
+    first.record('test1.spec.ts', 40)
+    first.save()
+
+    loaded = SpecDurations()
+    loaded.load()
+    assert loaded.durations == {'test1.spec.ts': [10, 20, 40], 'test2.spec.ts': [30]}
+    # no temporary files left behind
+    assert not [x for x in os.listdir(settings.BUILD_DIR) if x.startswith('.spec-durations-')]
+
+
+def test_make_batches(monkeypatch):
+    monkeypatch.setattr(settings, 'SPEC_BATCH_MAX_DURATION', 60)
+    monkeypatch.setattr(spec_durations, 'durations', {
+        'a.spec.ts': [10, 12],
+        'b.spec.ts': [30],
+        'c.spec.ts': [25],
+        'long.spec.ts': [300],
+    })
+    batches = make_batches(['a.spec.ts', 'unknown.spec.ts', 'b.spec.ts', 'long.spec.ts', 'c.spec.ts'])
+    assert batches == [['unknown.spec.ts'], ['long.spec.ts'], ['a.spec.ts', 'b.spec.ts'], ['c.spec.ts']]
@@ -0,0 +1,65 @@
+import os
+
+from cykubedrunner import fsutils
+from cykubedrunner.settings import settings
+
+
+def make_tree(root: str, count: int = 20):
+    for i in range(count):
+        pkgdir = os.path.join(root, f'package{i}', 'lib')
+        os.makedirs(pkgdir)
+        with open(os.path.join(pkgdir, 'index.js'), 'w') as f:
+            f.write('module.exports = {};')
+    with open(os.path.join(root, '.package-lock.json'), 'w') as f:
+        f.write('{}')
+
+
+def test_move():
+    src = os.path.join(settings.BUILD_DIR, 'src', 'node_modules')
+    make_tree(src)
+    dest = settings.cached_node_modules
+    fsutils.move(src, dest)
+    assert not os.path.exists(src)
+    assert os.path.exists(os.path.join(dest, 'package19', 'lib', 'index.js'))
+
+
+def test_remove_tree():
+    settings.init_build_dirs()
+    make_tree(os.path.join(settings.src_dir, 'node_modules'))
+    fsutils.remove_tree(settings.src_dir)
+    assert os.listdir(settings.BUILD_DIR) == []
+
+
+def test_remove_tree_in_background():
+    settings.init_build_dirs()
+    make_tree(os.path.join(settings.src_dir, 'node_modules'))
+    thread = fsutils.remove_tree(settings.src_dir, background=True)
+    # the path is free immediately
+    assert not os.path.exists(settings.src_dir)
+    thread.join()
+    assert os.listdir(settings.BUILD_DIR) == []
+
+
+def test_remove_tree_logs_failures(mocker):
+    settings.init_build_dirs()
+    make_tree(os.path.join(settings.src_dir, 'node_modules'))
+    mocker.patch('cykubedrunner.fsutils._remove', side_effect=PermissionError('Read-only file system'))
+    warning = mocker.patch('cykubedrunner.fsutils.logger.warning')
+    fsutils.remove_tree(settings.src_dir)
+    assert warning.call_count == 1
+
+
+def test_reap_trash():
+    settings.init_build_dirs()
+    # left behind by a process that was killed while deleting it
+    make_tree(os.path.join(settings.BUILD_DIR, '.trash-1234'))
+    thread = fsutils.reap_trash([settings.BUILD_DIR, os.path.join(settings.BUILD_DIR, 'missing')])
+    thread.join()
+    assert sorted(os.listdir(settings.BUILD_DIR)) == ['src']
+    assert fsutils.reap_trash([settings.BUILD_DIR]) is None
+
+    assert fsutils.remove_tree(os.path.join(settings.BUILD_DIR, 'missing')) is None
+
+
+def test_sync_filesystem():
+    fsutils.sync_filesystem(settings.BUILD_DIR)
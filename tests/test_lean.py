@@ -0,0 +1,123 @@
+import io
+import json
+import os
+import shutil
+
+import pytest
+from httpx import Response
+
+from cykubedrunner import codec, lean
+from cykubedrunner.common.schemas import NewTestRun, AgentSpecCompleted, SpecTests
+from cykubedrunner.cypress import CypressSpecRunner, list_files
+from cykubedrunner.playwright import PlaywrightSpecRunner
+from cykubedrunner.runner import run, run_spec_batch
+from cykubedrunner.settings import settings
+
+
+@pytest.fixture()
+def lean_results():
+    settings.LEAN_RESULTS_MIN_SIZE = 0
+    yield
+    settings.LEAN_RESULTS_MIN_SIZE = 32 * 1024 * 1024
+
+
+@pytest.mark.parametrize('chunk_size', [1, 7, lean.CHUNK_SIZE])
+def test_iter_json_array(chunk_size):
+    doc = {'stats': {'tests': 3, 'duration': 12345}, 'tests': [{'title': 'a', 'duration': 100000},
+                                                             {'title': 'b "quoted"', 'err': {}}, 123456],
+           'passes': [{'title': 'a'}]}
+    scanner = lean.JsonScanner(io.StringIO(json.dumps(doc, indent=2)), chunk_size)
+    assert list(lean.iter_object_array(scanner, ('tests',), top=True)) == doc['tests']
+
+
+def test_iter_json_array_nested():
+    doc = {'config': {}, 'suites': [{'title': 'one', 'specs': [1, 2], 'suites': [{'specs': [0]}]},
+                                    {'specs': []}, {'file': 'x.ts', 'specs': [3]}], 'errors': []}
+    assert list(lean.iter_json_array(io.StringIO(json.dumps(doc)), 'suites', 'specs')) == [1, 2, 3]
+
+
+def test_cypress_lean_parse(lean_results, testrun: NewTestRun, cypress_fixturedir):
+    os.makedirs(os.path.join(settings.BUILD_DIR, 'cypress_cache'))
+    for fixture, spec in [('full-run/electron/test1', 'cypress/e2e/stuff/test1.spec.ts'),
+                          ('fail-inside-helper', 'cypress/e2e/stuff/test1.spec.ts')]:
+        runner = CypressSpecRunner(None, testrun, spec, 'chrome')
+        shutil.copytree(os.path.join(cypress_fixturedir, fixture), runner.screenshots_folder, dirs_exist_ok=True)
+        runner.results_file = os.path.join(cypress_fixturedir, fixture, 'out.json')
+
+        result = runner.parse_results()
+        assert lean.is_lean(result)
+        with open(runner.results_file) as f:
+            expected = runner.parse_report(spec, json.load(f)['tests'], list_files(runner.screenshots_folder), [])
+        assert result.json().encode() == codec.encode_model(expected)
+
+
+@pytest.mark.parametrize('fixture', ['fails-skips-flakes.json', 'pass-with-flake/out.json'])
+def test_playwright_lean_parse(lean_results, testrun: NewTestRun, playwright_fixturedir, fixture):
+    runner = PlaywrightSpecRunner(None, testrun, 'another.spec.ts')
+    runner.results_file = os.path.join(playwright_fixturedir, fixture)
+
+    result = runner.parse_results()
+    assert lean.is_lean(result)
+    with open(runner.results_file) as f:
+        expected = runner.parse_suites(json.load(f)['suites'])
+    assert result.json().encode() == codec.encode_model(expected)
+
+
+def test_cypress_lean_run(lean_results, respx_mock, mocker, cypress_fixturedir, json_fixture_fetcher,
+                          testrun: NewTestRun, mock_uploader, post_logs_mock):
+    """
+    Huge specs take the lean path all the way to the spec-completed payload, which is identical to
+    what we'd send with the schemas
+    """
+    testrun.project.browsers = ['electron', 'firefox']
+    os.makedirs(os.path.join(settings.src_dir, 'node_modules'))
+    os.makedirs(os.path.join(settings.BUILD_DIR, 'cypress_cache'))
+
+    respx_mock.get(f'https://api.cykubed.com/agent/testrun/{testrun.id}').mock(
+        return_value=Response(200, content=testrun.json()))
+    respx_mock.post('https://api.cykubed.com/agent/testrun/20/next-spec').mock(side_effect=[
+        Response(status_code=200, content='stuff/test1.spec.ts'),
+        Response(status_code=204)
+    ])
+    mocker.patch('cykubedrunner.runner.start_server', return_value=mocker.Mock())
+    spec_completed_mock = respx_mock.post('https://api.cykubed.com/agent/testrun/20/spec-completed').mock(
+        return_value=Response(status_code=200))
+    mock_uploader(5)
+
+    def create_process_side_effects(runner):
+        srcdir = os.path.join(cypress_fixturedir, 'full-run', runner.browser, 'test1')
+        shutil.copytree(srcdir, runner.screenshots_folder, dirs_exist_ok=True)
+        shutil.copy(os.path.join(srcdir, 'out.json'), runner.results_file)
+        return mocker.Mock(returncode=0)
+
+    mocker.patch('cykubedrunner.baserunner.BaseSpecRunner.create_process',
+                 side_effect=create_process_side_effects, autospec=True)
+
+    run()
+
+    assert spec_completed_mock.call_count == 1
+    content = spec_completed_mock.calls[0].request.content
+    spec_completed = AgentSpecCompleted.parse_raw(content)
+    assert content == codec.encode_model(spec_completed)
+    assert spec_completed.file == 'stuff/test1.spec.ts'
+    assert spec_completed.result.json(indent=4) == json_fixture_fetcher('cypress/full-run/expected/test1.json')
+
+
+def test_batch_merges_lean_results(mocker, testrun: NewTestRun):
+    """
+    The results for each browser are merged the same way as for a single spec, whichever of them are lean
+    """
+    testrun.project.browsers = ['electron', 'firefox']
+    results = {
+        'electron': {'a.cy.ts': SpecTests(tests=[])},
+        'firefox': {'a.cy.ts': lean.SpecTests([]), 'b.cy.ts': lean.SpecTests([])},
+    }
+    mocker.patch('cykubedrunner.runner.CypressSpecRunner.run_batch', autospec=True,
+                 side_effect=lambda runner: results[runner.browser])
+    upload_results = mocker.patch('cykubedrunner.runner.upload_results')
+    mocker.patch('cykubedrunner.runner.result_cache.put')
+
+    assert run_spec_batch(None, testrun, ['a.cy.ts', 'b.cy.ts']) == ['b.cy.ts']
+    assert upload_results.call_count == 1
+    spec, spectests = upload_results.call_args.args
+    assert spec == 'a.cy.ts' and lean.is_lean(spectests)
@@ -0,0 +1,68 @@
+import base64
+import hashlib
+import json
+import os
+
+from cykubedrunner.pkgcache import NpmCache, YarnBerryCache, use_package_cache, load_index, prune
+from cykubedrunner.settings import settings
+
+
+def write_package_lock(*contents: bytes):
+    packages = {'': {'name': 'app'}}
+    for i, content in enumerate(contents):
+        integrity = 'sha512-' + base64.b64encode(hashlib.sha512(content).digest()).decode()
+        packages[f'node_modules/pkg{i}'] = {'version': '1.0.0', 'integrity': integrity}
+    os.makedirs(settings.src_dir, exist_ok=True)
+    with open(os.path.join(settings.src_dir, 'package-lock.json'), 'w') as f:
+        json.dump({'lockfileVersion': 2, 'packages': packages}, f)
+
+
+def npm_download(cache_dir: str, content: bytes):
+    """
+    Add a tarball to the cache in the same way as npm
+    """
+    digest = hashlib.sha512(content).hexdigest()
+    path = os.path.join(cache_dir, 'content-v2', 'sha512', digest[:2], digest[2:4], digest[4:])
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as f:
+        f.write(content)
+
+
+def test_npm_hits_and_misses(mocker):
+    logger = mocker.patch('cykubedrunner.pkgcache.logger')
+    write_package_lock(b'a' * 100, b'b' * 200)
+    cache = NpmCache()
+
+    with use_package_cache(cache) as cache_dir:
+        npm_download(cache_dir, b'a' * 100)
+        npm_download(cache_dir, b'b' * 200)
+    logger.info.assert_called_with('Package cache: 0 hits, 2 misses')
+
+    write_package_lock(b'a' * 100, b'c' * 300)
+    with use_package_cache(cache) as cache_dir:
+        npm_download(cache_dir, b'c' * 300)
+    logger.info.assert_called_with('Package cache: 1 hits, 1 misses')
+
+    index = load_index()
+    assert sorted(x['size'] for x in index['npm'].values()) == [100, 200, 300]
+
+
+def test_prune_least_recently_used(mocker):
+    mocker.patch('cykubedrunner.pkgcache.logger')
+    cache = YarnBerryCache()
+    # the zips are in the cache folder under the global folder
+    cache_dir = os.path.join(cache.root, 'cache')
+    os.makedirs(cache_dir)
+    index = {'yarn-berry': {}}
+    for i, name in enumerate(['a-npm-1.0.0-0123456789.zip', 'b-npm-1.0.0-abcdef0123.zip',
+                              'c-npm-1.0.0-fedcba9876.zip']):
+        with open(os.path.join(cache_dir, name), 'wb') as f:
+            f.write(b'x' * 100)
+        index['yarn-berry'][os.path.join('cache', name)] = dict(size=100, last_used=[3, 1, 2][i])
+
+    assert set(cache.entries().values()) == {'0123456789', 'abcdef0123', 'fedcba9876'}
+
+    prune(index, 150)
+
+    assert list(index['yarn-berry'].keys()) == ['cache/a-npm-1.0.0-0123456789.zip']
+    assert os.listdir(cache_dir) == ['a-npm-1.0.0-0123456789.zip']
@@ -1,3 +1,4 @@
+import json
 import os
 import shutil
 
@@ -115,3 +116,27 @@ def test_playwright_run(respx_mock,
     # 5 image uploads in a single upload POST
     assert upload_mock.call_count == 1
     assert len(multipart_parser(upload_mock.calls[0].request)) == 5
+
+
+def test_playwright_parse_batch(testrun, playwright_fixturedir):
+    """
+    A batch of specs run in one process: the results are split by spec
+    """
+    suites = []
+    for name in ['example', 'another']:
+        with open(os.path.join(playwright_fixturedir, name, 'out.json')) as f:
+            suites += json.loads(f.read())['suites']
+    results_file = os.path.join(settings.BUILD_DIR, 'batch.json')
+    with open(results_file, 'w') as f:
+        f.write(json.dumps({'suites': suites}))
+
+    specrunner = PlaywrightSpecRunner(None, testrun, ['tests/example.spec.ts', 'tests/another.spec.ts'])
+    assert specrunner.get_args()[-2:] == ['tests/example.spec.ts', 'tests/another.spec.ts']
+    specrunner.results_file = results_file
+    results = specrunner.parse_batch_results()
+
+    assert set(results.keys()) == {'tests/example.spec.ts', 'tests/another.spec.ts'}
+    for name in ['example', 'another']:
+        single = PlaywrightSpecRunner(None, testrun, f'{name}.spec.ts')
+        single.results_file = os.path.join(playwright_fixturedir, name, 'out.json')
+        assert results[f'tests/{name}.spec.ts'].json() == single.parse_results().json()
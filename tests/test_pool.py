@@ -0,0 +1,76 @@
+import signal
+
+import pytest
+from httpx import Response
+
+from cykubedrunner import pool
+from cykubedrunner.app import app
+from cykubedrunner.bundler import bundle_manifest
+from cykubedrunner.common.exceptions import BuildFailedException
+from cykubedrunner.durations import spec_durations
+from cykubedrunner.resultcache import result_cache
+from cykubedrunner.settings import settings
+from cykubedrunner.watchdog import spec_usage, ResourceUsage
+
+
+def test_pool_serves_multiple_testruns(respx_mock, mocker, monkeypatch, testrun):
+    register_mock = respx_mock.post('https://api.cykubed.com/agent/runner-pool/register').mock(
+        return_value=Response(200))
+    deregister_mock = respx_mock.post('https://api.cykubed.com/agent/runner-pool/deregister').mock(
+        return_value=Response(200))
+    next_testrun_mock = respx_mock.post('https://api.cykubed.com/agent/runner-pool/next-testrun').mock(
+        side_effect=[
+            Response(200, content='20'),
+            Response(200, content='21'),
+            Response(204),
+        ])
+    # leave the pool as soon as we're idle
+    monkeypatch.setattr(settings, 'POOL_IDLE_TIMEOUT', -1)
+    client = app.http_client
+
+    seen = []
+
+    def fake_run():
+        # each run should start with clean state, but reuse the same HTTP client
+        assert app.specs_completed == set()
+        assert app.http_client is client
+        assert result_cache.testrun is None and bundle_manifest.manifest is None
+        assert spec_durations.durations == dict() and spec_usage.pop('test1.spec.ts') is None
+        seen.append(app.trid)
+        app.specs_completed.add('test1.spec.ts')
+        result_cache.init(testrun)
+        bundle_manifest.manifest = dict()
+        spec_durations.record('test1.spec.ts', 10)
+        spec_usage.record(['test1.spec.ts'], ResourceUsage(peak_rss=1024))
+        if app.trid == 21:
+            raise BuildFailedException('Broken')
+
+    mocker.patch('cykubedrunner.pool.run', side_effect=fake_run)
+    log_failure = mocker.patch('cykubedrunner.pool.log_build_failed_exception')
+
+    assert pool.serve() == 0
+
+    assert seen == [20, 21]
+    assert register_mock.called
+    assert next_testrun_mock.call_count == 3
+    assert deregister_mock.called
+    assert log_failure.call_count == 1
+    assert app.trid is None
+
+
+def test_pool_deregisters_when_terminated_while_idle(respx_mock, mocker, monkeypatch):
+    respx_mock.post('https://api.cykubed.com/agent/runner-pool/register').mock(return_value=Response(200))
+    deregister_mock = respx_mock.post('https://api.cykubed.com/agent/runner-pool/deregister').mock(
+        return_value=Response(200))
+    monkeypatch.setattr(settings, 'TEST', False)
+    handlers = dict()
+    mocker.patch('cykubedrunner.pool.signal.signal', side_effect=handlers.__setitem__)
+
+    def terminate(request):
+        handlers[signal.SIGTERM](signal.SIGTERM, None)
+
+    respx_mock.post('https://api.cykubed.com/agent/runner-pool/next-testrun').mock(side_effect=terminate)
+
+    with pytest.raises(SystemExit):
+        pool.serve()
+    assert deregister_mock.called
@@ -0,0 +1,171 @@
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import httpx
+import pytest
+
+from cykubedrunner.proxy import CachingProxy, ProxyThread, ProxyMode, ResponseCache, ProxyResponse, Recordings, \
+    get_cache_ttl, parse_routes
+from cykubedrunner.settings import settings
+
+
+class UpstreamHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        self.server.requests.append(self.path)
+        body = f'{self.path} {len(self.server.requests)} {self.headers.get("Cookie", "")}'.strip().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain')
+        if self.path.endswith('/nostore'):
+            self.send_header('Cache-Control', 'no-store')
+        elif self.path.endswith('/private'):
+            self.send_header('Cache-Control', 'private, max-age=600')
+        elif self.path.endswith('/vary'):
+            self.send_header('Vary', '*')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        length = int(self.headers['Content-Length'])
+        self.server.requests.append(self.path)
+        body = self.rfile.read(length).upper()
+        self.send_response(201)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture()
+def upstream():
+    httpd = ThreadingHTTPServer(('localhost', 0), UpstreamHandler)
+    httpd.requests = []
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    yield httpd
+    httpd.shutdown()
+    httpd.server_close()
+
+
+@pytest.fixture()
+def start_proxy(upstream):
+    threads = []
+
+    def start(mode=ProxyMode.cache) -> ProxyThread:
+        routes = parse_routes(f'/api/=http://localhost:{upstream.server_address[1]}/v1,/other/=http://localhost:1')
+        thread = ProxyThread(CachingProxy(routes, mode))
+        thread.start()
+        threads.append(thread)
+        return thread
+    yield start
+    for thread in threads:
+        thread.stop()
+
+
+def test_parse_routes():
+    routes = parse_routes('/=https://cdn.example.com/, /api/=https://api.example.com')
+    assert [(r.prefix, r.upstream) for r in routes] == [('/api/', 'https://api.example.com'),
+                                                         ('/', 'https://cdn.example.com')]
+    assert routes[0].get_url('/api/users?page=2') == 'https://api.example.com/users?page=2'
+
+
+def test_cache(upstream, start_proxy):
+    proxy = start_proxy()
+    r = httpx.get(f'{proxy.url}/api/users?page=1')
+    assert (r.status_code, r.text, r.headers['x-cache']) == (200, '/v1/users?page=1 1', 'MISS')
+    r = httpx.get(f'{proxy.url}/api/users?page=1')
+    assert (r.text, r.headers['x-cache']) == ('/v1/users?page=1 1', 'HIT')
+    assert r.headers['content-type'] == 'text/plain'
+
+    # not cacheable
+    assert httpx.get(f'{proxy.url}/api/users?page=2').headers['x-cache'] == 'MISS'
+    assert httpx.get(f'{proxy.url}/private/x').status_code == 404
+    for path in ['nostore', 'private', 'vary']:
+        httpx.get(f'{proxy.url}/api/{path}')
+        assert httpx.get(f'{proxy.url}/api/{path}').headers['x-cache'] == 'MISS'
+    r = httpx.post(f'{proxy.url}/api/users', content=b'new user')
+    assert (r.status_code, r.text) == (201, 'NEW USER')
+    assert httpx.post(f'{proxy.url}/api/users', content=b'new user').headers['x-cache'] == 'MISS'
+
+    # the upstream isn't running
+    assert httpx.get(f'{proxy.url}/other/x').status_code == 502
+
+    assert upstream.requests == ['/v1/users?page=1', '/v1/users?page=2', '/v1/nostore', '/v1/nostore',
+                                 '/v1/private', '/v1/private', '/v1/vary', '/v1/vary', '/v1/users', '/v1/users']
+    assert proxy.proxy.get_stats() == {
+        '/api/': dict(requests=11, hits=1, misses=10, errors=0, bytes_saved=len('/v1/users?page=1 1')),
+        '/other/': dict(requests=1, hits=0, misses=0, errors=1, bytes_saved=0),
+    }
+
+
+def test_cache_by_cookie(upstream, start_proxy):
+    proxy = start_proxy()
+    assert httpx.get(f'{proxy.url}/api/me', headers={'Cookie': 'user=a'}).text == '/v1/me 1 user=a'
+    assert httpx.get(f'{proxy.url}/api/me', headers={'Cookie': 'user=b'}).text == '/v1/me 2 user=b'
+    r = httpx.get(f'{proxy.url}/api/me', headers={'Cookie': 'user=a'})
+    assert (r.text, r.headers['x-cache']) == ('/v1/me 1 user=a', 'HIT')
+
+
+def test_get_cache_ttl():
+    assert get_cache_ttl(httpx.Headers(), 300) == 300
+    assert get_cache_ttl(httpx.Headers({'Cache-Control': 'public, max-age=60'}), 300) == 60
+    assert get_cache_ttl(httpx.Headers({'Cache-Control': 'max-age=600, s-maxage=30'}), 300) == 30
+    assert get_cache_ttl(httpx.Headers({'Cache-Control': 'max-age=3600'}), 300) == 300
+    for value in ['private', 'no-cache', 'no-store', 'max-age=0', 'max-age=soon']:
+        assert get_cache_ttl(httpx.Headers({'Cache-Control': value}), 300) == 0
+    assert get_cache_ttl(httpx.Headers({'Vary': '*'}), 300) == 0
+
+
+def test_recording_write_failure(tmp_path):
+    root = tmp_path / 'recordings'
+    root.write_text('not a directory')
+    # logged, not raised
+    Recordings(str(root)).put('abcd', ProxyResponse(200, [], b'1234', 'MISS'))
+    assert Recordings(str(root)).get('abcd') is None
+
+
+def test_record_and_replay(upstream, start_proxy):
+    proxy = start_proxy(ProxyMode.record)
+    assert httpx.get(f'{proxy.url}/api/users').text == '/v1/users 1'
+    assert httpx.post(f'{proxy.url}/api/users', content=b'abc').text == 'ABC'
+    proxy.stop()
+    upstream.shutdown()
+
+    # another runner replays them without the upstream
+    proxy = start_proxy(ProxyMode.replay)
+    r = httpx.get(f'{proxy.url}/api/users')
+    assert (r.text, r.headers['x-cache']) == ('/v1/users 1', 'HIT')
+    r = httpx.post(f'{proxy.url}/api/users', content=b'abc')
+    assert (r.status_code, r.text) == (201, 'ABC')
+    assert httpx.post(f'{proxy.url}/api/users', content=b'xyz').status_code == 502
+    assert len(upstream.requests) == 2
+
+
+def test_response_cache_eviction(mocker):
+    monotonic = mocker.patch('cykubedrunner.proxy.time.monotonic', return_value=1000)
+    cache = ResponseCache(max_size=10, ttl=60)
+    for key in 'abc':
+        cache.put(key, ProxyResponse(200, [], b'1234', 'HIT'))
+    # the least recently used is evicted to make room
+    assert cache.get('a') is None
+    assert cache.get('b').body == b'1234'
+    cache.put('d', ProxyResponse(200, [], b'1234', 'HIT'))
+    assert cache.get('c') is None
+    assert cache.get('b') and cache.get('d')
+    assert cache.size == 8
+    # too big to cache at all
+    cache.put('e', ProxyResponse(200, [], b'12345678901', 'HIT'))
+    assert cache.get('e') is None
+
+    monotonic.return_value = 1061
+    assert cache.get('b') is None
+    assert cache.size == 4
+
+
+def test_proxy_settings(monkeypatch):
+    monkeypatch.setattr(settings, 'PROXY_CACHE_TTL', 5)
+    proxy = CachingProxy(parse_routes('/api/=http://localhost:1'))
+    assert proxy.cache.ttl == 5
+    assert proxy.recordings.root == settings.proxy_recordings_dir
+    proxy.close()
@@ -0,0 +1,95 @@
+import os
+
+import pytest
+
+from cykubedrunner import resources
+from cykubedrunner.resources import GiB
+from cykubedrunner.settings import settings
+
+
+@pytest.fixture()
+def cgroup(mocker, tmp_path):
+    mocker.patch('cykubedrunner.resources.CGROUP_ROOT', str(tmp_path))
+
+    def write(**files):
+        for path, content in files.items():
+            path = tmp_path / path
+            os.makedirs(path.parent, exist_ok=True)
+            path.write_text(content)
+    return write
+
+
+@pytest.fixture()
+def auto_concurrency():
+    settings.AUTO_CONCURRENCY = True
+    yield
+    settings.AUTO_CONCURRENCY = False
+
+
+def test_cgroup_v2(cgroup):
+    cgroup(**{'cpu.max': '250000 100000\n', 'memory.max': f'{8 * GiB}\n', 'memory.current': f'{3 * GiB}\n',
+              'memory.stat': f'anon 1000\ninactive_file {GiB}\nactive_file 2000\n'})
+    assert resources.get_cpu_limit() == 2.5
+    assert resources.get_memory_limit() == 8 * GiB
+    assert resources.get_memory_usage() == 2 * GiB
+
+
+def test_cgroup_v2_unlimited(cgroup):
+    cgroup(**{'cpu.max': 'max 100000', 'memory.max': 'max'})
+    assert resources.get_cpu_limit() == len(os.sched_getaffinity(0))
+    assert resources.get_memory_limit() is None
+
+
+def test_cgroup_v1(cgroup):
+    cgroup(**{'cpu/cpu.cfs_quota_us': '400000', 'cpu/cpu.cfs_period_us': '100000',
+              'memory/memory.limit_in_bytes': str(4 * GiB), 'memory/memory.usage_in_bytes': str(3 * GiB),
+              'memory/memory.stat': f'cache 100\ntotal_inactive_file {GiB}\n'})
+    assert resources.get_cpu_limit() == 4
+    assert resources.get_memory_limit() == 4 * GiB
+    assert resources.get_memory_usage() == 2 * GiB
+
+
+def test_cgroup_v1_unlimited(cgroup):
+    cgroup(**{'cpu/cpu.cfs_quota_us': '-1', 'cpu/cpu.cfs_period_us': '100000',
+              'memory/memory.limit_in_bytes': '9223372036854771712'})
+    assert resources.get_cpu_limit() == len(os.sched_getaffinity(0))
+    assert resources.get_memory_limit() is None
+
+
+def test_available_memory_limited_by_cgroup(mocker, cgroup):
+    mocker.patch('psutil.virtual_memory', return_value=mocker.Mock(available=32 * GiB))
+    cgroup(**{'memory.max': str(8 * GiB), 'memory.current': str(5 * GiB)})
+    assert resources.get_available_memory() == 3 * GiB
+
+
+def test_concurrency_disabled(mocker, cgroup):
+    cgroup(**{'cpu.max': '800000 100000'})
+    mocker.patch('cykubedrunner.resources.get_available_memory', return_value=64 * GiB)
+    assert resources.get_cypress_concurrency(['chrome', 'firefox']) == (1, 1)
+    assert resources.get_playwright_workers(['chromium']) == 1
+
+
+def test_cypress_concurrency(mocker, cgroup, auto_concurrency):
+    cgroup(**{'cpu.max': '800000 100000'})
+    available = mocker.patch('cykubedrunner.resources.get_available_memory', return_value=9 * GiB)
+    # limited by memory: firefox needs 2GB
+    assert resources.get_cypress_concurrency(['chrome', 'firefox']) == (2, 2)
+    assert resources.get_cypress_concurrency(['electron']) == (6, 1)
+    # under memory pressure we back off
+    available.return_value = GiB
+    assert resources.get_cypress_concurrency(['chrome', 'firefox']) == (1, 1)
+    # limited by CPU
+    available.return_value = 64 * GiB
+    cgroup(**{'cpu.max': '150000 100000'})
+    assert resources.get_cypress_concurrency(['chrome', 'firefox']) == (1, 1)
+
+
+def test_playwright_workers(mocker, cgroup, auto_concurrency):
+    cgroup(**{'cpu.max': '400000 100000'})
+    mocker.patch('cykubedrunner.resources.get_available_memory', return_value=64 * GiB)
+    assert resources.get_playwright_workers(['chromium', 'webkit']) == 4
+    settings.MAX_CONCURRENCY = 2
+    try:
+        assert resources.get_playwright_workers(['chromium', 'webkit']) == 2
+    finally:
+        settings.MAX_CONCURRENCY = 8
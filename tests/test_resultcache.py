@@ -0,0 +1,117 @@
+import json
+import os
+
+from httpx import Response
+
+from cykubedrunner.common.enums import TestResultStatus
+from cykubedrunner.common.schemas import NewTestRun, SpecTests, SpecTest, TestResult
+from cykubedrunner.resultcache import ResultCache, get_dependencies, result_cache
+from cykubedrunner.runner import run_spec
+from cykubedrunner.settings import settings
+
+
+def write(path: str, content: str):
+    path = os.path.join(settings.src_dir, path)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as f:
+        f.write(content)
+
+
+def make_result(status=TestResultStatus.passed) -> SpecTests:
+    return SpecTests(tests=[SpecTest(title='works', line=3, status=status,
+                                     results=[TestResult(browser='electron', status=status)])])
+
+
+def setup_project():
+    write('cypress/e2e/login.cy.ts', "import { login } from '../support/helpers';\nimport 'lodash';\n")
+    write('cypress/support/helpers.ts', "export * from './constants'\n")
+    write('cypress/support/constants.js', "export const USER = 'fred';\n")
+    write('cypress/e2e/other.cy.ts', "describe('other', () => {})\n")
+    write('dist/index.html', '<html></html>')
+
+
+def test_get_dependencies():
+    settings.init_build_dirs()
+    setup_project()
+    assert get_dependencies('cypress/e2e/login.cy.ts') == ['cypress/e2e/login.cy.ts',
+                                                           'cypress/support/constants.js',
+                                                           'cypress/support/helpers.ts']
+
+
+def test_result_cache(testrun: NewTestRun):
+    settings.RESULT_CACHE = True
+    try:
+        settings.init_build_dirs()
+        setup_project()
+        cache = ResultCache()
+        cache.init(testrun)
+
+        assert cache.get('cypress/e2e/login.cy.ts') is None
+
+        # failures aren't cached
+        cache.put('cypress/e2e/login.cy.ts', make_result(TestResultStatus.failed))
+        assert cache.get('cypress/e2e/login.cy.ts') is None
+
+        cache.put('cypress/e2e/login.cy.ts', make_result())
+        assert cache.get('cypress/e2e/login.cy.ts') == make_result()
+
+        # changing an unrelated spec makes no difference
+        write('cypress/e2e/other.cy.ts', "describe('changed', () => {})\n")
+        assert cache.get('cypress/e2e/login.cy.ts')
+
+        # but changing something it imports does
+        write('cypress/support/constants.js', "export const USER = 'bob';\n")
+        assert cache.get('cypress/e2e/login.cy.ts') is None
+
+        # as does rebuilding the app
+        cache.put('cypress/e2e/login.cy.ts', make_result())
+        write('dist/index.html', '<html>new</html>')
+        cache.init(testrun)
+        assert cache.get('cypress/e2e/login.cy.ts') is None
+
+        cache.put('cypress/e2e/login.cy.ts', make_result())
+        settings.FORCE_RERUN = True
+        assert cache.get('cypress/e2e/login.cy.ts') is None
+    finally:
+        settings.RESULT_CACHE = False
+        settings.FORCE_RERUN = False
+
+
+def test_run_spec_from_cache(respx_mock, mocker, testrun: NewTestRun, post_logs_mock):
+    settings.RESULT_CACHE = True
+    try:
+        settings.init_build_dirs()
+        setup_project()
+        mocker.patch.object(result_cache, 'testrun', testrun)
+        mocker.patch.object(result_cache, 'base_digest', None)
+        result_cache.put('cypress/e2e/login.cy.ts', make_result())
+
+        spec_completed_mock = respx_mock.post(f'https://api.cykubed.com/agent/testrun/{testrun.id}/spec-completed')\
+            .mock(return_value=Response(200))
+        runner = mocker.patch('cykubedrunner.runner.CypressSpecRunner')
+
+        run_spec(None, testrun, 'cypress/e2e/login.cy.ts')
+
+        assert not runner.called
+        payload = json.loads(spec_completed_mock.calls.last.request.content)
+        assert payload['cached']
+        assert payload['file'] == 'cypress/e2e/login.cy.ts'
+    finally:
+        settings.RESULT_CACHE = False
+
+
+def test_result_cache_write_failure(mocker, testrun: NewTestRun):
+    settings.RESULT_CACHE = True
+    try:
+        settings.init_build_dirs()
+        setup_project()
+        cache = ResultCache()
+        cache.init(testrun)
+        mocker.patch('cykubedrunner.resultcache.os.replace', side_effect=OSError('Read-only file system'))
+        warning = mocker.patch('cykubedrunner.resultcache.logger.warning')
+        # this isn't fatal
+        cache.put('cypress/e2e/login.cy.ts', make_result())
+        assert warning.called
+        assert cache.get('cypress/e2e/login.cy.ts') is None
+    finally:
+        settings.RESULT_CACHE = False
@@ -0,0 +1,73 @@
+import os
+import time
+
+import pytest
+
+from cykubedrunner.scratch import Scratch, get_scratch_root, SHM_DIR
+from cykubedrunner.settings import settings
+
+
+@pytest.fixture()
+def scratch_dir(monkeypatch):
+    path = os.path.join(settings.BUILD_DIR, 'scratch')
+    monkeypatch.setattr(settings, 'SCRATCH_DIR', path)
+    return path
+
+
+def write(path: str, size: int):
+    with open(os.path.join(path, 'video.mp4'), 'wb') as f:
+        f.write(b'x' * size)
+
+
+def test_release_after_upload(scratch_dir):
+    scratch = Scratch()
+    single = scratch.create(['a.cy.ts'])
+    batch = scratch.create(['a.cy.ts', 'b.cy.ts'])
+    assert os.path.dirname(single) == scratch_dir
+
+    scratch.release('a.cy.ts')
+    assert not os.path.exists(single)
+    # b hasn't been uploaded yet
+    assert os.path.exists(batch)
+    scratch.release('b.cy.ts')
+    assert os.listdir(scratch_dir) == []
+
+
+def test_reset(scratch_dir):
+    scratch = Scratch()
+    scratch.create(['a.cy.ts'])
+    # the results were never uploaded
+    scratch.reset()
+    assert os.listdir(scratch_dir) == []
+    assert scratch.dirs == dict()
+
+
+def test_evict_over_quota(scratch_dir, monkeypatch):
+    monkeypatch.setattr(settings, 'SCRATCH_MAX_SIZE', 1500)
+    scratch = Scratch()
+    # left behind by an earlier runner
+    os.makedirs(os.path.join(scratch_dir, 'spec-old'))
+    write(os.path.join(scratch_dir, 'spec-old'), 1000)
+    os.utime(os.path.join(scratch_dir, 'spec-old'), (time.time() - 60, time.time() - 60))
+
+    first = scratch.create(['a.cy.ts'])
+    write(first, 1000)
+    # the next run takes us over the quota
+    second = scratch.create(['b.cy.ts'])
+    assert not os.path.exists(os.path.join(scratch_dir, 'spec-old'))
+
+    # we never delete a directory still in use
+    write(second, 1000)
+    scratch.create(['c.cy.ts'])
+    assert os.path.exists(first)
+    assert os.path.exists(second)
+
+
+def test_tmpfs_root(mocker, monkeypatch, scratch_dir):
+    monkeypatch.setattr(settings, 'SCRATCH_TMPFS', True)
+    mocker.patch('shutil.disk_usage', return_value=mocker.Mock(free=8 * 1024 ** 3))
+    available = mocker.patch('cykubedrunner.resources.get_available_memory', return_value=8 * 1024 ** 3)
+    assert get_scratch_root() == os.path.join(SHM_DIR, 'cykubed-scratch')
+    # tmpfs uses the pod's memory
+    available.return_value = 1024 ** 3
+    assert get_scratch_root() == scratch_dir
@@ -0,0 +1,43 @@
+import os
+
+import pytest
+
+from cykubedrunner.common.exceptions import RunFailedException
+from cykubedrunner.settings import settings
+from cykubedrunner.snapshot import create_snapshot, extract_snapshot, snapshot_exists
+
+
+@pytest.fixture
+def workspace():
+    src = settings.src_dir
+    os.makedirs(os.path.join(src, 'node_modules', 'pkg', 'lib'))
+    os.makedirs(os.path.join(src, 'node_modules', '.bin'))
+    os.makedirs(os.path.join(src, '.git', 'objects'))
+    os.makedirs(os.path.join(src, 'empty'))
+    for i in range(50):
+        with open(os.path.join(src, 'node_modules', 'pkg', 'lib', f'file{i}.js'), 'w') as f:
+            f.write('x' * i * 100)
+    os.symlink('../pkg/lib/file1.js', os.path.join(src, 'node_modules', '.bin', 'pkg'))
+    return src
+
+
+def test_snapshot_roundtrip(workspace):
+    create_snapshot()
+    assert snapshot_exists()
+
+    dest = os.path.join(settings.BUILD_DIR, 'workspace')
+    extract_snapshot(dest)
+    assert sorted(os.listdir(dest)) == ['empty', 'node_modules']
+    assert len(os.listdir(os.path.join(dest, 'node_modules', 'pkg', 'lib'))) == 50
+    assert os.readlink(os.path.join(dest, 'node_modules', '.bin', 'pkg')) == '../pkg/lib/file1.js'
+    with open(os.path.join(dest, 'node_modules', 'pkg', 'lib', 'file3.js')) as f:
+        assert f.read() == 'x' * 300
+
+
+def test_corrupt_snapshot(workspace):
+    create_snapshot()
+    # append junk to a shard (which gzip will ignore)
+    with open(os.path.join(settings.snapshot_dir, 'shard-0.tar.gz'), 'ab') as f:
+        f.write(b'\0' * 16)
+    with pytest.raises(RunFailedException):
+        extract_snapshot(os.path.join(settings.BUILD_DIR, 'workspace'))
@@ -0,0 +1,97 @@
+import json
+import os
+import threading
+import time
+
+from httpx import Response
+
+from cykubedrunner.common.enums import TestResultStatus
+from cykubedrunner.common.schemas import NewTestRun, SpecTests, SpecTest, TestResult
+from cykubedrunner.settings import settings
+from cykubedrunner.spool import Spool
+
+
+def make_result(screenshot: str) -> SpecTests:
+    return SpecTests(tests=[SpecTest(title='fails', status=TestResultStatus.failed,
+                                     results=[TestResult(browser='electron', status=TestResultStatus.failed,
+                                                         failure_screenshots=[screenshot])])])
+
+
+def test_spool_survives_api_outage(respx_mock, testrun: NewTestRun):
+    settings.SPOOL_DIR = os.path.join(settings.BUILD_DIR, 'spool')
+    screenshot = os.path.join(settings.BUILD_DIR, 'fails.png')
+    with open(screenshot, 'wb') as f:
+        f.write(b'png')
+
+    upload_mock = respx_mock.post(f'https://api.cykubed.com/agent/testrun/{testrun.id}/upload-artifacts').mock(
+        side_effect=[Response(503)] + [Response(200, json={'urls': ['http://fails.png']})] * 2)
+    spec_completed_mock = respx_mock.post(f'https://api.cykubed.com/agent/testrun/{testrun.id}/spec-completed')\
+        .mock(side_effect=[Response(502), Response(200)])
+
+    spool = Spool()
+    spool.add('cypress/e2e/fails.cy.ts', make_result(screenshot))
+    # we can delete the original artifacts straight away
+    os.remove(screenshot)
+
+    assert spool.drain(10)
+
+    assert upload_mock.call_count == 3
+    assert spec_completed_mock.call_count == 2
+    payload = json.loads(spec_completed_mock.calls.last.request.content)
+    assert payload['file'] == 'cypress/e2e/fails.cy.ts'
+    assert payload['result']['tests'][0]['results'][0]['failure_screenshots'] == ['http://fails.png']
+
+    # nothing left to send
+    assert Spool().load() == []
+    assert os.listdir(settings.SPOOL_DIR) == ['journal.jsonl']
+
+
+def test_spool_replays_unsent_results(respx_mock, testrun: NewTestRun):
+    settings.SPOOL_DIR = os.path.join(settings.BUILD_DIR, 'spool')
+    os.makedirs(settings.SPOOL_DIR)
+    with open(os.path.join(settings.SPOOL_DIR, 'journal.jsonl'), 'w') as f:
+        for entry_id in ['a', 'b']:
+            record = dict(id=entry_id, trid=testrun.id, spec=f'{entry_id}.cy.ts', cached=False, screenshots=[],
+                          video=None, result=SpecTests(tests=[]).json())
+            f.write(json.dumps(record) + '\n')
+        f.write(json.dumps(dict(id='a', done=True)) + '\n')
+        f.write('{"id": "c", "tr')
+
+    spec_completed_mock = respx_mock.post(f'https://api.cykubed.com/agent/testrun/{testrun.id}/spec-completed')\
+        .mock(return_value=Response(200))
+
+    spool = Spool()
+    spool.start()
+    assert spool.drain(10)
+
+    assert spec_completed_mock.call_count == 1
+    assert json.loads(spec_completed_mock.calls.last.request.content)['file'] == 'b.cy.ts'
+
+
+def test_spool_reset(respx_mock, testrun: NewTestRun):
+    settings.SPOOL_DIR = os.path.join(settings.BUILD_DIR, 'spool')
+    spec_completed_mock = respx_mock.post(f'https://api.cykubed.com/agent/testrun/{testrun.id}/spec-completed')\
+        .mock(side_effect=[Response(503), Response(200)])
+
+    spool = Spool()
+    spool.add('cypress/e2e/a.cy.ts', SpecTests(tests=[]))
+    assert not spool.drain(0.5)
+    # the next test run starts afresh, and sends what was left in the journal
+    spool.reset()
+    assert spool.thread is None and spool.queue.unfinished_tasks == 0
+    spool.start()
+    assert spool.drain(10)
+    assert spec_completed_mock.call_count == 2
+
+
+def test_spool_starts_once(mocker):
+    settings.SPOOL_DIR = os.path.join(settings.BUILD_DIR, 'spool')
+    spool = Spool()
+    load = mocker.patch.object(spool, 'load', side_effect=lambda: time.sleep(0.1) or [])
+    threads = [threading.Thread(target=spool.start) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert load.call_count == 1
+    spool.reset()
@@ -0,0 +1,32 @@
+import os
+import subprocess
+import sys
+import time
+
+import pytest
+
+# generous, as CI machines vary - this is to catch an eager import of something heavy creeping back in
+STARTUP_BUDGET = 3.0
+
+HEAVY_MODULES = ['sentry_sdk', 'google.cloud.logging', 'psutil', 'yaml', 'wcmatch',
+                 'cykubedrunner.builder', 'cykubedrunner.runner', 'cykubedrunner.server']
+
+
+def run_python(code: str) -> subprocess.CompletedProcess:
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path))
+    return subprocess.run([sys.executable, '-c', code], env=env, capture_output=True, text=True)
+
+
+def test_main_imports_are_lazy():
+    result = run_python('import sys, cykubedrunner.main; print("\\n".join(sys.modules))')
+    assert result.returncode == 0, result.stderr
+    modules = set(result.stdout.splitlines())
+    assert not modules.intersection(HEAVY_MODULES)
+
+
+@pytest.mark.parametrize('cmd', ['build', 'prepare_cache', 'run'])
+def test_startup_budget(cmd):
+    t = time.time()
+    result = run_python(f'from cykubedrunner import main; main.get_command({cmd!r})')
+    assert result.returncode == 0, result.stderr
+    assert time.time() - t < STARTUP_BUDGET
@@ -0,0 +1,124 @@
+import threading
+import time
+
+import pytest
+
+from cykubedrunner.common.exceptions import BuildFailedException
+from cykubedrunner.steps import BuildStep, run_steps
+from cykubedrunner.utils import runcmd, commands_cancelled, logger
+
+
+def test_run_steps_respects_dependencies():
+    order = []
+    lock = threading.Lock()
+
+    def step(name, delay=0.0):
+        def fn():
+            time.sleep(delay)
+            with lock:
+                order.append(name)
+            return name
+        return fn
+
+    clone = BuildStep('clone', step('clone'))
+    node = BuildStep('node', step('node', 0.1), requires=[clone])
+    specs = BuildStep('specs', step('specs'), requires=[clone])
+    verify = BuildStep('verify', step('verify'), requires=[node])
+    app = BuildStep('app', step('app'), requires=[node])
+
+    timings = run_steps([verify, app, specs, node, clone], 4)
+
+    assert set(timings.keys()) == {'clone', 'node', 'specs', 'verify', 'app'}
+    assert order[0] == 'clone'
+    # specs doesn't wait for the (slower) node environment
+    assert order.index('specs') < order.index('node')
+    assert order.index('node') < order.index('verify')
+    assert order.index('node') < order.index('app')
+    assert verify.result == 'verify'
+
+
+def test_run_steps_bounded_concurrency():
+    active = []
+    peak = []
+    lock = threading.Lock()
+
+    def fn():
+        with lock:
+            active.append(1)
+            peak.append(len(active))
+        time.sleep(0.05)
+        with lock:
+            active.pop()
+
+    run_steps([BuildStep(f'step{i}', fn) for i in range(6)], 2)
+    assert max(peak) == 2
+
+
+def test_run_steps_fail_fast():
+    started = []
+
+    def fail():
+        raise BuildFailedException('Broken')
+
+    def slow():
+        # this will be killed when the other step fails
+        runcmd('sleep 10', cmd=True)
+
+    failing = BuildStep('fail', fail)
+    after = BuildStep('after', lambda: started.append(1), requires=[failing])
+
+    t = time.time()
+    with pytest.raises(BuildFailedException) as ex:
+        run_steps([BuildStep('slow', slow), failing, after], 4)
+
+    assert ex.value.msg == 'Broken'
+    assert time.time() - t < 5
+    assert not started
+    assert not commands_cancelled.is_set()
+
+
+def test_run_steps_circular_dependency():
+    a = BuildStep('a', lambda: None)
+    b = BuildStep('b', lambda: None, requires=[a])
+    a.requires = [b]
+    with pytest.raises(BuildFailedException):
+        run_steps([a, b], 2)
+
+
+def test_concurrent_steps_log_their_own_step():
+    logger.init(None, source='builder')
+    barrier = threading.Barrier(2)
+
+    def fn():
+        logger.cmd('npm run build')
+        # wait for the other step to run its command
+        barrier.wait(5)
+        return logger.step
+
+    a, b = BuildStep('a', fn), BuildStep('b', fn)
+    run_steps([a, b], 2)
+    assert {a.result, b.result} == {1, 2}
+
+
+
+def test_step_cleared_after_build_step():
+    logger.init(None, source='builder')
+
+    def fn():
+        logger.cmd('npm ci')
+        # meanwhile another step runs a command
+        thread = threading.Thread(target=logger.cmd, args=('npm run build',))
+        thread.start()
+        thread.join()
+        return logger.step
+
+    def no_command():
+        return logger.step
+
+    # the same thread runs both steps
+    first = BuildStep('first', fn)
+    second = BuildStep('second', no_command, requires=[first])
+    run_steps([first, second], 1)
+    assert first.result == 1
+    # not the command the thread ran for the first step
+    assert second.result == 2
@@ -0,0 +1,42 @@
+import os
+import shutil
+import subprocess
+
+import pytest
+
+from cykubedrunner.settings import settings
+from cykubedrunner.video import merge_windows, get_ffmpeg_args, make_failure_clip
+
+
+def test_merge_windows():
+    assert merge_windows([(30.0, 32.0), (2.0, 4.0), (8.0, 10.0)]) == [(0.0, 15.0), (25.0, 37.0)]
+
+
+def test_ffmpeg_args():
+    args = get_ffmpeg_args('in.mp4', 'out.mp4', [(0.0, 15.0), (25.0, 37.0)])
+    assert args[args.index('-vf') + 1] == \
+           "select='between(t,0.00,15.00)+between(t,25.00,37.00)',setpts=N/FRAME_RATE/TB"
+    assert args[args.index('-b:v') + 1] == settings.VIDEO_BITRATE
+    assert args[-1] == 'out.mp4'
+    # without any windows we just transcode it
+    assert '-vf' not in get_ffmpeg_args('in.mp4', 'out.mp4', [])
+
+
+@pytest.mark.skipif(not shutil.which('ffmpeg'), reason='needs ffmpeg')
+def test_make_failure_clip():
+    video = os.path.join(settings.BUILD_DIR, 'test.cy.ts.mp4')
+    subprocess.run(['ffmpeg', '-loglevel', 'error', '-f', 'lavfi', '-i', 'testsrc=duration=30:size=320x240:rate=10',
+                    video], check=True)
+
+    clip = make_failure_clip(video, [(20.0, 22.0)])
+
+    assert clip != video
+    assert not os.path.exists(video)
+    duration = subprocess.check_output(['ffprobe', '-v', 'error', '-show_entries', 'format=duration',
+                                        '-of', 'csv=p=0', clip], text=True)
+    assert 11 <= float(duration) <= 13
+
+
+def test_make_failure_clip_without_ffmpeg(mocker):
+    mocker.patch('cykubedrunner.video.shutil.which', return_value=None)
+    assert make_failure_clip('test.mp4', []) == 'test.mp4'
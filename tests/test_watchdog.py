@@ -0,0 +1,38 @@
+import os
+
+from cykubedrunner.settings import settings
+from cykubedrunner.watchdog import ResourceUsage, SpecUsage, ProcessWatchdog, get_spec_memory_limit, running_specs, \
+    MB
+
+
+def test_spec_usage():
+    usage = SpecUsage()
+    usage.record(['a.spec.ts'], ResourceUsage(peak_rss=100 * MB, peak_cpu=80.04, cpu_time=2.0))
+    # specs run in a batch share the usage
+    usage.record(['a.spec.ts', 'b.spec.ts'], ResourceUsage(peak_rss=50 * MB, peak_cpu=120.0, cpu_time=1.53))
+    assert usage.pop('a.spec.ts') == dict(peak_rss=100 * MB, peak_cpu=120.0, cpu_time=3.5,
+                                             scratch_bytes=0)
+    assert usage.pop('b.spec.ts') == dict(peak_rss=50 * MB, peak_cpu=120.0, cpu_time=1.5,
+                                             scratch_bytes=0)
+    assert usage.pop('a.spec.ts') is None
+
+
+def test_process_watchdog():
+    watchdog = ProcessWatchdog(os.getpid())
+    assert watchdog.sample() > 0
+    watchdog.sample()
+    assert watchdog.usage.peak_rss > 0
+    assert watchdog.usage.cpu_time > 0
+
+
+def test_spec_memory_limit(mocker, monkeypatch):
+    memory_limit = mocker.patch('cykubedrunner.watchdog.get_memory_limit', return_value=None)
+    assert get_spec_memory_limit() is None
+    memory_limit.return_value = 1000 * MB
+    assert get_spec_memory_limit() == 900 * MB
+    # shared between the specs running at once
+    with running_specs.track(), running_specs.track(), running_specs.track():
+        assert get_spec_memory_limit() == 300 * MB
+    assert running_specs.count == 0
+    monkeypatch.setattr(settings, 'SPEC_MEMORY_LIMIT', 200 * MB)
+    assert get_spec_memory_limit() == 200 * MB
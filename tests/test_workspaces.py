@@ -0,0 +1,47 @@
+import json
+
+from cykubedrunner.workspaces import get_workspace_paths
+
+
+def make_repo(workspaces, packages: dict[str, dict]) -> dict[str, str]:
+    files = {'package.json': json.dumps(dict(name='monorepo', private=True, workspaces=workspaces)),
+             'yarn.lock': ''}
+    for wdir, manifest in packages.items():
+        files[f'{wdir}/package.json'] = json.dumps(manifest)
+        files[f'{wdir}/src/index.ts'] = ''
+    return files
+
+
+PACKAGES = {
+    'apps/web': dict(name='web', dependencies={'@acme/ui': 'workspace:*', 'react': '^18.2.0'},
+                     devDependencies={'@acme/test-utils': '*'}),
+    'apps/admin': dict(name='admin', dependencies={'@acme/ui': 'workspace:*'}),
+    'libs/ui': dict(name='@acme/ui', dependencies={'@acme/tokens': 'workspace:^'}),
+    'libs/tokens': dict(name='@acme/tokens'),
+    'libs/testing/utils': dict(name='@acme/test-utils'),
+    'tools/scripts': dict(name='scripts'),
+}
+
+
+def test_workspace_dependencies():
+    files = make_repo(['apps/*', 'libs/**', '!tools/*'], PACKAGES)
+    assert get_workspace_paths('apps/web/', list(files), files.get) == \
+           ['apps/web', 'libs/ui', 'libs/testing/utils', 'libs/tokens']
+    assert get_workspace_paths('libs/tokens', list(files), files.get) == ['libs/tokens']
+
+
+def test_yarn1_nohoist_workspaces():
+    files = make_repo(dict(packages=['./apps/*', 'libs/ui/']), PACKAGES)
+    # libs/tokens isn't a workspace, so is installed from the registry
+    assert get_workspace_paths('apps/admin', list(files), files.get) == ['apps/admin', 'libs/ui']
+
+
+def test_pnpm_workspaces():
+    files = make_repo(None, PACKAGES)
+    files['pnpm-workspace.yaml'] = "packages:\n  - 'apps/*'\n  - 'libs/*'\n"
+    assert get_workspace_paths('apps/admin', list(files), files.get) == ['apps/admin', 'libs/ui', 'libs/tokens']
+
+
+def test_not_a_monorepo():
+    files = {'package.json': json.dumps(dict(name='app')), 'e2e/package.json': '{}'}
+    assert get_workspace_paths('e2e', list(files), files.get) == ['e2e']